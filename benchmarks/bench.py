@@ -0,0 +1,251 @@
+#!/usr/bin/python3
+import os
+import sys
+import json
+import time
+import zlib
+import base64
+import random
+import shutil
+import socket
+import struct
+import argparse
+import datetime
+import tempfile
+import threading
+import subprocess
+import http.client
+
+
+BLGR = os.path.abspath(os.path.join(os.path.dirname(__file__), os.pardir, 'blgr', 'blgr.py'))
+# metrics where a bigger number is an improvement, everything else is a cost
+HIGHER_IS_BETTER = ('requests_per_second',)
+
+
+def make_png(size, rnd):
+    # random pixels do not compress, so the encoded image is close to size bytes
+    width = max(1, int((size / 3) ** 0.5))
+    raw = b''.join(b'\0' + bytes(rnd.getrandbits(8) for _ in range(width * 3)) for _ in range(width))
+
+    def chunk(kind, data):
+        return struct.pack('>I', len(data)) + kind + data + struct.pack('>I', zlib.crc32(kind + data))
+
+    return (b'\x89PNG\r\n\x1a\n' + chunk(b'IHDR', struct.pack('>IIBBBBB', width, width, 8, 2, 0, 0, 0)) +
+            chunk(b'IDAT', zlib.compress(raw, 1)) + chunk(b'IEND', b''))
+
+
+def make_notebook(cells, images, image_kb, rnd):
+    nb_cells = []
+    for i in range(cells):
+        nb_cells.append({'cell_type': 'markdown', 'metadata': {},
+                         'source': ['## Section {}\n'.format(i), 'Some text about step {}.\n'.format(i)]})
+        outputs = [{'output_type': 'pyout', 'metadata': {}, 'prompt_number': i + 1,
+                    'text': ['{}'.format(rnd.random())]}]
+        if i < images:
+            png = base64.b64encode(make_png(image_kb * 1024, rnd)).decode('ascii')
+            outputs.append({'output_type': 'display_data', 'metadata': {}, 'png': png})
+        nb_cells.append({'cell_type': 'code', 'collapsed': False, 'language': 'python', 'metadata': {},
+                         'prompt_number': i + 1, 'outputs': outputs,
+                         'input': ['x = {}\n'.format(i), 'for i in range(x):\n', '    print(i * x)']})
+    return {'metadata': {'name': '', 'signature': ''}, 'nbformat': 3, 'nbformat_minor': 0,
+            'worksheets': [{'cells': nb_cells, 'metadata': {}}]}
+
+
+def make_blog(posts_path, posts=100, pages=2, cells=10, images=0, image_kb=32, categories=5, days=365, seed=0):
+    # same layout Create.execute produces: <ts>-<slug>/<slug><ts>.ipynb plus meta.json
+    rnd = random.Random(seed)
+    start = datetime.datetime(2015, 1, 1)
+    for i in range(posts):
+        dt = start + datetime.timedelta(seconds=rnd.randrange(days * 86400), microseconds=rnd.randrange(1, 10 ** 6))
+        ts = dt.strftime('%Y-%m-%d-%H')
+        slug = 'post-{}'.format(i)
+        post_dir = os.path.join(posts_path, '-'.join((ts, slug)))
+        os.makedirs(post_dir)
+        with open(os.path.join(post_dir, '{}{}.{}'.format(slug, ts, 'ipynb')), 'w') as nb:
+            json.dump(make_notebook(cells, images, image_kb, rnd), nb)
+        with open(os.path.join(post_dir, 'meta.json'), 'w') as meta:
+            json.dump({'title': 'Post {}'.format(i),
+                       'slug': slug,
+                       'category': 'category-{}'.format(rnd.randrange(categories)) if categories else '',
+                       'dt': dt.isoformat(),
+                       'comments': rnd.random() < 0.5,
+                       'set_link': i < pages},
+                      meta)
+
+
+def make_project(path, args):
+    posts_path = os.path.join(path, 'posts')
+    make_blog(posts_path, posts=args.posts, pages=args.pages, cells=args.cells, images=args.images,
+              image_kb=args.image_kb, categories=args.categories, days=args.days, seed=args.seed)
+    config = {'posts': {'path': posts_path},
+              'output': {'path': os.path.join(path, 'output'), 'page_size': 20},
+              'cache': {'path': os.path.join(path, 'cache')},
+              'converter': {'backend': 'inprocess'},
+              'disqus': 'bench'}
+    config_path = os.path.join(path, 'config.json')
+    with open(config_path, 'w') as cfg:
+        json.dump(config, cfg)
+    return config_path, config
+
+
+def run_blgr(config_path, *args):
+    started = time.perf_counter()
+    proc = subprocess.Popen([sys.executable, BLGR, '-c', config_path] + list(args),
+                            cwd=os.path.dirname(config_path), stdout=subprocess.DEVNULL)
+    # wait4 gives the rusage of this very child, including the pool workers it waited for
+    _, status, rusage = os.wait4(proc.pid, 0)
+    proc.returncode = os.waitstatus_to_exitcode(status)
+    if proc.returncode:
+        raise RuntimeError('blgr {} failed with {}'.format(' '.join(args), proc.returncode))
+    return {'wall': time.perf_counter() - started,
+            'peak_rss': rusage.ru_maxrss * (1 if sys.platform == 'darwin' else 1024)}
+
+
+def touch_one_post(config):
+    posts_path = config['posts']['path']
+    post_dir = os.path.join(posts_path, sorted(os.listdir(posts_path))[-1])
+    nb_path = [os.path.join(post_dir, f) for f in os.listdir(post_dir) if f.endswith('.ipynb')][0]
+    with open(nb_path, 'r') as nb_file:
+        nb = json.load(nb_file)
+    nb['worksheets'][0]['cells'].append({'cell_type': 'markdown', 'metadata': {}, 'source': ['edited']})
+    with open(nb_path, 'w') as nb_file:
+        json.dump(nb, nb_file)
+
+
+def bench_generate(config_path, config, jobs, stream=False):
+    jobs_args = (['-j', str(jobs)] if jobs else []) + (['--stream'] if stream else [])
+    out_path = config['output']['path']
+    if os.path.islink(out_path):
+        os.remove(out_path)
+    for path in (out_path, out_path + '.generations', config['cache']['path']):
+        shutil.rmtree(path, ignore_errors=True)
+    results = {'generate_cold': run_blgr(config_path, 'generate', *jobs_args),
+               'generate_warm': run_blgr(config_path, 'generate', '-i', *jobs_args)}
+    touch_one_post(config)
+    results['generate_one_changed'] = run_blgr(config_path, 'generate', '-i', *jobs_args)
+    return results
+
+
+def _free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def bench_serve(config_path, config, seconds, clients):
+    out_path = config['output']['path']
+    urls = []
+    for dirpath, _, filenames in os.walk(out_path):
+        if 'index.html' in filenames:
+            urls.append('/' + os.path.relpath(dirpath, out_path).replace(os.sep, '/').strip('./') + '/')
+    urls = [u.replace('//', '/') for u in sorted(urls)]
+
+    port = _free_port()
+    proc = subprocess.Popen([sys.executable, BLGR, '-c', config_path, 'serve', '-p', str(port),
+                             '-w', str(clients)], cwd=os.path.dirname(config_path),
+                            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        deadline = time.monotonic() + 10
+        while True:
+            try:
+                socket.create_connection(('127.0.0.1', port), timeout=1).close()
+                break
+            except OSError:
+                if time.monotonic() > deadline:
+                    raise
+                time.sleep(0.05)
+
+        counts = [0] * clients
+        stop = time.monotonic() + seconds
+
+        def client(n):
+            conn = http.client.HTTPConnection('127.0.0.1', port)
+            i = n
+            while time.monotonic() < stop:
+                conn.request('GET', urls[i % len(urls)], headers={'Accept-Encoding': 'gzip'})
+                conn.getresponse().read()
+                counts[n] += 1
+                i += clients
+            conn.close()
+
+        threads = [threading.Thread(target=client, args=(n,)) for n in range(clients)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    finally:
+        proc.terminate()
+        proc.wait()
+    return {'serve': {'requests_per_second': sum(counts) / seconds}}
+
+
+def compare(results, baseline, threshold):
+    regressions = []
+    lines = []
+    for name, metrics in sorted(results.items()):
+        for metric, value in sorted(metrics.items()):
+            base = baseline.get(name, {}).get(metric)
+            if not base:
+                lines.append('{:<22}{:<22}{:>14.3f}'.format(name, metric, value))
+                continue
+            change = (value - base) / base
+            worse = -change if metric in HIGHER_IS_BETTER else change
+            flag = ''
+            if worse > threshold:
+                flag = '  REGRESSION'
+                regressions.append((name, metric))
+            lines.append('{:<22}{:<22}{:>14.3f}{:>14.3f}{:>+9.1%}{}'.format(name, metric, value, base, change, flag))
+    return regressions, lines
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='blgr benchmarks on a synthetic blog')
+    parser.add_argument('--posts', type=int, default=200)
+    parser.add_argument('--pages', type=int, default=2, help='posts linked from the menu')
+    parser.add_argument('--cells', type=int, default=10, help='markdown/code cell pairs per notebook')
+    parser.add_argument('--images', type=int, default=2, help='cells with an embedded png per notebook')
+    parser.add_argument('--image-kb', type=int, default=32)
+    parser.add_argument('--categories', type=int, default=5)
+    parser.add_argument('--days', type=int, default=730, help='posts are spread over this many days')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('-j', '--jobs', type=int, default=None)
+    parser.add_argument('--stream', action='store_true', help='time streaming builds (generate --stream)')
+    parser.add_argument('--serve-seconds', type=float, default=5)
+    parser.add_argument('--serve-clients', type=int, default=8)
+    parser.add_argument('--results', default=None, help='write the results as json here')
+    parser.add_argument('--baseline', default=os.path.join(os.path.dirname(__file__), 'baseline.json'))
+    parser.add_argument('--save-baseline', action='store_true', help='store the results as the new baseline')
+    parser.add_argument('--threshold', type=float, default=0.2,
+                        help='relative slowdown reported as a regression')
+    parser.add_argument('--keep', action='store_true', help='keep the synthetic project')
+    args = parser.parse_args(argv)
+
+    project = tempfile.mkdtemp(prefix='blgr-bench-')
+    try:
+        config_path, config = make_project(project, args)
+        results = bench_generate(config_path, config, args.jobs, args.stream)
+        if args.serve_seconds:
+            results.update(bench_serve(config_path, config, args.serve_seconds, args.serve_clients))
+    finally:
+        if args.keep:
+            print('synthetic project kept in {}'.format(project))
+        else:
+            shutil.rmtree(project)
+
+    if args.results:
+        with open(args.results, 'w') as results_file:
+            json.dump(results, results_file, indent=1, sort_keys=True)
+    baseline = {}
+    if os.path.exists(args.baseline):
+        with open(args.baseline, 'r') as baseline_file:
+            baseline = json.load(baseline_file)
+    regressions, lines = compare(results, baseline, args.threshold)
+    print('\n'.join(lines))
+    if args.save_baseline:
+        with open(args.baseline, 'w') as baseline_file:
+            json.dump(results, baseline_file, indent=1, sort_keys=True)
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,23 +1,1537 @@
 #!/usr/bin/python3
+# blgr runs from git hooks and scripts, so only what every command needs is
+# imported here; jinja2, nbconvert, http.server, sqlite3 and the like are
+# imported by the code that uses them
 import os
+import io
+import re
+import sys
 import json
+import time
 import shutil
-import datetime
+import hashlib
 import argparse
-import http.server
-import socketserver
-from subprocess import call
+import datetime
+import functools
+import itertools
+import threading
+import contextlib
+
+try:
+    import resource
+except ImportError:  # not available on windows
+    resource = None
+
+
+MANIFEST_NAME = '.blgr-manifest.json'
+FRAGMENT_NAME = '.blgr-fragment.json'
+PUBLISH_MANIFEST_NAME = '.blgr-publish.json'
+SHARDS_SUFFIX = '.shards'
+PREVIEW_SUFFIX = '.preview'
+MANIFEST_VERSION = 1
+DEFAULT_CACHE_PATH = './.cache'
+DEFAULT_CACHE_SIZE = 256 * 1024 * 1024
+COMPRESSIBLE_EXTS = ('.html', '.css', '.js')
+COMPRESSED_EXTS = {'br': '.br', 'gzip': '.gz'}
+DEFAULT_SERVE_WORKERS = 32
+DEFAULT_SERVE_CONNECTIONS = 512
+DEFAULT_SERVE_TIMEOUT = 15
+DEFAULT_WATCH_DEBOUNCE = 0.3
+DEFAULT_PAGE_SIZE = 20
+DEFAULT_PROFILE_TOP = 10
+DEFAULT_GENERATIONS = 3
+STREAM_BATCH = 256
+GENERATIONS_SUFFIX = '.generations'
+STAGING_SUFFIX = '.staging'
+GENERATION_FORMAT = '%Y%m%d-%H%M%S-%f'
+ASSETS_DIR = 'assets'
+IMAGE_EXTS = {'image/png': '.png', 'image/jpeg': '.jpg', 'image/gif': '.gif',
+              'image/svg+xml': '.svg', 'image/webp': '.webp'}
+BOILERPLATE_SCRIPTS = ('text/javascript', 'application/javascript', 'module')
+STYLES_MARK = '\0blgr-styles\0'
+SEARCH_DIR = 'search'
+SEARCH_TERM = re.compile(r'\w+')
+SEARCH_TERM_LENGTH = (2, 32)
+SEARCH_TITLE_WEIGHT = 5
+DEFAULT_SEARCH_PREFIX = 2
+TEMPLATES = ('base.html', 'index.html', 'menu.html', 'comments.html', 'search.html')
+RELOAD_PATH = '/__blgr/reload'
+RELOAD_SCRIPT = '''<script>
+(function() {
+    var source = new EventSource('%s?path=' + encodeURIComponent(location.pathname));
+    source.onmessage = function() { location.reload(); };
+})();
+</script>''' % RELOAD_PATH
+
+
+def _empty_manifest():
+    return {'version': MANIFEST_VERSION, 'global': None, 'sources': {}, 'indexes': {}, 'files': {}}
+
+
+def _hash_bytes(*chunks):
+    h = hashlib.sha1()
+    for chunk in chunks:
+        h.update(chunk)
+    return h.hexdigest()
+
+
+def _hash_file(*paths):
+    h = hashlib.sha1()
+    for path in paths:
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(65536), b''):
+                h.update(chunk)
+    return h.hexdigest()
+
+
+def _hash_json(data):
+    return _hash_bytes(json.dumps(data, sort_keys=True, default=str).encode('utf-8'))
+
+
+def _compress_file(path, encoding, base_path=None):
+    compressed_path = path + COMPRESSED_EXTS[encoding]
+    st = os.stat(path)
+    # siblings carry the mtime of their source, so an equal mtime means up to date
+    if os.path.exists(compressed_path) and os.stat(compressed_path).st_mtime == st.st_mtime:
+        return False
+    # a source carried over from the published generation (base_path) keeps
+    # its mtime there, and so does its sibling
+    base_compressed = base_path + COMPRESSED_EXTS[encoding] if base_path else None
+    if base_compressed and os.path.exists(base_compressed) and os.stat(base_compressed).st_mtime == st.st_mtime:
+        _link_replace(base_compressed, compressed_path)
+        return False
+
+    with open(path, 'rb') as src:
+        data = src.read()
+    if encoding == 'br':
+        import brotli
+        data = brotli.compress(data)
+    else:
+        import gzip
+        data = gzip.compress(data, compresslevel=9, mtime=0)
+    tmp_path = '{}.{}.tmp'.format(compressed_path, os.getpid())
+    with open(tmp_path, 'wb') as dst:
+        dst.write(data)
+    os.utime(tmp_path, ns=(st.st_atime_ns, st.st_mtime_ns))
+    os.replace(tmp_path, compressed_path)
+    return True
+
+
+def _accepted_encodings(header):
+    accepted = set()
+    for coding in header.split(','):
+        name, _, params = coding.partition(';')
+        q = 1.0
+        for param in params.split(';'):
+            key, _, value = param.strip().partition('=')
+            if key == 'q':
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0
+        if name.strip() and q > 0:
+            accepted.add(name.strip().lower())
+    return accepted
+
+
+def _link_or_copy(src, dst):
+    try:
+        os.link(src, dst)
+    except OSError:  # no hardlinks across devices or on some filesystems
+        shutil.copy2(src, dst)
+
+
+def _list_generations(generations_path):
+    if not os.path.isdir(generations_path):
+        return []
+    return sorted(g for g in os.listdir(generations_path) if not g.endswith(STAGING_SUFFIX))
+
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:  # alive, only owned by someone else
+        return True
+    return True
+
+
+def _stale_staging(name):
+    # staging dirs are named <generation>.<pid>.staging; a build only owns
+    # its own, so the ones of concurrent builds are left alone. Builds in one
+    # process (serve --watch) run one after another, so its own are stale.
+    generation, _, pid = name[:-len(STAGING_SUFFIX)].rpartition('.')
+    if not generation or not pid.isdigit():  # made before staging dirs had a pid
+        return True
+    return int(pid) == os.getpid() or not _pid_alive(int(pid))
+
+
+def _current_generation(publish_path):
+    # the published tree: a symlink into the generations, or a plain directory
+    # left by a build made before generations existed
+    if os.path.islink(publish_path) or os.path.isdir(publish_path):
+        return os.path.realpath(publish_path) if os.path.isdir(publish_path) else None
+    return None
+
+
+def _flip_symlink(publish_path, generation_path):
+    # rename is atomic, so readers of publish_path see the old tree or the new
+    # one and never a missing or partial one
+    link_tmp = '{}.{}.tmp'.format(publish_path, os.getpid())
+    if os.path.lexists(link_tmp):
+        os.remove(link_tmp)
+    os.symlink(os.path.relpath(generation_path, os.path.dirname(os.path.abspath(publish_path))), link_tmp)
+    os.replace(link_tmp, publish_path)
+
+
+def _search_tokens(text):
+    for token in SEARCH_TERM.findall(text.lower()):
+        # long runs are hashes and encoded data nobody searches for
+        if SEARCH_TERM_LENGTH[0] <= len(token) <= SEARCH_TERM_LENGTH[1]:
+            yield token
+
+
+def _search_terms(ipynb_path, meta):
+    # term frequencies of the markdown and code cells, title and category weigh more
+    with open(ipynb_path, 'r') as nb_file:
+        nb = json.load(nb_file)
+    cells = nb.get('cells')
+    if cells is None:  # nbformat 3 keeps cells in worksheets
+        cells = [c for ws in nb.get('worksheets', []) for c in ws.get('cells', [])]
+    terms = {}
+    for cell in cells:
+        if cell.get('cell_type') in ('markdown', 'heading', 'code'):
+            text = cell.get('source', cell.get('input', ''))
+            for token in _search_tokens(''.join(text) if isinstance(text, list) else text):
+                terms[token] = terms.get(token, 0) + 1
+    for field in ('title', 'category'):
+        for token in _search_tokens(meta.get(field) or ''):
+            terms[token] = terms.get(token, 0) + SEARCH_TITLE_WEIGHT
+    return terms
+
+
+def _shard_spec(value):
+    # i/N, counted from 1 the way CI matrices usually number their jobs
+    try:
+        index, count = (int(v) for v in value.split('/'))
+    except ValueError:
+        raise argparse.ArgumentTypeError('expected i/N, got {!r}'.format(value))
+    if not 1 <= index <= count:
+        raise argparse.ArgumentTypeError('shard {} is not in 1..{}'.format(index, count))
+    return index, count
+
+
+def _assign_shards(sources, costs, count):
+    # Every shard runs this on the same posts and the same previous manifest,
+    # so they all agree on the split without talking to each other. Posts
+    # with a recorded conversion time are balanced longest first onto the
+    # least loaded shard, new posts go by a stable hash of their directory.
+    shards = [[] for _ in range(count)]
+    loads = [0.0] * count
+    default_cost = sum(costs.values()) / len(costs) if costs else 1.0
+    known = []
+    for source in sorted(sources):
+        if source in costs:
+            known.append(source)
+            continue
+        name = os.path.basename(os.path.normpath(source))
+        shard = int(_hash_bytes(name.encode('utf-8')), 16) % count
+        shards[shard].append(source)
+        loads[shard] += default_cost
+    for source in sorted(known, key=lambda s: (-costs[s], s)):
+        shard = min(range(count), key=lambda n: (loads[n], n))
+        shards[shard].append(source)
+        loads[shard] += costs[source]
+    return shards
+
+
+def _link_replace(src, dst):
+    if os.path.exists(dst) and os.path.samefile(src, dst):
+        return
+    tmp_path = '{}.{}.tmp'.format(dst, os.getpid())
+    _link_or_copy(src, tmp_path)
+    os.replace(tmp_path, dst)
+    # renaming onto another link of the same inode does nothing, which happens
+    # when a parallel worker linked the same file in between
+    if os.path.lexists(tmp_path):
+        os.remove(tmp_path)
+
+
+_worker = None
+
+
+def _init_worker(state):
+    global _worker
+    _worker = Generate()
+    _worker.__dict__.update(state)
+
+
+def _run_worker(job):
+    return _worker._timed_conversion(job)
+
+
+class Converter():
+    backend = None
+
+    def version(self):
+        raise NotImplementedError
+
+    def convert(self, post_path, out_file):
+        raise NotImplementedError
+
+
+class InProcessConverter(Converter):
+    backend = 'inprocess'
+
+    def __init__(self):
+        self.exporter = None
+        self._version = None
+
+    def version(self):
+        # read from package metadata, so cache hits never import nbconvert
+        if self._version is None:
+            import importlib.metadata
+            try:
+                nbconvert_version = importlib.metadata.version('nbconvert')
+            except importlib.metadata.PackageNotFoundError:
+                nbconvert_version = importlib.metadata.version('ipython')
+            self._version = '{}-{}'.format(self.backend, nbconvert_version)
+        return self._version
+
+    def convert(self, post_path, out_file):
+        if self.exporter is None:
+            # importing nbconvert and building the exporter is the expensive part,
+            # so it happens once per process and the exporter is reused afterwards
+            try:
+                from nbconvert import HTMLExporter
+            except ImportError:
+                from IPython.nbconvert.exporters import HTMLExporter
+            self.exporter = HTMLExporter()
+        body, _ = self.exporter.from_filename(post_path)
+        with open(out_file, 'w') as out:
+            out.write(body)
+
+
+class SubprocessConverter(Converter):
+    backend = 'subprocess'
+
+    def __init__(self):
+        self._version = None
+
+    def version(self):
+        if self._version is None:
+            from subprocess import check_output
+            ipython_version = check_output(['ipython', '--version']).decode('utf-8').strip()
+            self._version = '{}-{}'.format(self.backend, ipython_version)
+        return self._version
+
+    def convert(self, post_path, out_file):
+        from subprocess import check_call
+        out_dir = os.path.dirname(out_file)
+        check_call(['ipython', 'nbconvert', '--to', 'html', os.path.abspath(post_path)], cwd=out_dir)
+        # nbconvert names its output after the notebook
+        produced = os.path.splitext(os.path.basename(post_path))[0] + '.html'
+        os.rename(os.path.join(out_dir, produced), out_file)
+
+
+CONVERTERS = {c.backend: c for c in (InProcessConverter, SubprocessConverter)}
+
+
+class ConversionCache():
+    def __init__(self, path, max_size):
+        self.path = os.path.join(path, 'conversions')
+        self.max_size = max_size
+
+    def key(self, post_path, version):
+        return _hash_bytes(version.encode('utf-8'), _hash_file(post_path).encode('utf-8'))
+
+    def _entry(self, key):
+        return os.path.join(self.path, key[:2], key + '.html')
+
+    def fetch(self, key, out_file):
+        # builds sharing the cache prune it while others read; once open, an
+        # entry can be removed without harm
+        entry = self._entry(key)
+        try:
+            src = open(entry, 'rb')
+        except FileNotFoundError:
+            return False
+        with src, open(out_file, 'wb') as dst:
+            shutil.copyfileobj(src, dst)
+        try:
+            os.utime(entry)  # mtime is the recency mark used for LRU eviction
+        except FileNotFoundError:
+            pass
+        return True
+
+    def store(self, key, out_file):
+        entry = self._entry(key)
+        os.makedirs(os.path.dirname(entry), exist_ok=True)
+        # copy under a private name first, so parallel builds never see a partial entry
+        tmp_entry = '{}.{}.tmp'.format(entry, os.getpid())
+        shutil.copyfile(out_file, tmp_entry)
+        os.replace(tmp_entry, entry)
+
+    def prune(self, max_size=None):
+        if max_size is None:
+            max_size = self.max_size
+        entries = []
+        if os.path.exists(self.path):
+            for shard in os.listdir(self.path):
+                shard_path = os.path.join(self.path, shard)
+                for entry in os.scandir(shard_path):
+                    if entry.name.endswith('.tmp'):  # still being stored
+                        continue
+                    try:
+                        st = entry.stat()
+                    except FileNotFoundError:  # pruned by another build
+                        continue
+                    entries.append((st.st_mtime, st.st_size, entry.path))
+
+        total = sum(e[1] for e in entries)
+        removed = 0
+        for _, size, path in sorted(entries):
+            if total <= max_size:
+                break
+            try:
+                os.remove(path)
+                removed += 1
+            except FileNotFoundError:
+                pass
+            total -= size
+        return removed, total
+
+
+def _format_tag(tag, attrs):
+    import html
+    return '<{}{}>'.format(tag, ''.join(' {}="{}"'.format(k, html.escape(v)) if v is not None else ' ' + k
+                                        for k, v in attrs))
+
+
+class OutputWriter():
+    # Every file of a build is written through here. Content equal to the file
+    # already in place, or to the same file of the published generation (which
+    # is then hardlinked in), is not written again, so unchanged files keep
+    # their mtime and rsync, CDN purges and syncs only see real changes.
+    # files is the "files" map of the published manifest, its hashes spare
+    # reading files whose mtime and size did not change.
+    def __init__(self, out_path, base_path=None, files=None):
+        self.out_path = out_path
+        self.base_path = base_path
+        self.files = files or {}
+        self.counts = {'written': 0, 'skipped': 0, 'deleted': 0}
+
+    def _matches(self, path, rel_path, digest, size):
+        try:
+            st = os.stat(path)
+        except OSError:
+            return False
+        if st.st_size != size:
+            return False
+        prev = self.files.get(rel_path)
+        if prev is not None and prev[0] == st.st_mtime_ns and prev[1] == size:
+            return prev[2] == digest
+        return _hash_file(path) == digest
+
+    def _unchanged(self, path, digest, size):
+        rel_path = os.path.relpath(path, self.out_path)
+        if self._matches(path, rel_path, digest, size):
+            return True
+        if self.base_path is not None:
+            base = os.path.join(self.base_path, rel_path)
+            if os.path.abspath(base) != os.path.abspath(path) and self._matches(base, rel_path, digest, size):
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                _link_replace(base, path)
+                return True
+        return False
+
+    def _count(self, written):
+        self.counts['written' if written else 'skipped'] += 1
+        return written
+
+    def write(self, path, data):
+        if isinstance(data, str):
+            data = data.encode('utf-8')
+        if self._unchanged(path, _hash_bytes(data), len(data)):
+            return self._count(False)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # replaced, not rewritten: the file may be a hardlink into another
+        # generation, and conversion workers may write the same asset at once
+        tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+        with open(tmp_path, 'wb') as out:
+            out.write(data)
+        os.replace(tmp_path, path)
+        return self._count(True)
+
+    def commit(self, tmp_path, path):
+        # for outputs streamed into tmp_path: moved over path only if they differ
+        if self._unchanged(path, _hash_file(tmp_path), os.path.getsize(tmp_path)):
+            os.remove(tmp_path)
+            return self._count(False)
+        os.replace(tmp_path, path)
+        return self._count(True)
+
+    def link(self, src, path):
+        if self._unchanged(path, _hash_file(src), os.path.getsize(src)):
+            return self._count(False)
+        _link_replace(src, path)
+        return self._count(True)
+
+    def skip(self, count=1):
+        # for files left alone on their manifest key, without being looked at
+        self.counts['skipped'] += count
+
+    def remove(self, path):
+        if os.path.exists(path):
+            os.remove(path)
+            self.counts['deleted'] += 1
+
+    def add(self, counts):
+        for key, count in counts.items():
+            self.counts[key] += count
+
+
+class AssetStore():
+    # Content-addressed files under <output>/assets: an image embedded in many
+    # posts is written once, and its url changes whenever its bytes do
+    def __init__(self, out_path, writer=None):
+        self.path = os.path.join(out_path, ASSETS_DIR)
+        self.writer = writer or OutputWriter(out_path)
+
+    def add(self, data, ext):
+        name = _hash_bytes(data) + ext
+        path = os.path.join(self.path, name)
+        if not os.path.exists(path):
+            self.writer.write(path, data)
+        return '/'.join((ASSETS_DIR, name))
+
+
+class PageDecorator():
+    # Copies a converted page to out as it is parsed, injecting the menu right
+    # after <body> and the comments at the end of #notebook-container (or of
+    # <body> when a template has no such container). No tree is ever built.
+    # With an asset store, base64 images are moved out into asset files and
+    # the inline css and js nbconvert puts in <head> into shared ones; only
+    # <head> is held in memory, to put the stylesheet link where styles began.
+    HANDLERS = ('handle_starttag', 'handle_startendtag', 'handle_endtag', 'handle_data', 'handle_entityref',
+                'handle_charref', 'handle_comment', 'handle_decl', 'handle_pi', 'unknown_decl')
+
+    def __init__(self, out, menu, comments=None, script=None, assets=None, images=True, boilerplate=True):
+        # owns its parser rather than subclassing it, so html.parser is only
+        # imported by commands that decorate pages
+        from html.parser import HTMLParser
+        self.parser = HTMLParser(convert_charrefs=False)
+        for name in self.HANDLERS:
+            setattr(self.parser, name, getattr(self, name))
+        self.out = out
+        self.menu = menu
+        self.comments = comments
+        self.script = script
+        self.assets = assets
+        self.images = images
+        self.boilerplate = boilerplate and assets is not None
+        self.extracted = []
+        self.container_depth = 0
+        self.page_out = None
+        self.styles = []
+        self.inline = None
+
+    def _extract_image(self, attrs):
+        src = dict(attrs).get('src') or ''
+        if self.assets is None or not self.images or not src.startswith('data:'):
+            return None
+        header, _, payload = src[len('data:'):].partition(',')
+        mime, _, encoding = header.partition(';')
+        if encoding != 'base64' or mime not in IMAGE_EXTS:
+            return None
+        import base64
+        import binascii
+        try:
+            data = base64.b64decode(payload)
+        except (binascii.Error, ValueError):
+            return None
+        rel_path = self._add_asset(data, IMAGE_EXTS[mime])
+        attrs = [(k, '/' + rel_path if k == 'src' else v) for k, v in attrs]
+        if 'loading' not in dict(attrs):
+            attrs.append(('loading', 'lazy'))
+        return _format_tag('img', attrs)
+
+    def _add_asset(self, data, ext):
+        rel_path = self.assets.add(data, ext)
+        self.extracted.append(rel_path)
+        return rel_path
+
+    def _is_boilerplate(self, tag, attrs):
+        attrs = dict(attrs)
+        if self.page_out is None:
+            return False
+        if tag == 'style':
+            return attrs.get('type', 'text/css') == 'text/css' and 'media' not in attrs
+        # mathjax only reads its config from inline scripts
+        return tag == 'script' and 'src' not in attrs and attrs.get('type', 'text/javascript') in BOILERPLATE_SCRIPTS
+
+    def _write_inline(self, tag, attrs, text):
+        if tag == 'style':
+            if not self.styles:
+                self.out.write(STYLES_MARK)
+            self.styles.append(text)
+            return
+        rel_path = self._add_asset(text.encode('utf-8'), '.js')
+        attrs = [(k, v) for k, v in attrs if k != 'type' or v == 'module'] + [('src', '/' + rel_path)]
+        self.out.write(_format_tag('script', attrs) + '</script>')
+
+    def _write_head(self):
+        head = self.out.getvalue()
+        self.out = self.page_out
+        self.page_out = None
+        if self.styles:
+            rel_path = self._add_asset('\n'.join(self.styles).encode('utf-8'), '.css')
+            head = head.replace(STYLES_MARK, '<link rel="stylesheet" href="/{}">'.format(rel_path), 1)
+        self.out.write(head)
+
+    def _write_comments(self):
+        if self.comments is not None:
+            self.out.write(self.comments)
+            self.comments = None
+
+    def handle_starttag(self, tag, attrs):
+        if self.inline is None and self._is_boilerplate(tag, attrs):
+            self.inline = (tag, attrs, [])
+            return
+        if tag == 'body' and self.page_out is not None:
+            self._write_head()
+        self.out.write((tag == 'img' and self._extract_image(attrs)) or self.parser.get_starttag_text())
+        if tag == 'head' and self.boilerplate:
+            self.page_out = self.out
+            self.out = io.StringIO()
+        elif tag == 'body' and self.menu is not None:
+            self.out.write(self.menu)
+            self.menu = None
+        elif tag == 'div':
+            if self.container_depth:
+                self.container_depth += 1
+            elif ('id', 'notebook-container') in attrs:
+                self.container_depth = 1
+
+    def handle_startendtag(self, tag, attrs):
+        self.out.write((tag == 'img' and self._extract_image(attrs)) or self.parser.get_starttag_text())
+
+    def handle_endtag(self, tag):
+        if self.inline is not None and tag == self.inline[0]:
+            self._write_inline(*self.inline[:2], ''.join(self.inline[2]))
+            self.inline = None
+            return
+        if tag == 'div' and self.container_depth:
+            self.container_depth -= 1
+            if not self.container_depth:
+                self._write_comments()
+        elif tag == 'body':
+            self._write_comments()
+            if self.script is not None:
+                self.out.write(self.script)
+                self.script = None
+        self.out.write('</{}>'.format(tag))
+        if tag == 'head' and self.page_out is not None:
+            self._write_head()
+
+    def handle_data(self, data):
+        if self.inline is not None:
+            self.inline[2].append(data)
+        else:
+            self.out.write(data)
+
+    def handle_entityref(self, name):
+        self.out.write('&{};'.format(name))
+
+    def handle_charref(self, name):
+        self.out.write('&#{};'.format(name))
+
+    def handle_comment(self, data):
+        self.out.write('<!--{}-->'.format(data))
+
+    def handle_decl(self, decl):
+        self.out.write('<!{}>'.format(decl))
+
+    def handle_pi(self, data):
+        self.out.write('<?{}>'.format(data))
+
+    def unknown_decl(self, data):
+        self.out.write('<![{}]>'.format(data))
+
+    def feed(self, data):
+        self.parser.feed(data)
+
+    def close(self):
+        self.parser.close()
+        if self.page_out is not None:
+            self._write_head()
+
+
+@functools.lru_cache(maxsize=None)
+def _server_classes():
+    # the handler and server are mixed into their http.server bases on first
+    # use, so only serve pays for importing http.server, socketserver and email
+    import http.server
+    handler = type('BlgrRequestHandler', (BlgrRequestHandler, http.server.SimpleHTTPRequestHandler), {})
+    server = type('PooledHTTPServer', (PooledHTTPServer, http.server.HTTPServer), {})
+    return handler, server
+
+
+class BlgrRequestHandler():
+    # HTTP/1.1 keeps connections open between requests; the socket timeout
+    # both drops idle keep-alive connections and bounds slow requests
+    protocol_version = 'HTTP/1.1'
+    # headers and body go out in separate writes; with Nagle on, the body
+    # waits for the client's delayed ACK of the headers on every response
+    disable_nagle_algorithm = True
+
+    def setup(self):
+        self.timeout = self.server.request_timeout
+        super().setup()
+
+    def handle(self):
+        # one request per pick up: a connection kept alive goes back to the
+        # server to wait for the next one, unless that was already sent
+        self.close_connection = True
+        self.handle_one_request()
+        while not self.close_connection:
+            if not self._pending():
+                self.server.keep(self.connection)
+                return
+            self.handle_one_request()
+
+    def _pending(self):
+        # a pipelined request already read off the socket never makes it readable again
+        self.connection.settimeout(0)
+        try:
+            return bool(self.rfile.peek(1))
+        except OSError:
+            return False
+        finally:
+            self.connection.settimeout(self.timeout)
+
+    def do_GET(self):
+        if self.server.reload_hub is not None and self.path.split('?', 1)[0] == RELOAD_PATH:
+            self._subscribe()
+        else:
+            super().do_GET()
+
+    def _subscribe(self):
+        import urllib.parse
+        query = urllib.parse.parse_qs(urllib.parse.urlsplit(self.path).query)
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream')
+        self.send_header('Cache-Control', 'no-cache')
+        self.send_header('Connection', 'close')
+        self.end_headers()
+        self.wfile.flush()
+        # the socket now belongs to the hub, this worker thread is free again
+        self.close_connection = True
+        self.server.detach(self.connection)
+        self.server.reload_hub.add(self.connection, query.get('path', ['/'])[0])
+
+    def _negotiate(self, path):
+        # pick a precompressed sibling written by generate --compress, if the client takes it
+        accepted = _accepted_encodings(self.headers.get('Accept-Encoding', ''))
+        for encoding in ('br', 'gzip'):
+            compressed_path = path + COMPRESSED_EXTS[encoding]
+            # a sibling is only up to date while it carries the mtime of its source
+            if encoding in accepted and os.path.isfile(compressed_path) and \
+                    os.stat(compressed_path).st_mtime_ns == os.stat(path).st_mtime_ns:
+                return encoding, compressed_path
+        return None, path
+
+    def send_head(self):
+        path = self.translate_path(self.path)
+        name = os.path.basename(path)
+        if name in (MANIFEST_NAME, FRAGMENT_NAME) or name.endswith('.tmp'):
+            # build bookkeeping and half-written files are not part of the site
+            self.send_error(404, 'File not found')
+            return None
+        if os.path.isdir(path):
+            index = os.path.join(path, 'index.html')
+            if not self.path.split('?', 1)[0].split('#', 1)[0].endswith('/') or not os.path.isfile(index):
+                return super().send_head()  # redirect to the trailing slash or a listing
+            path = index
+        if not os.path.isfile(path):
+            return super().send_head()
+
+        encoding, body_path = self._negotiate(path)
+        try:
+            f = open(body_path, 'rb')
+        except OSError:
+            self.send_error(404, 'File not found')
+            return None
+        try:
+            st = os.fstat(f.fileno())
+            mtime = os.stat(path).st_mtime
+            etag = self._etag(body_path, st)
+            if self._not_modified(etag, mtime):
+                f.close()
+                self.send_response(304)
+                self._send_cache_headers(path, etag, mtime)
+                self.end_headers()
+                return None
+
+            self.send_response(200)
+            self.send_header('Content-type', self.guess_type(path))
+            if encoding is not None:
+                self.send_header('Content-Encoding', encoding)
+            self.send_header('Content-Length', str(st.st_size))
+            self._send_cache_headers(path, etag, mtime)
+            self.end_headers()
+            return f
+        except:
+            f.close()
+            raise
+
+    def _etag(self, body_path, st):
+        if self.server.build_index is None:
+            return None
+        rel_path = os.path.relpath(body_path, self.directory)
+        entry = self.server.build_index.get(rel_path)
+        # the recorded hash only holds while the file is the one generate hashed
+        if entry is None or entry[0] != st.st_mtime_ns or entry[1] != st.st_size:
+            return None
+        return '"{}"'.format(entry[2])
+
+    def _not_modified(self, etag, mtime):
+        if 'If-None-Match' in self.headers:
+            if etag is None:
+                return False
+            tags = [t.strip() for t in self.headers['If-None-Match'].split(',')]
+            # If-None-Match uses weak comparison
+            return '*' in tags or etag in (t[2:] if t.startswith('W/') else t for t in tags)
+        if 'If-Modified-Since' in self.headers:
+            import email.utils
+            try:
+                since = email.utils.parsedate_to_datetime(self.headers['If-Modified-Since'])
+            except (TypeError, ValueError, IndexError, OverflowError):
+                return False
+            if since is None:
+                return False
+            if since.tzinfo is None:
+                since = since.replace(tzinfo=datetime.timezone.utc)
+            return int(mtime) <= since.timestamp()
+        return False
+
+    def _send_cache_headers(self, path, etag, mtime):
+        if os.path.splitext(path)[1] in COMPRESSIBLE_EXTS:
+            self.send_header('Vary', 'Accept-Encoding')
+        if etag is not None:
+            self.send_header('ETag', etag)
+        self.send_header('Last-Modified', self.date_time_string(mtime))
+        import fnmatch
+        rel_path = os.path.relpath(path, self.directory).replace(os.sep, '/')
+        for pattern, cache_control in self.server.cache_control:
+            if fnmatch.fnmatch(rel_path, pattern):
+                self.send_header('Cache-Control', cache_control)
+                break
+
+
+class BuildIndex():
+    # File hashes recorded by generate in the build manifest, reloaded
+    # whenever a new build replaces the manifest
+    def __init__(self, out_path):
+        self.manifest_path = os.path.join(out_path, MANIFEST_NAME)
+        self.lock = threading.Lock()
+        self.mtime = None
+        self.files = {}
+
+    def get(self, rel_path):
+        try:
+            mtime = os.stat(self.manifest_path).st_mtime_ns
+        except OSError:
+            mtime = None
+        if mtime != self.mtime:
+            with self.lock:
+                if mtime != self.mtime:
+                    self._load(mtime)
+        return self.files.get(rel_path)
+
+    def _load(self, mtime):
+        files = {}
+        if mtime is not None:
+            try:
+                with open(self.manifest_path, 'r') as mf:
+                    files = json.load(mf).get('files', {})
+            except (OSError, ValueError):
+                pass
+        self.files = files
+        self.mtime = mtime
+
+
+class PooledHTTPServer():
+    # Connections wait in a selector until a request arrives and only then
+    # take a pool thread, which hands them back once the response is out,
+    # so idle keep-alive connections cost a socket and never a worker.
+    request_queue_size = 128
+
+    def __init__(self, address, handler, workers, max_connections, request_timeout):
+        import socket
+        import selectors
+        from concurrent.futures import ThreadPoolExecutor
+        super().__init__(address, handler)
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        self.connections = threading.BoundedSemaphore(max_connections)
+        self.request_timeout = request_timeout
+        self.build_index = None
+        self.cache_control = []
+        self.reload_hub = None
+        self.detached = set()
+        self.kept = set()
+        self.detached_lock = threading.Lock()
+        self.idle = {}
+        self.idle_lock = threading.Lock()
+        self.idle_selector = selectors.DefaultSelector()
+        # wakes the selector when a connection is parked from another thread
+        self.wakeup, self.wakeup_send = socket.socketpair()
+        self.wakeup.setblocking(False)
+        self.wakeup_send.setblocking(False)
+        self.idle_selector.register(self.wakeup, selectors.EVENT_READ)
+        self.closed = False
+        self.idle_thread = threading.Thread(target=self._dispatch_idle)
+        self.idle_thread.daemon = True
+        self.idle_thread.start()
+
+    def detach(self, request):
+        with self.detached_lock:
+            self.detached.add(request)
+
+    def keep(self, request):
+        with self.detached_lock:
+            self.kept.add(request)
+
+    def _park(self, request, client_address):
+        import selectors
+        with self.idle_lock:
+            if self.closed:
+                self.shutdown_request(request)
+                return
+            self.idle[request] = (client_address, time.monotonic() + self.request_timeout)
+            self.idle_selector.register(request, selectors.EVENT_READ)
+        try:
+            self.wakeup_send.send(b'\0')
+        except OSError:  # full, the selector wakes up anyway
+            pass
+
+    def _dispatch_idle(self):
+        while not self.closed:
+            ready = self.idle_selector.select(timeout=min(0.5, self.request_timeout))
+            now = time.monotonic()
+            with self.idle_lock:
+                if self.closed:
+                    return
+                requests = []
+                for key, _ in ready:
+                    if key.fileobj is self.wakeup:
+                        try:
+                            while self.wakeup.recv(4096):
+                                pass
+                        except OSError:
+                            pass
+                    elif key.fileobj in self.idle:
+                        requests.append((key.fileobj, self.idle.pop(key.fileobj)[0]))
+                        self.idle_selector.unregister(key.fileobj)
+                # the idle timeout, for connections that never send a request
+                expired = [r for r, (_, deadline) in self.idle.items() if deadline <= now]
+                for request in expired:
+                    del self.idle[request]
+                    self.idle_selector.unregister(request)
+            for request, client_address in requests:
+                self.executor.submit(self._process_request, request, client_address)
+            for request in expired:
+                self.shutdown_request(request)
+                self.connections.release()
+
+    def process_request(self, request, client_address):
+        if not self.connections.acquire(blocking=False):
+            try:
+                request.sendall(b'HTTP/1.1 503 Service Unavailable\r\n'
+                                b'Content-Length: 0\r\nConnection: close\r\n\r\n')
+            except OSError:
+                pass
+            self.shutdown_request(request)
+            return
+        self._park(request, client_address)
+
+    def _process_request(self, request, client_address):
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            with self.detached_lock:
+                detached = request in self.detached
+                kept = request in self.kept
+                self.detached.discard(request)
+                self.kept.discard(request)
+            if kept and not self.closed:
+                self._park(request, client_address)
+                return
+            if not detached:
+                self.shutdown_request(request)
+            self.connections.release()
+
+    def server_close(self):
+        super().server_close()
+        with self.idle_lock:
+            self.closed = True
+            idle = list(self.idle)
+            self.idle.clear()
+        self.wakeup_send.close()
+        self.idle_thread.join()
+        self.idle_selector.close()
+        self.wakeup.close()
+        for request in idle:
+            self.shutdown_request(request)
+        self.executor.shutdown(wait=False)
+        if self.reload_hub is not None:
+            self.reload_hub.close()
+
+
+def _url_path(path):
+    path = '/' + path.replace(os.sep, '/').lstrip('/')
+    if path.endswith('/index.html'):
+        path = path[:-len('index.html')]
+    return path
+
+
+class ReloadHub():
+    # Holds the open live reload streams. A single thread watches all of them
+    # for disconnects, so idle tabs cost a socket and never a worker thread.
+    def __init__(self):
+        import selectors
+        self.lock = threading.Lock()
+        self.clients = {}
+        self.selector = selectors.DefaultSelector()
+        self.closed = False
+        self.thread = threading.Thread(target=self._reap)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def add(self, sock, path):
+        import selectors
+        sock.settimeout(1)
+        with self.lock:
+            self.clients[sock] = _url_path(path)
+            self.selector.register(sock, selectors.EVENT_READ)
+
+    def _drop(self, sock):
+        import socket
+        with self.lock:
+            if self.clients.pop(sock, None) is None:
+                return
+            self.selector.unregister(sock)
+        try:
+            sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        sock.close()
+
+    def _reap(self):
+        while not self.closed:
+            if not self.clients:
+                time.sleep(0.5)
+                continue
+            for key, _ in self.selector.select(timeout=0.5):
+                # clients never send anything, readable means gone
+                self._drop(key.fileobj)
+
+    def notify(self, paths):
+        paths = {_url_path(p) for p in paths}
+        with self.lock:
+            targets = [sock for sock, path in self.clients.items() if path in paths]
+        for sock in targets:
+            try:
+                sock.sendall(b'data: reload\n\n')
+            except OSError:
+                self._drop(sock)
+        return len(targets)
+
+    def close(self):
+        self.closed = True
+        for sock in list(self.clients):
+            self._drop(sock)
+
+
+class PollingWatcher():
+    def __init__(self, dirs, files, interval=0.5):
+        self.dirs = dirs
+        self.files = files
+        self.interval = interval
+        self.state = self._snapshot()
+
+    def _snapshot(self):
+        state = {}
+        paths = list(self.files)
+        for d in self.dirs:
+            for dirpath, _, filenames in os.walk(d):
+                paths.extend(os.path.join(dirpath, f) for f in filenames)
+        for path in paths:
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            state[path] = (st.st_mtime_ns, st.st_size)
+        return state
+
+    def wait(self, timeout=None):
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            state = self._snapshot()
+            changed = {p for p in set(state) | set(self.state) if state.get(p) != self.state.get(p)}
+            self.state = state
+            if changed:
+                return changed
+            if deadline is not None and time.monotonic() >= deadline:
+                return set()
+            time.sleep(self.interval if deadline is None else
+                       max(0, min(self.interval, deadline - time.monotonic())))
+
+    def close(self):
+        pass
+
+
+class InotifyWatcher():
+    IN_MODIFY = 0x002
+    IN_ATTRIB = 0x004
+    IN_CLOSE_WRITE = 0x008
+    IN_MOVED_FROM = 0x040
+    IN_MOVED_TO = 0x080
+    IN_CREATE = 0x100
+    IN_DELETE = 0x200
+    IN_ISDIR = 0x40000000
+    MASK = IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+
+    def __init__(self, dirs, files):
+        import ctypes
+        import ctypes.util
+        self.libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        self.fd = self.libc.inotify_init1(os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+        self.wds = {}
+        # single files are watched through their directory, editors often replace them
+        self.files = {os.path.abspath(f) for f in files}
+        for d in dirs:
+            for dirpath, _, _ in os.walk(d):
+                self._add(dirpath, recursive=True)
+        for f in self.files:
+            self._add(os.path.dirname(f), recursive=False)
+
+    def _add(self, path, recursive):
+        import ctypes
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(path), self.MASK)
+        if wd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_add_watch failed for {}'.format(path))
+        prev = self.wds.get(wd)
+        self.wds[wd] = (path, recursive or (prev is not None and prev[1]))
+
+    def wait(self, timeout=None):
+        import select
+        import struct
+        if not select.select([self.fd], [], [], timeout)[0]:
+            return set()
+        buf = os.read(self.fd, 65536)
+        changed = set()
+        offset = 0
+        while offset < len(buf):
+            wd, mask, _, length = struct.unpack_from('iIII', buf, offset)
+            name = buf[offset + 16:offset + 16 + length].rstrip(b'\0')
+            offset += 16 + length
+            if wd not in self.wds:
+                continue
+            dirpath, recursive = self.wds[wd]
+            path = os.path.join(dirpath, os.fsdecode(name))
+            if not recursive and os.path.abspath(path) not in self.files:
+                continue
+            if recursive and mask & self.IN_ISDIR and mask & (self.IN_CREATE | self.IN_MOVED_TO):
+                for sub, _, _ in os.walk(path):
+                    self._add(sub, recursive=True)
+            changed.add(path)
+        return changed
+
+    def close(self):
+        os.close(self.fd)
+
+
+def _make_watcher(dirs, files):
+    try:
+        return InotifyWatcher(dirs, files)
+    except (OSError, AttributeError, TypeError):
+        # no inotify here (not linux, or out of watches) - fall back to polling
+        return PollingWatcher(dirs, files)
+
+
+class MetaIndex():
+    # Parsed meta.json and notebook name of every post, keyed by post dir and
+    # kept with the stat they were read at. A refresh re-reads only the posts
+    # whose directory or meta.json stat changed since. The archive table has
+    # what indexes are built from (normalized date, page or post, category),
+    # so streaming builds can query them instead of holding every post.
+    def __init__(self, path):
+        if path not in (':memory:', ''):  # '' is a private temporary file
+            os.makedirs(os.path.dirname(path) or os.curdir, exist_ok=True)
+        import sqlite3
+        self.db = sqlite3.connect(path)
+        self.search_rows = []
+        self.db.execute('CREATE TABLE IF NOT EXISTS posts (path TEXT PRIMARY KEY, dir_mtime INTEGER, '
+                        'meta_mtime INTEGER, meta_size INTEGER, notebook TEXT, meta TEXT)')
+        self.db.execute('CREATE TABLE IF NOT EXISTS search (path TEXT PRIMARY KEY, hash TEXT, terms TEXT)')
+        if self.db.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'archive'").fetchone() is None:
+            # stores made before the archive existed read every post again to fill it
+            with self.db:
+                self.db.execute('DELETE FROM posts')
+                self.db.execute('CREATE TABLE archive (path TEXT PRIMARY KEY, dt TEXT, page INTEGER, category TEXT)')
+                self.db.execute('CREATE INDEX archive_dt ON archive (page, dt)')
+                self.db.execute('CREATE INDEX archive_category ON archive (category, page, dt)')
+
+    def _update_chunk(self, posts_path, entries):
+        stats = {}
+        for entry in entries:
+            pp = os.path.join(posts_path, entry.name)
+            meta_st = os.stat(os.path.join(pp, 'meta.json'))
+            stats[pp] = (entry.stat().st_mtime_ns, meta_st.st_mtime_ns, meta_st.st_size)
+        self.db.executemany('INSERT OR IGNORE INTO seen VALUES (?)', ((pp,) for pp in stats))
+        known = {row[0]: row[1:] for row in self.db.execute(
+            'SELECT path, dir_mtime, meta_mtime, meta_size FROM posts WHERE path IN ({})'.format(
+                ', '.join('?' * len(stats))), list(stats))}
+
+        updates = []
+        archive = []
+        for pp, stat in stats.items():
+            if known.get(pp) == stat:
+                continue
+            with open(os.path.join(pp, 'meta.json'), 'r') as meta_file:
+                meta_text = meta_file.read()
+            meta = json.loads(meta_text)
+            ipynbs = sorted(f for f in os.listdir(pp) if f.endswith('.ipynb'))
+            page = bool(meta.get('set_link'))
+            dt = _parse_dt(meta['dt']).isoformat(timespec='microseconds') if meta.get('dt') and not page else None
+            updates.append((pp,) + stat + (ipynbs[0] if ipynbs else None, meta_text))
+            archive.append((pp, dt, int(page), meta.get('category') or 'uncategorized'))
+        with self.db:
+            self.db.executemany('INSERT OR REPLACE INTO posts VALUES (?, ?, ?, ?, ?, ?)', updates)
+            self.db.executemany('INSERT OR REPLACE INTO archive VALUES (?, ?, ?, ?)', archive)
+
+    def update(self, posts_path):
+        # brings the store up to date with posts_path a chunk of posts at a
+        # time, so memory does not grow with the number of posts
+        self.db.execute('CREATE TEMP TABLE IF NOT EXISTS seen (path TEXT PRIMARY KEY)')
+        self.db.execute('DELETE FROM seen')
+        chunk = []
+        with os.scandir(posts_path) as entries:
+            for entry in entries:
+                if entry.is_dir():
+                    chunk.append(entry)
+                if len(chunk) >= STREAM_BATCH:
+                    self._update_chunk(posts_path, chunk)
+                    chunk = []
+        self._update_chunk(posts_path, chunk)
+        with self.db:
+            for table in ('posts', 'search', 'archive'):
+                self.db.execute('DELETE FROM {} WHERE path NOT IN (SELECT path FROM seen)'.format(table))
+
+    def refresh(self, posts_path):
+        self.update(posts_path)
+        posts = {}
+        notebooks = {}
+        # in path order, the way the archive lists pages: a re-read post gets a
+        # new rowid, and must not move the pages around in the menu
+        for pp, notebook, meta_text in self.db.execute('SELECT path, notebook, meta FROM posts ORDER BY path'):
+            posts[pp] = json.loads(meta_text)
+            notebooks[pp] = notebook
+        return posts, notebooks
+
+    def view(self, column):
+        return MetaView(self.db, column)
+
+    def archive_entries(self):
+        # (date, post dir) of every post, oldest first
+        for dt, pp in self.db.execute('SELECT dt, path FROM archive WHERE page = 0 ORDER BY dt, path'):
+            yield datetime.datetime.fromisoformat(dt), pp
 
-import jinja2
-from bs4 import BeautifulSoup
+    def archive_undated(self):
+        return [row[0] for row in self.db.execute('SELECT path FROM archive WHERE page = 0 AND dt IS NULL')]
+
+    def archive_pages(self):
+        return [row[0] for row in self.db.execute('SELECT path FROM archive WHERE page = 1 ORDER BY path')]
+
+    def archive_periods(self):
+        # every year, each followed by its months, each followed by its days
+        year = month = None
+        for (day,) in self.db.execute('SELECT DISTINCT substr(dt, 1, 10) FROM archive '
+                                      'WHERE page = 0 ORDER BY 1').fetchall():
+            y, m, d = (int(part) for part in day.split('-'))
+            if y != year:
+                year, month = y, None
+                yield (y,)
+            if m != month:
+                month = m
+                yield (y, m)
+            yield (y, m, d)
+
+    def archive_categories(self):
+        return [row[0] for row in self.db.execute('SELECT DISTINCT category FROM archive '
+                                                  'WHERE page = 0 ORDER BY category')]
+
+    def archive_posts(self, start=None, end=None, category=None):
+        where = ['a.page = 0']
+        args = []
+        if start is not None:
+            where.append('a.dt >= ?')
+            args.append(start.isoformat(timespec='microseconds'))
+        if end is not None:
+            where.append('a.dt < ?')
+            args.append(end.isoformat(timespec='microseconds'))
+        if category is not None:
+            where.append('a.category = ?')
+            args.append(category)
+        return ArchiveQuery(self.db, ' AND '.join(where), args)
+
+    def search_terms(self, path, source_hash):
+        # terms extracted from a post, as long as its inputs did not change since
+        row = self.db.execute('SELECT terms FROM search WHERE path = ? AND hash = ?', (path, source_hash)).fetchone()
+        return json.loads(row[0]) if row is not None else None
+
+    def store_search_terms(self, path, source_hash, terms):
+        # buffered, so a build commits once per batch of posts instead of once per post
+        self.search_rows.append((path, source_hash, json.dumps(terms)))
+        if len(self.search_rows) >= STREAM_BATCH:
+            self.flush_search_terms()
+
+    def flush_search_terms(self):
+        if self.search_rows:
+            with self.db:
+                self.db.executemany('INSERT OR REPLACE INTO search VALUES (?, ?, ?)', self.search_rows)
+            self.search_rows = []
+
+    def close(self):
+        self.flush_search_terms()
+        self.db.close()
+
+
+class MetaView():
+    # read only mapping over one column of the posts table, for code that
+    # looks posts up one at a time and needs no dict of all of them
+    def __init__(self, db, column):
+        self.db = db
+        self.column = column
+
+    def get(self, path, default=None):
+        row = self.db.execute('SELECT {} FROM posts WHERE path = ?'.format(self.column), (path,)).fetchone()
+        if row is None:
+            return default
+        return json.loads(row[0]) if self.column == 'meta' else row[0]
+
+    def __getitem__(self, path):
+        missing = object()
+        value = self.get(path, missing)
+        if value is missing:
+            raise KeyError(path)
+        return value
+
+    def __contains__(self, path):
+        return self.db.execute('SELECT 1 FROM posts WHERE path = ?', (path,)).fetchone() is not None
+
+    def __iter__(self):
+        return (row[0] for row in self.db.execute('SELECT path FROM posts ORDER BY path'))
+
+    def __len__(self):
+        return self.db.execute('SELECT COUNT(*) FROM posts').fetchone()[0]
+
+
+class ArchiveQuery():
+    # The posts of one index, counted and streamed newest first from the
+    # metadata store instead of collected into a list; _render_index takes
+    # them a page at a time.
+    def __init__(self, db, where, args):
+        self.db = db
+        self.where = where
+        self.args = args
+
+    def __len__(self):
+        return self.db.execute('SELECT COUNT(*) FROM archive a WHERE ' + self.where, self.args).fetchone()[0]
+
+    def __iter__(self):
+        rows = self.db.execute('SELECT a.dt, p.meta FROM archive a JOIN posts p ON p.path = a.path '
+                               'WHERE {} ORDER BY a.dt DESC, a.path DESC'.format(self.where), self.args)
+        for dt, meta_text in rows:
+            dt = datetime.datetime.fromisoformat(dt)
+            yield _post_dict(json.loads(meta_text), dt.year, dt.month, dt.day)
+
+
+class Spill():
+    # Rows kept in a private temporary sqlite file instead of a list, and read
+    # back sorted by all columns: the on-disk stand-in for a list sorted once
+    # it is filled, for data that grows with the number of posts.
+    def __init__(self, columns):
+        import sqlite3
+        self.db = sqlite3.connect('')
+        self.columns = ', '.join(columns)
+        self.db.execute('CREATE TABLE rows ({})'.format(self.columns))
+        self.insert = 'INSERT INTO rows VALUES ({})'.format(', '.join('?' * len(columns)))
+
+    def append(self, row):
+        self.db.execute(self.insert, row)
+
+    def extend(self, rows):
+        self.db.executemany(self.insert, rows)
+
+    def sorted(self):
+        return self.db.execute('SELECT * FROM rows ORDER BY ' + self.columns)
+
+    def close(self):
+        self.db.close()
+
+
+def _post_dict(meta, year, month, day):
+    pd = {'url': '/{}/{}/{}/{}/'.format(year, month, day, meta['slug'])}
+    pd.update(meta)
+    return pd
+
+
+def _parse_dt(value):
+    # fromisoformat is implemented in C and takes timestamps with or without
+    # microseconds; a timezone is dropped so the post keeps the date it was
+    # written on and all dates compare
+    if value.endswith('Z'):
+        value = value[:-1]
+    return datetime.datetime.fromisoformat(value).replace(tzinfo=None)
+
+
+def _period_start(key):
+    return datetime.datetime(*(tuple(key) + (1, 1))[:3])
+
+
+def _period_end(key):
+    if len(key) == 1:
+        return datetime.datetime(key[0] + 1, 1, 1)
+    if len(key) == 2:
+        return datetime.datetime(key[0] + key[1] // 12, key[1] % 12 + 1, 1)
+    return datetime.datetime(*key) + datetime.timedelta(days=1)
+
+
+class Archive():
+    # Posts sorted by date. Every year, month and day is a contiguous run of
+    # the sorted array, found with two bisects, so no nested dicts or per
+    # level post lists are kept: groups are (key, lo, hi) slices of it.
+    def __init__(self, entries=()):
+        entries = sorted(entries)
+        self.dts = [dt for dt, _ in entries]
+        self.posts = [post for _, post in entries]
+
+    def __len__(self):
+        return len(self.dts)
+
+    def __iter__(self):
+        return zip(self.dts, self.posts)
+
+    def period(self, key):
+        import bisect
+        return bisect.bisect_left(self.dts, _period_start(key)), bisect.bisect_left(self.dts, _period_end(key))
+
+    def groups(self, lo=0, hi=None, level=1):
+        # every year, each followed by its months, each followed by its days;
+        # one bisect per group, so the whole walk is linear in the post count
+        import bisect
+        hi = len(self.dts) if hi is None else hi
+        while lo < hi:
+            dt = self.dts[lo]
+            key = (dt.year, dt.month, dt.day)[:level]
+            end = bisect.bisect_left(self.dts, _period_end(key), lo, hi)
+            yield key, lo, end
+            if level < 3:
+                yield from self.groups(lo, end, level + 1)
+            lo = end
+
+
+def _reset_peak_rss():
+    # linux only: drops the high-water mark of this process (VmHWM) to its
+    # current rss, so _peak_rss reports the peak of what ran since
+    try:
+        with open('/proc/self/clear_refs', 'w') as clear_refs:
+            clear_refs.write('5')
+    except OSError:
+        return False
+    return True
+
+
+def _peak_rss():
+    try:
+        with open('/proc/self/status', 'r') as status:
+            for line in status:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return None
+
+
+def _children_max_rss():
+    # the largest child so far, children cannot be reset from here
+    if resource is None:
+        return None
+    scale = 1 if sys.platform == 'darwin' else 1024
+    return resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * scale
+
+
+class Profiler():
+    def __init__(self):
+        self.phases = []
+        self.conversions = []
+        self.events = [{'name': 'process_name', 'ph': 'M', 'pid': os.getpid(), 'tid': 0,
+                        'args': {'name': 'generate'}}]
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        # peak_rss is the peak of the phase alone where it can be reset, the
+        # process wide high-water mark would only ever report the largest phase
+        reset = _reset_peak_rss()
+        started, wall, cpu = time.time(), time.perf_counter(), time.process_time()
+        try:
+            yield
+        finally:
+            wall = time.perf_counter() - wall
+            self.phases.append({'name': name, 'wall': wall, 'cpu': time.process_time() - cpu,
+                                'peak_rss': _peak_rss() if reset else None,
+                                'max_rss_children': _children_max_rss()})
+            self.events.append({'name': name, 'cat': 'phase', 'ph': 'X', 'pid': os.getpid(), 'tid': 0,
+                                'ts': int(started * 1e6), 'dur': int(wall * 1e6)})
+
+    def record(self, timing):
+        self.conversions.append(timing)
+        self.events.append({'name': timing['source'], 'cat': 'conversion', 'ph': 'X',
+                            'pid': timing['pid'], 'tid': 0,
+                            'ts': int(timing['start'] * 1e6), 'dur': int(timing['wall'] * 1e6),
+                            'args': {'output': timing['output'], 'size': timing['size'], 'cpu': timing['cpu']}})
+
+    def write(self, report_path, trace_path):
+        with open(report_path, 'w') as report:
+            json.dump({'phases': self.phases, 'conversions': self.conversions}, report, indent=1)
+        with open(trace_path, 'w') as trace:
+            json.dump({'traceEvents': self.events, 'displayTimeUnit': 'ms'}, trace)
+
+    def summary(self, top):
+        lines = ['{:<14}{:>9}{:>9}'.format('phase', 'wall, s', 'cpu, s')]
+        lines.extend('{:<14}{:>9.3f}{:>9.3f}'.format(p['name'], p['wall'], p['cpu']) for p in self.phases)
+        slowest = sorted(self.conversions, key=lambda c: c['wall'], reverse=True)[:top]
+        if slowest:
+            lines.append('slowest notebooks:')
+            lines.extend('{:>9.3f}s {:>9} KB  {}'.format(c['wall'], c['size'] // 1024, c['source'])
+                         for c in slowest)
+        return '\n'.join(lines)
 
 
 class Command(type):
+    # commands are registered as classes, BlgrCli instantiates only the one it runs
     def __init__(cls, *args, **kwargs):
         if not hasattr(cls, 'commands'):
             cls.commands = {}
         else:
-            cls.commands[cls._command] = cls()
+            cls.commands[cls._command] = cls
 
 
 class BlgrCommand(metaclass=Command):
@@ -25,6 +1539,7 @@ class BlgrCommand(metaclass=Command):
         super().__init__()
         self.parser = None
         self.config = None
+        self.cli_args = {}
 
     def add_args(self):
         raise NotImplementedError
@@ -99,50 +1614,488 @@ class Create(BlgrCommand):
 class Generate(BlgrCommand):
     _command = 'generate'
 
+    def __init__(self):
+        super().__init__()
+        self.out_path = os.curdir
+        self.prev_manifest = {}
+        self.manifest = _empty_manifest()
+        self.conversions = []
+        self.converter = None
+        self.cache = None
+        self.reload_script = None
+        self.meta_index = None
+        self.notebooks = {}
+        self.tmpl_env = None
+        self.templates = {}
+        self.profiler = None
+        self.assets = None
+        self.writer = None
+        self.fresh_assets = set()
+        self.publish_path = None
+        self.generation = None
+        self.search_sources = []
+        self.shard_sources = None
+        self.executor = None
+
     def add_args(self):
-        pass
+        self._add_build_args()
+        self.parser.add_argument('--shard', type=_shard_spec, default=None,
+                                 help='convert only shard i of N (i/N) of the posts into '
+                                      '<output.path>.shards/i-of-N, to be combined by merge')
+
+    def _add_build_args(self):
+        self.parser.add_argument('-i', '--incremental', action='store_true', default=False,
+                                 help='rebuild only posts, pages and indexes whose inputs '
+                                      'changed since the last build')
+        self.parser.add_argument('-j', '--jobs', type=int, default=None,
+                                 help='number of notebooks converted in parallel '
+                                      '(defaults to the number of cores)')
+        self.parser.add_argument('-z', '--compress', action='store_true', default=False,
+                                 help='write precompressed .gz/.br siblings of html, css and js files')
+        self.parser.add_argument('--stream', action='store_true', default=False,
+                                 help='read posts from the metadata store in date order and build '
+                                      'indexes and search from it, so memory stays flat however '
+                                      'many posts there are')
+        self.parser.add_argument('--profile', nargs='?', const='profile.json', default=None,
+                                 help='write per phase and per notebook timings to PROFILE '
+                                      '(default profile.json) and a chrome trace next to it')
+        self.parser.add_argument('--profile-top', type=int, default=DEFAULT_PROFILE_TOP,
+                                 help='number of slowest notebooks listed after a profiled build')
 
     def prepare(self):
+        self.profiler = Profiler() if self.cli_args.get('profile') else None
         self.prj_path = os.path.abspath(os.path.dirname(__file__))
-        jinja_loader = jinja2.FileSystemLoader(searchpath=os.path.join(self.prj_path, 'data/templates/'))
-        self.tmpl_env = jinja2.Environment(loader=jinja_loader)
+        with self._phase('templates'):
+            self._prepare_templates()
+        self.reload_script = RELOAD_SCRIPT if self.cli_args.get('preview') else None
+
+        with self._phase('out path'):
+            self._generate_out_path()
+        with self._phase('scan'):
+            self._generate_posts_dict()
+        with self._phase('archive'):
+            self._generate_pages_dts()
+        if self.cli_args.get('shard'):
+            index, count = self.cli_args['shard']
+            costs = {source: src['cost'] for source, src in self.prev_manifest.get('sources', {}).items()
+                     if 'cost' in src}
+            self.shard_sources = set(_assign_shards(self.posts, costs, count)[index - 1])
+
+    def _phase(self, name):
+        if self.profiler is None:
+            return contextlib.nullcontext()
+        return self.profiler.phase(name)
+
+    def _template_dirs(self):
+        # user template dirs come first, so they can override the bundled templates
+        user_dirs = self.config.get('templates', {}).get('paths', [])
+        return list(user_dirs) + [os.path.join(self.prj_path, 'data/templates/')]
 
-        self._generate_out_path()
-        self._generate_posts_dict()
-        self._generate_pages_dts()
+    def _prepare_templates(self):
+        # the environment outlives a single build (serve --watch), and compiled
+        # templates go to an on-disk bytecode cache that jinja checks against
+        # the template source, so neither cold builds nor rebuilds recompile
+        # unchanged templates
+        import jinja2
+        searchpath = self._template_dirs()
+        if self.tmpl_env is None or getattr(self.tmpl_env.loader, 'searchpath', None) != searchpath:
+            bytecode_cache = None
+            if 'cache' in self.config:
+                bytecode_dir = os.path.join(self.config['cache']['path'], 'templates')
+                os.makedirs(bytecode_dir, exist_ok=True)
+                bytecode_cache = jinja2.FileSystemBytecodeCache(bytecode_dir)
+            self.tmpl_env = jinja2.Environment(loader=jinja2.FileSystemLoader(searchpath=searchpath),
+                                               bytecode_cache=bytecode_cache)
+        self.templates = {}
+        for name in TEMPLATES:
+            self._get_template(name)
+
+    def _get_template(self, name):
+        # loaded once per build and shared by every index writer
+        if name not in self.templates:
+            self.templates[name] = self.tmpl_env.get_template(name)
+        return self.templates[name]
 
     def _generate_out_path(self):
-        self.out_path = self.config['output']['path']
-        if os.path.exists(self.out_path):
-            shutil.rmtree(self.out_path)
-        os.makedirs(self.out_path)
+        # builds go to a staging generation next to output.path, which only
+        # switches over to it once the build is complete (see _publish)
+        self.publish_path = os.path.normpath(self.config['output']['path'])
+        if self.cli_args.get('preview'):
+            # kept apart from output.path, which generate and publish use
+            self.publish_path += PREVIEW_SUFFIX
+        generations_path = self.publish_path + GENERATIONS_SUFFIX
+        self.prev_manifest = {}
+        self.manifest = _empty_manifest()
+        self.conversions = []
+        self.search_sources = Spill(('source', 'hash', 'ipynb', 'url')) if self.cli_args.get('stream') else []
+        self.assets = None
+        self.writer = None
+        self.fresh_assets = set()
+        if self.cli_args.get('shard'):
+            # a shard is a plain directory, built from scratch; the published
+            # manifest only tells how long each post took to convert last time
+            self.out_path = os.path.join(self.publish_path + SHARDS_SUFFIX, '{}-of-{}'.format(*self.cli_args['shard']))
+            if os.path.exists(self.out_path):
+                shutil.rmtree(self.out_path)
+            os.makedirs(self.out_path)
+            self.prev_manifest = self._load_manifest(self.publish_path)
+            self.writer = OutputWriter(self.out_path)
+            return
+
+        os.makedirs(generations_path, exist_ok=True)
+        for name in os.listdir(generations_path):
+            if name.endswith(STAGING_SUFFIX) and _stale_staging(name):  # left by a build that died
+                shutil.rmtree(os.path.join(generations_path, name), ignore_errors=True)
+
+        self.generation = datetime.datetime.now().strftime(GENERATION_FORMAT)
+        self.out_path = os.path.join(generations_path, '{}.{}{}'.format(self.generation, os.getpid(), STAGING_SUFFIX))
+        current = _current_generation(self.publish_path)
+        if self.cli_args.get('incremental') and current is not None:
+            # unchanged files are hardlinked, not copied; every writer replaces
+            # files instead of rewriting them, so generations never share a change
+            shutil.copytree(current, self.out_path, symlinks=True, copy_function=_link_or_copy)
+            self.prev_manifest = self._load_manifest()
+        os.makedirs(self.out_path, exist_ok=True)
+        # even a full build leaves the files it would write identically as
+        # they are in the published generation
+        published = self.prev_manifest or (self._load_manifest(current) if current is not None else {})
+        self.writer = OutputWriter(self.out_path, current, published.get('files'))
+
+    def _publish(self):
+        generations_path = os.path.dirname(self.out_path)
+        generation_path = os.path.join(generations_path, self.generation)
+        os.rename(self.out_path, generation_path)
+        self.out_path = generation_path
+        if os.path.isdir(self.publish_path) and not os.path.islink(self.publish_path):
+            # a directory cannot be swapped atomically for a symlink, so the
+            # output of an old style build becomes the previous generation
+            mtime = datetime.datetime.fromtimestamp(os.stat(self.publish_path).st_mtime)
+            os.rename(self.publish_path, os.path.join(generations_path, mtime.strftime(GENERATION_FORMAT)))
+        _flip_symlink(self.publish_path, generation_path)
+
+        keep = max(1, self.config['output'].get('generations', DEFAULT_GENERATIONS))
+        generations = _list_generations(generations_path)
+        for old in generations[:-keep]:
+            if old != self.generation:
+                shutil.rmtree(os.path.join(generations_path, old))
+
+    def _load_manifest(self, out_path=None):
+        manifest_path = os.path.join(out_path or self.out_path, MANIFEST_NAME)
+        if not os.path.exists(manifest_path):
+            return {}
+        try:
+            with open(manifest_path, 'r') as mf:
+                manifest = json.load(mf)
+        except ValueError:
+            return {}
+        if manifest.get('version') != MANIFEST_VERSION:
+            return {}
+        return manifest
+
+    def _save_manifest(self):
+        # serve reloads the manifest while running, so it must never see a partial one
+        manifest_path = os.path.join(self.out_path, MANIFEST_NAME)
+        with open(manifest_path + '.tmp', 'w') as mf:
+            json.dump(self.manifest, mf, sort_keys=True, indent=1)
+        os.replace(manifest_path + '.tmp', manifest_path)
+
+    def _generate_file_hashes(self):
+        # hashed once per build so serve can answer with strong ETags without reading files
+        prev_files = self.prev_manifest.get('files', {})
+        files = {}
+        for dirpath, _, filenames in os.walk(self.out_path):
+            for filename in filenames:
+                path = os.path.join(dirpath, filename)
+                rel_path = self._out_rel(path)
+                if rel_path == MANIFEST_NAME or filename.endswith('.tmp'):
+                    continue
+                st = os.stat(path)
+                prev = prev_files.get(rel_path)
+                if prev is not None and prev[0] == st.st_mtime_ns and prev[1] == st.st_size:
+                    files[rel_path] = prev
+                else:
+                    files[rel_path] = [st.st_mtime_ns, st.st_size, _hash_file(path)]
+        self.manifest['files'] = files
+
+    def _generate_global_hash(self):
+        # everything that ends up in every page: config, templates, menu, comments
+        # and the live reload script of preview builds
+        tmpls = []
+        for tmpl_dir in self._template_dirs():
+            if os.path.isdir(tmpl_dir):
+                tmpls.extend(sorted(os.path.join(tmpl_dir, t) for t in os.listdir(tmpl_dir)
+                                    if os.path.isfile(os.path.join(tmpl_dir, t))))
+        self.manifest['global'] = _hash_bytes(_hash_json(self.config).encode('utf-8'),
+                                              _hash_file(*tmpls).encode('utf-8'),
+                                              self.menu.encode('utf-8'),
+                                              self.comments.encode('utf-8'),
+                                              (self.reload_script or '').encode('utf-8'))
+
+    def _out_rel(self, path):
+        return os.path.relpath(path, self.out_path)
+
+    def _is_fresh(self, source, source_hash):
+        # source is fresh when nothing global changed, its inputs are the same and
+        # every output it produced last time is still in place
+        if self.prev_manifest.get('global') != self.manifest['global']:
+            return False
+        prev = self.prev_manifest.get('sources', {}).get(source)
+        if prev is None or prev['hash'] != source_hash:
+            return False
+        return all(os.path.exists(os.path.join(self.out_path, o)) for o in prev['outputs'])
+
+    def _convert_source(self, source, out_path, ipynb_path, comments=False):
+        if self.shard_sources is not None and source not in self.shard_sources:
+            return
+        inputs = (ipynb_path, os.path.join(source, 'meta.json'))
+        source_hash = _hash_file(*(i for i in inputs if os.path.exists(i)))
+        src = {'hash': source_hash, 'outputs': [self._out_rel(os.path.join(out_path, 'index.html'))]}
+        if self._is_fresh(source, source_hash):
+            # a fresh page still references the assets extracted when it was converted
+            prev = self.prev_manifest['sources'][source]
+            src['outputs'] = list(prev['outputs'])
+            if 'cost' in prev:
+                src['cost'] = prev['cost']
+            # assets shared by several posts are counted once
+            assets = set(src['outputs'][1:]) - self.fresh_assets
+            self.fresh_assets.update(assets)
+            self._get_writer().skip(1 + len(assets))
+        else:
+            # the source rides along, so the result finds its manifest entry directly
+            self.conversions.append((out_path, ipynb_path, comments, source))
+        self.manifest['sources'][source] = src
+        self.search_sources.append((source, source_hash, ipynb_path, _url_path(src['outputs'][0])))
+
+    def _base_file(self, path):
+        if self.writer is None or self.writer.base_path is None:
+            return None
+        return os.path.join(self.writer.base_path, self._out_rel(path))
+
+    def _remove_stale(self):
+        prev_outputs = set(self.prev_manifest.get('indexes', {}))
+        for src in self.prev_manifest.get('sources', {}).values():
+            prev_outputs.update(src['outputs'])
+        outputs = set(self.manifest['indexes'])
+        for src in self.manifest['sources'].values():
+            outputs.update(src['outputs'])
+
+        for stale in prev_outputs - outputs:
+            stale_path = os.path.join(self.out_path, stale)
+            for path in [stale_path] + [stale_path + ext for ext in COMPRESSED_EXTS.values()]:
+                self._get_writer().remove(path)
+            # drop directories left empty, but never the output root itself
+            stale_dir = os.path.dirname(stale_path)
+            while os.path.abspath(stale_dir) != os.path.abspath(self.out_path) and not os.listdir(stale_dir):
+                os.rmdir(stale_dir)
+                stale_dir = os.path.dirname(stale_dir)
+
+    def _compress_encodings(self):
+        encodings = self.config['output'].get('compress', list(COMPRESSED_EXTS))
+        if 'br' in encodings:
+            try:
+                import brotli  # noqa: F401
+            except ImportError:
+                print('brotli is not installed, skipping .br outputs')
+                encodings = [e for e in encodings if e != 'br']
+        return encodings
+
+    def _compress_outputs(self):
+        encodings = self._compress_encodings()
+        jobs = []
+        for dirpath, _, filenames in os.walk(self.out_path):
+            for filename in filenames:
+                if os.path.splitext(filename)[1] in COMPRESSIBLE_EXTS:
+                    path = os.path.join(dirpath, filename)
+                    base = self._base_file(path)
+                    jobs.extend((path, e, base) for e in encodings)
+        # zlib and brotli release the GIL, so threads are enough here
+        from concurrent.futures import ThreadPoolExecutor
+        workers = self.cli_args.get('jobs') or os.cpu_count() or 1
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            return sum(executor.map(lambda job: _compress_file(*job), jobs))
+
+    def _remove_stale_compressed(self):
+        # incremental builds start from hardlinks of the published siblings;
+        # one whose source was rewritten since (or left the site) no longer
+        # carries its mtime, and serve must not send it
+        for dirpath, _, filenames in os.walk(self.out_path):
+            for filename in filenames:
+                source, ext = os.path.splitext(os.path.join(dirpath, filename))
+                if ext not in COMPRESSED_EXTS.values():
+                    continue
+                try:
+                    fresh = os.stat(source).st_mtime_ns == os.stat(source + ext).st_mtime_ns
+                except FileNotFoundError:
+                    fresh = False
+                if not fresh:
+                    self._get_writer().remove(source + ext)
+
+    def _get_meta_index(self):
+        if self.meta_index is None:
+            if 'cache' in self.config:
+                self.meta_index = MetaIndex(os.path.join(self.config['cache']['path'], 'meta.sqlite'))
+            else:
+                # a streaming build must not keep the whole store in memory either
+                self.meta_index = MetaIndex('' if self.cli_args.get('stream') else ':memory:')
+        return self.meta_index
 
     def _generate_posts_dict(self):
-        posts_path = self.config['posts']['path']
-        self.posts = {}
-        post_dirs = (d for d in os.listdir(posts_path) if os.path.isdir(os.path.join(posts_path, d)))
-        for pd in post_dirs:
-            pp = os.path.join(posts_path, pd)
-            with open(os.path.join(pp, 'meta.json'), 'r') as meta_file:
-                meta = json.load(meta_file)
-            self.posts[pp] = meta
+        meta_index = self._get_meta_index()
+        if self.cli_args.get('stream'):
+            # nothing is loaded, posts are looked up in the store when needed
+            meta_index.update(self.config['posts']['path'])
+            self.posts, self.notebooks = meta_index.view('meta'), meta_index.view('notebook')
+        else:
+            self.posts, self.notebooks = meta_index.refresh(self.config['posts']['path'])
+
+    def _find_notebook(self, post):
+        notebook = self.notebooks.get(post)
+        if notebook is None:
+            notebook = sorted(f for f in os.listdir(post) if f.endswith('.ipynb'))[0]
+        return notebook
 
     def _generate_pages_dts(self):
-        self.dts = {}
+        if self.cli_args.get('stream'):
+            undated = self._get_meta_index().archive_undated()
+            if undated:
+                raise ValueError('posts without a dt in meta.json: {}'.format(', '.join(sorted(undated))))
+            self.pages = self._get_meta_index().archive_pages()
+            self.dts = None
+            return
         self.pages = []
+        entries = []
         for pp, data in self.posts.items():
             if not data['set_link']:
-                dt = datetime.datetime.strptime(data['dt'], '%Y-%m-%dT%H:%M:%S.%f')
-                self.dts.setdefault(dt.year, {}).setdefault(dt.month, {}).setdefault(dt.day, []).append(pp)
+                entries.append((_parse_dt(data['dt']), pp))
             else:
                 self.pages.append(pp)
+        self.dts = Archive(entries)
+
+    def _render_index(self, indx_dir, posts, context):
+        # newest first, split into pages of output.page_size: the first page is
+        # indx_dir/index.html, the rest indx_dir/page/N/index.html
+        if not isinstance(posts, ArchiveQuery):  # queries stream their posts sorted already
+            # by dates parsed the way the archive parses them; posts come in archive
+            # order, whose ties go by post dir, and the sort keeps the order of ties,
+            # so reversed first they go by post dir descending, the way queries list them
+            posts = sorted(reversed(posts), key=lambda p: _parse_dt(p['dt']) if p.get('dt') else datetime.datetime.min,
+                           reverse=True)
+        page_size = self.config.get('output', {}).get('page_size') or DEFAULT_PAGE_SIZE
+        page_count = max(1, -(-len(posts) // page_size))
+        posts = iter(posts)
+        indx_rel = self._out_rel(indx_dir)
+        # the main index is the output root itself, whose relative path is '.'
+        indx_url = '/' if indx_rel == os.curdir else _url_path(indx_rel + os.sep)
+
+        def page_url(page):
+            return indx_url if page == 1 else '{}page/{}/'.format(indx_url, page)
+
+        for page in range(1, page_count + 1):
+            page_dir = indx_dir if page == 1 else os.path.join(indx_dir, 'page', str(page))
+            pagination = {'page': page, 'pages': page_count,
+                          'prev': page_url(page - 1) if page > 1 else None,
+                          'next': page_url(page + 1) if page < page_count else None}
+            page_context = dict(context, posts=list(itertools.islice(posts, page_size)), pagination=pagination)
+            self._render_index_page(os.path.join(page_dir, 'index.html'), page_context)
+
+    def _render_index_page(self, indx_path, context, template='index.html'):
+        # a page whose posts and neighbours did not change is left as it is
+        indx_key = _hash_bytes(str(self.manifest['global']).encode('utf-8'),
+                               _hash_json(context).encode('utf-8'))
+        indx_rel = self._out_rel(indx_path)
+        self.manifest['indexes'][indx_rel] = indx_key
+        if self.prev_manifest.get('indexes', {}).get(indx_rel) == indx_key and os.path.exists(indx_path):
+            self._get_writer().skip()
+            return
+
+        tmpl = self._get_template(template)
+        self._get_writer().write(indx_path, tmpl.render(context))
+
+    def _write_search_file(self, rel_path, data):
+        # recorded with the indexes, so unchanged shards are left alone and
+        # shards whose prefix no longer occurs are removed as stale
+        key = _hash_json(data)
+        self.manifest['indexes'][rel_path] = key
+        path = os.path.join(self.out_path, rel_path)
+        if self.prev_manifest.get('indexes', {}).get(rel_path) == key and os.path.exists(path):
+            self._get_writer().skip()
+            return
+        self._get_writer().write(path, json.dumps(data, separators=(',', ':'), sort_keys=True))
+
+    def _search_docs(self):
+        # sorted by post dir, which starts with the post date, so new posts
+        # append documents and leave the ids in existing shards as they are
+        meta_index = self._get_meta_index()
+        if isinstance(self.search_sources, Spill):
+            sources = self.search_sources.sorted()
+        else:
+            sources = sorted(self.search_sources)
+        for doc_id, (source, source_hash, ipynb_path, url) in enumerate(sources):
+            meta = self.posts.get(source, {})
+            terms = meta_index.search_terms(source, source_hash)
+            if terms is None:
+                terms = _search_terms(ipynb_path, meta)
+                meta_index.store_search_terms(source, source_hash, terms)
+            yield doc_id, [url, meta.get('title', ''), meta.get('dt', '')], terms
+        meta_index.flush_search_terms()
+
+    def _generate_search(self):
+        # an inverted index sharded by term prefix: search/index.json lists the
+        # documents, search/terms/<prefix>.json maps terms to [doc, frequency] pairs,
+        # so a query only fetches the shards of its terms. Terms are extracted
+        # again only for posts whose inputs changed.
+        search_cfg = self.config.get('search', {})
+        if not search_cfg.get('enabled', True):
+            return
+        prefix_length = search_cfg.get('prefix_length', DEFAULT_SEARCH_PREFIX)
+        if self.cli_args.get('stream'):
+            self._stream_search(prefix_length)
+        else:
+            docs = []
+            shards = {}
+            for doc_id, doc, terms in self._search_docs():
+                docs.append(doc)
+                for term, count in terms.items():
+                    shards.setdefault(term[:prefix_length], {}).setdefault(term, []).append([doc_id, count])
+
+            self._write_search_file(os.path.join(SEARCH_DIR, 'index.json'), {'prefix': prefix_length, 'docs': docs})
+            for prefix, shard in shards.items():
+                self._write_search_file(os.path.join(SEARCH_DIR, 'terms', prefix + '.json'), shard)
+        self._render_index_page(os.path.join(self.out_path, SEARCH_DIR, 'index.html'),
+                                {'header': 'Search', 'pages': self.menu_pages}, 'search.html')
+
+    def _stream_search(self, prefix_length):
+        # documents are written out as they come and postings spilled to disk,
+        # then read back sorted by term, so only one shard is held at a time
+        rel_path = os.path.join(SEARCH_DIR, 'index.json')
+        path = os.path.join(self.out_path, rel_path)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        postings = Spill(('term', 'doc', 'count'))
+        with open(path + '.tmp', 'w') as index_file:
+            # the same bytes as json.dumps of the whole index in _write_search_file
+            index_file.write('{"docs":[')
+            for doc_id, doc, terms in self._search_docs():
+                index_file.write((',' if doc_id else '') + json.dumps(doc, separators=(',', ':')))
+                postings.extend((term, doc_id, count) for term, count in terms.items())
+            index_file.write('],"prefix":{}}}'.format(prefix_length))
+        self.search_sources.close()
+        self.manifest['indexes'][rel_path] = _hash_file(path + '.tmp')
+        self._get_writer().commit(path + '.tmp', path)
+
+        prefix = None
+        shard = {}
+        for term, doc_id, count in postings.sorted():
+            if term[:prefix_length] != prefix:
+                if shard:
+                    self._write_search_file(os.path.join(SEARCH_DIR, 'terms', prefix + '.json'), shard)
+                prefix, shard = term[:prefix_length], {}
+            shard.setdefault(term, []).append([doc_id, count])
+        if shard:
+            self._write_search_file(os.path.join(SEARCH_DIR, 'terms', prefix + '.json'), shard)
+        postings.close()
 
     def _generate_main_index(self, posts, header='Main index'):
-        tmpl = self.tmpl_env.get_template('index.html')
-        main_indx_path = os.path.join(self.out_path, 'index.html')
-        main_indx = tmpl.render({'header': header, 'posts': posts, 'pages': self.menu_pages})
-        with open(main_indx_path, 'w') as indx:
-            indx.write(main_indx)
+        self._render_index(self.out_path, posts, {'header': header, 'pages': self.menu_pages})
 
     def _generate_pages(self):
         for page in self.pages:
@@ -150,13 +2103,11 @@ class Generate(BlgrCommand):
             if not os.path.exists(page_path):
                 os.mkdir(page_path)
 
-            fls = os.listdir(page)
-            psts = [pst for pst in fls if pst.endswith('.ipynb')]
-            pp = os.path.join(page, psts[0])
-            self._process_ipynb(page_path, pp)
+            pp = os.path.join(page, self._find_notebook(page))
+            self._convert_source(page, page_path, pp)
 
     def _generate_comments(self):
-        tmpl = self.tmpl_env.get_template('comments.html')
+        tmpl = self._get_template('comments.html')
         self.comments = tmpl.render({'disqus': self.config['disqus']})
 
     def _generate_menu(self):
@@ -165,134 +2116,323 @@ class Generate(BlgrCommand):
             pd = self.posts[page]
             pd['url'] = '/{}/'.format(pd['slug'])
             self.menu_pages.append(pd)
-        tmpl = self.tmpl_env.get_template('menu.html')
-        self.menu = tmpl.render({'pages': self.menu_pages})
+        tmpl = self._get_template('menu.html')
+        search = self.config.get('search', {}).get('enabled', True)
+        self.menu = tmpl.render({'pages': self.menu_pages, 'search': search})
 
     def _generate_year_index(self, year_path, posts, year, header=None):
-        indx_path = os.path.join(year_path, 'index.html')
-        tmpl = self.tmpl_env.get_template('index.html')
         if header is None:
             header = 'Year {}'.format(year)
-        indx = tmpl.render({'header': header, 'posts': posts})
-        with open(indx_path, 'w') as cindex:
-            cindex.write(indx)
+        self._render_index(year_path, posts, {'header': header})
 
     def _generate_month_index(self, month_path, posts, year_month, header=None):
         if header is None:
             header = 'Year {} Month {}'.format(year_month[0], year_month[1])
-        indx_path = os.path.join(month_path, 'index.html')
-        tmpl = self.tmpl_env.get_template('index.html')
-        indx = tmpl.render({'header': header, 'posts': posts})
-        with open(indx_path, 'w') as cindex:
-            cindex.write(indx)
+        self._render_index(month_path, posts, {'header': header})
 
     def _generate_day_index(self, day_path, posts, year_month_day, header=None):
         if header is None:
             header = 'Year {} Month {} Day {}'.format(year_month_day[0], year_month_day[1],
                                                       year_month_day[2])
-        indx_path = os.path.join(day_path, 'index.html')
-        tmpl = self.tmpl_env.get_template('index.html')
-        indx = tmpl.render({'header': header, 'posts': posts})
-        with open(indx_path, 'w') as cindex:
-            cindex.write(indx)
+        self._render_index(day_path, posts, {'header': header})
 
     def _generate_category_index(self, category, cat_path, posts, header=None):
         if header is None:
             header = category
-        indx_path = os.path.join(cat_path, 'index.html')
-        tmpl = self.tmpl_env.get_template('index.html')
-        indx = tmpl.render({'header': header, 'posts': posts})
-        with open(indx_path, 'w') as cindex:
-            cindex.write(indx)
+        self._render_index(cat_path, posts, {'header': header})
 
     def _generate_categories(self, categories):
         for cat in categories:
-            cat_path = os.path.join(self.config['output']['path'], cat)
+            cat_path = os.path.join(self.out_path, cat)
             if not os.path.exists(cat_path):
                 os.mkdir(cat_path)
 
             self._generate_category_index(cat, cat_path, categories[cat])
 
+    def _get_cache(self):
+        if self.cache is None and 'cache' in self.config:
+            cache_cfg = self.config['cache']
+            self.cache = ConversionCache(cache_cfg['path'], cache_cfg.get('max_size', DEFAULT_CACHE_SIZE))
+        return self.cache
+
+    def _get_writer(self):
+        if self.writer is None:
+            self.writer = OutputWriter(self.out_path)
+        return self.writer
+
+    def _get_assets(self):
+        if self.assets is None:
+            self.assets = AssetStore(self.out_path, self._get_writer())
+        return self.assets
+
+    def _get_converter(self):
+        if self.converter is None:
+            backend = self.config.get('converter', {}).get('backend', InProcessConverter.backend)
+            self.converter = CONVERTERS[backend]()
+        return self.converter
+
     def _process_ipynb(self, out_path, post_path, comments=False):
-        os.chdir(out_path)
-        call(['ipython', 'nbconvert', '--to', 'html', post_path])
-        psts_html = os.listdir('./')
-        if psts_html:
-            os.rename(psts_html[0], 'index.html')
-
-        os.chdir(self.prj_path)
-        self._append_html(os.path.join(out_path, 'index.html'), comments)
-
-    def _append_html(self, path, comments):
-        soup = BeautifulSoup(open(path))
-
-        menu = BeautifulSoup(self.menu)
-        comments_div = soup.find(id='notebook-container')
-        soup.body.insert(0, menu)
-        if comments:
-            comments = BeautifulSoup(self.comments)
-            comments_div.append(comments)
-        res = soup.prettify()
-        with open(path, 'w') as pg:
-            pg.write(res)
+        # converters write straight into out_path and never touch the cwd,
+        # conversions may run side by side in worker processes
+        # the page only replaces index.html once it is decorated, so a server
+        # running over the output never sees a half-written one
+        indx_path = os.path.join(out_path, 'index.html')
+        raw_path = indx_path + '.raw.tmp'
+        converter = self._get_converter()
+        cache = self._get_cache()
+        if cache is None:
+            converter.convert(post_path, raw_path)
+        else:
+            key = cache.key(post_path, converter.version())
+            if not cache.fetch(key, raw_path):
+                converter.convert(post_path, raw_path)
+                cache.store(key, raw_path)
+        # the cache keeps the raw page, images are extracted on every decoration
+        assets = self._append_html(indx_path, comments, raw_path)
+        os.remove(raw_path)
+        return assets
+
+    def _append_html(self, path, comments, src_path=None):
+        tmp_path = path + '.tmp'
+        with open(src_path or path, 'r') as src, open(tmp_path, 'w') as pg:
+            output_cfg = self.config.get('output', {})
+            decorator = PageDecorator(pg, self.menu, self.comments if comments else None, self.reload_script,
+                                      self._get_assets(), images=output_cfg.get('extract_images', True),
+                                      boilerplate=output_cfg.get('share_boilerplate', True))
+            for chunk in iter(lambda: src.read(65536), ''):
+                decorator.feed(chunk)
+            decorator.close()
+        self._get_writer().commit(tmp_path, path)
+        return decorator.extracted
 
     def _generate_post(self, post, day_path, categories, year, month, day):
-        slug = self.posts[post]['slug']
-        slug_path = os.path.join(day_path, slug)
-        cat = self.posts[post]['category'] if self.posts[post].get('category') else 'uncategorized'
-        pd = {'url': '/{}/{}/{}/{}/'.format(year, month, day, slug)}
-        pd.update(self.posts[post])
-        categories.setdefault(cat, []).append(pd)
+        meta = self.posts[post]
+        slug_path = os.path.join(day_path, meta['slug'])
+        pd = _post_dict(meta, year, month, day)
+        categories.setdefault(meta.get('category') or 'uncategorized', []).append(pd)
         if not os.path.exists(slug_path):
             os.mkdir(slug_path)
 
-        fls = os.listdir(post)
-        psts = [pst for pst in fls if pst.endswith('.ipynb')]
-        pp = os.path.join(self.prj_path, post, psts[0])
-        self._process_ipynb(slug_path, pp, pd['comments'])
+        pp = os.path.join(self.prj_path, post, self._find_notebook(post))
+        self._convert_source(post, slug_path, pp, pd['comments'])
         return pd
 
     def _generate_posts(self):
-        all_posts = []
-        categories = {}
-        for year in self.dts:
-            year_posts = []
-            year_path = os.path.join(self.out_path, str(year))
-            if not os.path.exists(year_path):
-                os.mkdir(year_path)
-
-            for month in self.dts[year]:
-                month_posts = []
-                month_path = os.path.join(year_path, str(month))
-                if not os.path.exists(month_path):
-                    os.mkdir(month_path)
-
-                for day in self.dts[year][month]:
-                    day_posts = []
-                    day_path = os.path.join(month_path, str(day))
-                    if not os.path.exists(day_path):
-                        os.mkdir(day_path)
-
-                    for post in self.dts[year][month][day]:
-                        pd = self._generate_post(post, day_path, year, month, day, categories)
-                        all_posts.append(pd)
-
-
-                    day_posts.append(pd)
-                    month_posts.append(pd)
-                    year_posts.append(pd)
-
-                    self._generate_day_index(day_path, day_posts, (year, month, day))
-                self._generate_month_index(month_path, month_posts, (year, month))
-            self._generate_year_index(year_path, year_posts, year)
-        self._generate_categories(categories)
-        self._generate_main_index(all_posts)
+        if self.cli_args.get('stream'):
+            return self._stream_posts()
+        self.all_posts = []
+        self.categories = {}
+        for dt, post in self.dts:
+            day_path = os.path.join(self.out_path, str(dt.year), str(dt.month), str(dt.day))
+            os.makedirs(day_path, exist_ok=True)
+            self.all_posts.append(self._generate_post(post, day_path, self.categories, dt.year, dt.month, dt.day))
+
+    def _stream_posts(self):
+        # posts come from the store in date order and are converted in batches
+        # on one pool of workers, so neither post dicts nor the conversion
+        # queue grow with the blog; the indexes are queried from the store later
+        workers = self.cli_args.get('jobs') or os.cpu_count() or 1
+        if workers > 1:
+            from concurrent.futures import ProcessPoolExecutor
+            pool = ProcessPoolExecutor(max_workers=workers, initializer=_init_worker,
+                                       initargs=(self._worker_state(),))
+        else:
+            pool = contextlib.nullcontext()
+        with pool as self.executor:
+            for dt, post in self._get_meta_index().archive_entries():
+                day_path = os.path.join(self.out_path, str(dt.year), str(dt.month), str(dt.day))
+                os.makedirs(day_path, exist_ok=True)
+                self._generate_post(post, day_path, {}, dt.year, dt.month, dt.day)
+                if len(self.conversions) >= STREAM_BATCH:
+                    self._run_conversions()
+            self._run_conversions()
+        self.executor = None
+
+    def _generate_period_index(self, key, posts):
+        indx_path = os.path.join(self.out_path, *(str(k) for k in key))
+        if len(key) == 1:
+            self._generate_year_index(indx_path, posts, key[0])
+        elif len(key) == 2:
+            self._generate_month_index(indx_path, posts, key)
+        else:
+            self._generate_day_index(indx_path, posts, key)
+
+    def _generate_indexes(self):
+        if self.cli_args.get('stream'):
+            return self._stream_indexes()
+        # all_posts follows the archive order, so every group is a slice of it
+        for key, lo, hi in self.dts.groups():
+            self._generate_period_index(key, self.all_posts[lo:hi])
+        self._generate_categories(self.categories)
+        self._generate_main_index(self.all_posts)
+
+    def _stream_indexes(self):
+        # every index is a query on the store, rendered a page of posts at a time
+        meta_index = self._get_meta_index()
+        for key in meta_index.archive_periods():
+            self._generate_period_index(key, meta_index.archive_posts(_period_start(key), _period_end(key)))
+        self._generate_categories({cat: meta_index.archive_posts(category=cat)
+                                   for cat in meta_index.archive_categories()})
+        self._generate_main_index(meta_index.archive_posts())
+
+    def _worker_state(self):
+        # everything a conversion worker needs to run _process_ipynb on its own
+        return {'config': self.config, 'prj_path': self.prj_path, 'out_path': self.out_path,
+                'menu': self.menu, 'comments': self.comments, 'reload_script': self.reload_script,
+                'writer': self.writer}
+
+    def _run_conversions(self):
+        jobs = self.conversions
+        self.conversions = []
+        workers = min(self.cli_args.get('jobs') or os.cpu_count() or 1, len(jobs))
+        if self.executor is not None:  # a streaming build keeps its pool between batches
+            timings = list(self.executor.map(_run_worker, jobs))
+        elif workers <= 1:
+            timings = [self._timed_conversion(job) for job in jobs]
+        else:
+            from concurrent.futures import ProcessPoolExecutor
+            with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker,
+                                     initargs=(self._worker_state(),)) as executor:
+                # iterating the results re-raises the first conversion error here
+                timings = list(executor.map(_run_worker, jobs))
+        # images extracted from a page become outputs of its source, so they are
+        # checked by freshness and dropped as stale once no page uses them; the
+        # conversion time balances the next sharded build
+        for timing in timings:
+            src = self.manifest['sources'].get(timing.pop('post'))
+            assets = timing.pop('assets')
+            writes = timing.pop('writes')
+            if self.executor is not None or workers > 1:  # workers count on their own copy of the writer
+                self._get_writer().add(writes)
+            if src is not None:
+                src['outputs'].extend(a for a in sorted(set(assets or ())) if a not in src['outputs'])
+                src['cost'] = round(timing['wall'], 3)
+            if self.profiler is not None:
+                self.profiler.record(timing)
+
+    def _timed_conversion(self, job):
+        out_path, post_path, comments, source = job
+        started, wall, cpu = time.time(), time.perf_counter(), time.process_time()
+        counts = dict(self._get_writer().counts)
+        assets = self._process_ipynb(out_path, post_path, comments)
+        writes = {key: count - counts[key] for key, count in self._get_writer().counts.items()}
+        indx_path = os.path.join(out_path, 'index.html')
+        return {'source': post_path, 'output': indx_path, 'post': source, 'assets': assets, 'writes': writes,
+                'pid': os.getpid(), 'start': started,
+                'wall': time.perf_counter() - wall, 'cpu': time.process_time() - cpu,
+                'size': os.path.getsize(indx_path) if os.path.exists(indx_path) else 0}
+
+    def _write_profile(self):
+        report_path = self.cli_args['profile']
+        self.profiler.write(report_path, os.path.splitext(report_path)[0] + '.trace.json')
+        print(self.profiler.summary(self.cli_args.get('profile_top') or DEFAULT_PROFILE_TOP))
+
+    def _save_fragment(self):
+        # what merge needs from a shard besides its files
+        fragment = {'version': MANIFEST_VERSION, 'shard': list(self.cli_args['shard']),
+                    'global': self.manifest['global'], 'sources': self.manifest['sources']}
+        with open(os.path.join(self.out_path, FRAGMENT_NAME), 'w') as ff:
+            json.dump(fragment, ff, sort_keys=True, indent=1)
+
+    def _steps(self):
+        steps = [('menu', self._generate_menu),
+                 ('comments', self._generate_comments),
+                 ('global hash', self._generate_global_hash),
+                 ('pages', self._generate_pages),
+                 ('posts', self._generate_posts),
+                 ('conversions', self._run_conversions)]
+        if self.cli_args.get('shard'):
+            if self.cli_args.get('compress'):
+                steps.append(('compress', self._compress_outputs))
+            return steps + [('fragment', self._save_fragment)]
+
+        steps.extend([('indexes', self._generate_indexes),
+                      ('search', self._generate_search),
+                      ('stale', self._remove_stale)])
+        if self.cli_args.get('compress'):
+            steps.append(('compress', self._compress_outputs))
+        steps.append(('stale compressed', self._remove_stale_compressed))
+        return steps + [('file hashes', self._generate_file_hashes),
+                        ('manifest', self._save_manifest),
+                        ('publish', self._publish)]
 
     def execute(self):
-        self._generate_menu()
-        self._generate_comments()
-        self._generate_pages()
-        self._generate_posts()
+        steps = self._steps()
+        if self._get_cache() is not None:
+            steps.append(('cache prune', self.cache.prune))
+
+        for name, step in steps:
+            with self._phase(name):
+                step()
+        print('{written} files written, {skipped} unchanged, {deleted} deleted'.format(**self._get_writer().counts))
+        if self.profiler is not None:
+            self._write_profile()
+
+
+class Merge(Generate):
+    # Combines the partial outputs of generate --shard into one build: the
+    # shard files are linked in, and menu, indexes and search are rendered
+    # once over all posts, then published like any other build.
+    _command = 'merge'
+
+    def add_args(self):
+        self._add_build_args()
+        self.parser.add_argument('shards', nargs='*',
+                                 help='shard directories to merge (defaults to every directory '
+                                      'in <output.path>.shards)')
+
+    def _shard_paths(self):
+        if self.cli_args.get('shards'):
+            return self.cli_args['shards']
+        shards_path = self.publish_path + SHARDS_SUFFIX
+        return [os.path.join(shards_path, s) for s in sorted(os.listdir(shards_path))]
+
+    def _merge_shards(self):
+        built = set()
+        counts = set()
+        for shard_path in self._shard_paths():
+            with open(os.path.join(shard_path, FRAGMENT_NAME), 'r') as ff:
+                fragment = json.load(ff)
+            if fragment.get('version') != MANIFEST_VERSION or fragment['global'] != self.manifest['global']:
+                raise ValueError('{} was built by another blgr or with another config or templates'.format(shard_path))
+            built.add(tuple(fragment['shard']))
+            counts.add(fragment['shard'][1])
+            self.manifest['sources'].update(fragment['sources'])
+
+            for dirpath, _, filenames in os.walk(shard_path):
+                out_dir = os.path.join(self.out_path, os.path.relpath(dirpath, shard_path))
+                os.makedirs(out_dir, exist_ok=True)
+                for filename in filenames:
+                    if filename not in (FRAGMENT_NAME, MANIFEST_NAME) and not filename.endswith('.tmp'):
+                        self._get_writer().link(os.path.join(dirpath, filename), os.path.join(out_dir, filename))
+
+        count = counts.pop() if len(counts) == 1 else None
+        if count is None or built != {(i, count) for i in range(1, count + 1)}:
+            raise ValueError('shards do not add up to a whole build: {}'.format(
+                ', '.join('{}/{}'.format(*b) for b in sorted(built)) or 'none given'))
+
+    def _convert_source(self, source, out_path, ipynb_path, comments=False):
+        src = self.manifest['sources'].get(source)
+        if src is None:
+            raise ValueError('{} was not built by any of the shards'.format(source))
+        self.search_sources.append((source, src['hash'], ipynb_path, _url_path(src['outputs'][0])))
+
+    def _steps(self):
+        steps = [('menu', self._generate_menu),
+                 ('comments', self._generate_comments),
+                 ('global hash', self._generate_global_hash),
+                 ('merge', self._merge_shards),
+                 ('pages', self._generate_pages),
+                 ('posts', self._generate_posts),
+                 ('indexes', self._generate_indexes),
+                 ('search', self._generate_search),
+                 ('stale', self._remove_stale)]
+        if self.cli_args.get('compress'):
+            steps.append(('compress', self._compress_outputs))
+        steps.append(('stale compressed', self._remove_stale_compressed))
+        return steps + [('file hashes', self._generate_file_hashes),
+                        ('manifest', self._save_manifest),
+                        ('publish', self._publish)]
 
 
 class Serve(BlgrCommand):
@@ -303,30 +2443,313 @@ class Serve(BlgrCommand):
                                  required=False, help='port on which to start '
                                                       'serving')
 
+        self.parser.add_argument('-w', '--workers', type=int, default=DEFAULT_SERVE_WORKERS,
+                                 help='number of threads handling connections')
+        self.parser.add_argument('--max-connections', type=int, default=DEFAULT_SERVE_CONNECTIONS,
+                                 help='open connections above this are answered with 503')
+        self.parser.add_argument('--timeout', type=float, default=DEFAULT_SERVE_TIMEOUT,
+                                 help='seconds a connection may stay idle or take to send a request')
+        self.parser.add_argument('--watch', action='store_true', default=False,
+                                 help='rebuild changed posts while serving')
+        self.parser.add_argument('--debounce', type=float, default=DEFAULT_WATCH_DEBOUNCE,
+                                 help='seconds without changes before a rebuild starts')
+
     def prepare(self):
-        os.chdir(self.config['output']['path'])
+        self.out_path = self.config['output']['path']
+        if self.cli_args.get('watch'):
+            # preview builds carry the live reload script, so they never go to output.path
+            self.out_path = os.path.normpath(self.out_path) + PREVIEW_SUFFIX
+        self.port = self.cli_args.get('port', 8080)
+        self.stop_event = threading.Event()
+        self.reload_hub = None
+
+    def make_server(self, address):
+        handler_class, server_class = _server_classes()
+        handler = functools.partial(handler_class, directory=self.out_path)
+        httpd = server_class(address, handler,
+                                 workers=self.cli_args.get('workers', DEFAULT_SERVE_WORKERS),
+                                 max_connections=self.cli_args.get('max_connections', DEFAULT_SERVE_CONNECTIONS),
+                                 request_timeout=self.cli_args.get('timeout', DEFAULT_SERVE_TIMEOUT))
+        httpd.build_index = BuildIndex(self.out_path)
+        httpd.cache_control = self.config.get('serve', {}).get('cache_control', [])
+        return httpd
+
+    def _make_generate(self):
+        generate = Generate()
+        generate.config = self.config
+        generate.cli_args = {'incremental': True, 'jobs': None, 'preview': True}
+        return generate
+
+    def _rebuild(self, generate, changed=()):
+        config_path = self.cli_args.get('config_path')
+        if config_path and os.path.abspath(config_path) in {os.path.abspath(c) for c in changed}:
+            with open(config_path, 'r') as cfgf:
+                self.config = json.load(cfgf)
+            generate.config = self.config
+        started = time.time()
+        try:
+            # incremental, so only posts and indexes whose inputs changed are rewritten;
+            # the files being replaced keep being served until then
+            generate.prepare()
+            generate.execute()
+        except Exception:
+            import traceback
+            traceback.print_exc()
+            return False
+        print('rebuilt in {:.2f}s'.format(time.time() - started))
+
+        if self.reload_hub is not None:
+            prev_files = generate.prev_manifest.get('files', {})
+            rebuilt = [f for f, entry in generate.manifest['files'].items()
+                       if f not in prev_files or prev_files[f][2] != entry[2]]
+            self.reload_hub.notify(rebuilt)
+        return True
+
+    def _watch(self, watcher, generate):
+        debounce = self.cli_args.get('debounce', DEFAULT_WATCH_DEBOUNCE)
+        while not self.stop_event.is_set():
+            changed = watcher.wait(debounce)
+            if not changed:
+                continue
+            # a burst of saves ends with one rebuild once things go quiet
+            while True:
+                more = watcher.wait(debounce)
+                if not more:
+                    break
+                changed |= more
+            self._rebuild(generate, changed)
+
+    def execute(self):
+        if not self.cli_args.get('watch'):
+            httpd = self.make_server(('', self.port))
+            print('serving at port {}'.format(self.port))
+            try:
+                httpd.serve_forever()
+            finally:
+                httpd.server_close()
+            return
+
+        self.reload_hub = ReloadHub()
+        generate = self._make_generate()
+        self._rebuild(generate)
+        # created once the first preview build is published, so there is something to serve
+        httpd = self.make_server(('', self.port))
+        httpd.reload_hub = self.reload_hub
+        files = [self.cli_args['config_path']] if self.cli_args.get('config_path') else []
+        # user template dirs from the config as well as the bundled ones
+        watcher = _make_watcher([self.config['posts']['path']] + generate._template_dirs(), files)
+        server_thread = threading.Thread(target=httpd.serve_forever)
+        server_thread.daemon = True
+        server_thread.start()
+        print('serving at port {}, watching for changes'.format(self.port))
+        try:
+            self._watch(watcher, generate)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            watcher.close()
+            httpd.shutdown()
+            httpd.server_close()
+
+
+class Rollback(BlgrCommand):
+    _command = 'rollback'
+
+    def add_args(self):
+        self.parser.add_argument('generation', nargs='?', default=None,
+                                 help='generation to publish (defaults to the one before the current)')
+        self.parser.add_argument('-l', '--list', action='store_true', default=False,
+                                 help='list the kept generations, the published one marked with *')
+
+    def prepare(self):
+        self.publish_path = os.path.normpath(self.config['output']['path'])
+        self.generations_path = self.publish_path + GENERATIONS_SUFFIX
+        self.generations = _list_generations(self.generations_path)
+        current = _current_generation(self.publish_path)
+        self.current = os.path.basename(current) if current else None
 
     def execute(self):
-        handler = http.server.SimpleHTTPRequestHandler
-        httpd = socketserver.TCPServer(('', self.port), handler)
-        print('serving at port {}'.format(self.port))
-        httpd.serve_forever()
+        if self.cli_args.get('list'):
+            for generation in self.generations:
+                print('{} {}'.format('*' if generation == self.current else ' ', generation))
+            return
+
+        generation = self.cli_args.get('generation')
+        if generation is None:
+            older = [g for g in self.generations if self.current is None or g < self.current]
+            generation = older[-1] if older else None
+        if generation not in self.generations:
+            print('no generation to roll back to')
+            return
+        _flip_symlink(self.publish_path, os.path.join(self.generations_path, generation))
+        print('published generation {}'.format(generation))
+
+
+def _file_size(path):
+    try:
+        return os.stat(path).st_size
+    except OSError:
+        return None
+
+
+class Publish(BlgrCommand):
+    # Deploys the published build to a plain directory (a web root or a
+    # mount) as a delta. The target keeps the hash and size of every file it
+    # got, so only new or changed files are copied, pages after everything
+    # else so none is served before the assets it links to, and files that
+    # left the site are removed once the new ones are in place.
+    _command = 'publish'
+
+    def add_args(self):
+        self.parser.add_argument('target', nargs='?', default=None,
+                                 help='directory to publish to (defaults to publish.target from config)')
+        self.parser.add_argument('-n', '--dry-run', action='store_true', default=False,
+                                 help='print the deploy plan without touching the target')
+        self.parser.add_argument('-j', '--jobs', type=int, default=None,
+                                 help='number of files copied in parallel (defaults to the number of cores)')
+
+    def prepare(self):
+        self.source = _current_generation(os.path.normpath(self.config['output']['path']))
+        self.target = self.cli_args.get('target') or self.config.get('publish', {}).get('target')
+
+    def _load(self, path):
+        try:
+            with open(path, 'r') as mf:
+                manifest = json.load(mf)
+        except (OSError, ValueError):
+            return {}
+        return manifest if manifest.get('version') == MANIFEST_VERSION else {}
+
+    def _source_files(self):
+        # the build manifest has the hash of every file whose stat did not change since
+        recorded = self._load(os.path.join(self.source, MANIFEST_NAME)).get('files', {})
+        files = {}
+        for dirpath, _, filenames in os.walk(self.source):
+            for filename in filenames:
+                if filename in (MANIFEST_NAME, FRAGMENT_NAME) or filename.endswith('.tmp'):
+                    continue
+                path = os.path.join(dirpath, filename)
+                rel_path = os.path.relpath(path, self.source)
+                st = os.stat(path)
+                entry = recorded.get(rel_path)
+                if entry is not None and entry[0] == st.st_mtime_ns and entry[1] == st.st_size:
+                    files[rel_path] = [entry[2], st.st_size]
+                else:
+                    files[rel_path] = [_hash_file(path), st.st_size]
+        return files
+
+    def plan(self):
+        files = self._source_files()
+        published = self._load(os.path.join(self.target, PUBLISH_MANIFEST_NAME)).get('files', {})
+        # the size check catches target files changed or removed behind our back
+        copies = [rel_path for rel_path, entry in files.items()
+                  if published.get(rel_path) != entry
+                  or _file_size(os.path.join(self.target, rel_path)) != entry[1]]
+        copies.sort(key=lambda rel_path: ('.html' in os.path.basename(rel_path), rel_path))
+        # only files published from here are ever removed, the rest of the target is left alone
+        stale = sorted(set(published) - set(files))
+        return files, copies, stale
+
+    def _copy(self, rel_path):
+        # hardlinked when the target is on the same filesystem: builds never
+        # change a file of a generation in place
+        dst = os.path.join(self.target, rel_path)
+        os.makedirs(os.path.dirname(dst), exist_ok=True)
+        _link_replace(os.path.join(self.source, rel_path), dst)
+
+    def _remove(self, rel_path):
+        path = os.path.join(self.target, rel_path)
+        if os.path.exists(path):
+            os.remove(path)
+        parent = os.path.dirname(path)
+        # the folder may already be gone from the target, then there is nothing to tidy
+        while os.path.abspath(parent) != os.path.abspath(self.target) and os.path.isdir(parent) and \
+                not os.listdir(parent):
+            os.rmdir(parent)
+            parent = os.path.dirname(parent)
+
+    def _save(self, files):
+        manifest_path = os.path.join(self.target, PUBLISH_MANIFEST_NAME)
+        with open(manifest_path + '.tmp', 'w') as mf:
+            json.dump({'version': MANIFEST_VERSION, 'files': files}, mf, sort_keys=True, indent=1)
+        os.replace(manifest_path + '.tmp', manifest_path)
+
+    def execute(self):
+        if self.source is None:
+            print('nothing to publish, run generate first')
+            return
+        if not self.target:
+            print('no target given and no publish.target in config')
+            return
+
+        files, copies, stale = self.plan()
+        counts = (len(copies), sum(files[c][1] for c in copies), len(files) - len(copies), len(stale))
+        if self.cli_args.get('dry_run'):
+            for rel_path in copies:
+                print('copy {}'.format(rel_path))
+            for rel_path in stale:
+                print('delete {}'.format(rel_path))
+            print('{} files to copy ({} bytes), {} unchanged, {} to delete'.format(*counts))
+            return
+
+        os.makedirs(self.target, exist_ok=True)
+        pages = [c for c in copies if '.html' in os.path.basename(c)]
+        others = copies[:len(copies) - len(pages)]
+        from concurrent.futures import ThreadPoolExecutor
+        workers = self.cli_args.get('jobs') or os.cpu_count() or 1
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            for batch in (others, pages):
+                list(executor.map(self._copy, batch))
+        for rel_path in stale:
+            self._remove(rel_path)
+        # saved last: a publish that dies halfway is redone from the old manifest
+        self._save(files)
+        print('{} files copied ({} bytes), {} unchanged, {} deleted'.format(*counts))
+
+
+class Cache(BlgrCommand):
+    _command = 'cache'
+
+    def add_args(self):
+        self.parser.add_argument('action', choices=('prune',),
+                                 help='prune: evict least recently used conversions')
+        self.parser.add_argument('--max-size', type=int, default=None,
+                                 help='size in bytes to shrink the cache to '
+                                      '(defaults to cache.max_size from config)')
+
+    def prepare(self):
+        cache_cfg = self.config.get('cache', {'path': DEFAULT_CACHE_PATH})
+        self.cache = ConversionCache(cache_cfg['path'], cache_cfg.get('max_size', DEFAULT_CACHE_SIZE))
+
+    def execute(self):
+        removed, total = self.cache.prune(self.cli_args.get('max_size'))
+        print('removed {} cached conversions, {} bytes left'.format(removed, total))
 
 
 class BlgrCli():
+    def _command_name(self, cli_args):
+        # which command runs decides the one parser worth filling in
+        probe = argparse.ArgumentParser(add_help=False)
+        probe.add_argument('-c', '--config_path')
+        probe.add_argument('command', nargs='?')
+        return probe.parse_known_args(cli_args)[0].command
+
     def process_cli_args(self, cli_args=None):
+        if not cli_args:
+            cli_args = sys.argv[1:]
         parser = argparse.ArgumentParser(description='blgr cli')
         parser.add_argument('-c', '--config_path', default='config.json', required=True, help='path to config file')
 
         subparsers = parser.add_subparsers(help='command')
-        for name, cmd in BlgrCommand.commands.items():
-            cmd.parser = subparsers.add_parser(name)
-            cmd.add_args()
-            cmd.parser.set_defaults(cmd=cmd)
-        if cli_args:
-            args = parser.parse_args(cli_args)
-        else:
-            args = parser.parse_args()
+        name = self._command_name(cli_args)
+        for cmd_name, cmd_class in BlgrCommand.commands.items():
+            cmd_parser = subparsers.add_parser(cmd_name)
+            if cmd_name == name:
+                cmd = cmd_class()
+                cmd.parser = cmd_parser
+                cmd.add_args()
+                cmd.parser.set_defaults(cmd=cmd)
+        args = parser.parse_args(cli_args)
         if hasattr(args, 'cmd'):
             self.cmd = args.cmd
             self.cmd.cli_args = vars(args)
@@ -0,0 +1,42 @@
+import os
+import json
+import shutil
+
+from benchmarks.bench import make_blog, compare
+from blgr.blgr import Generate
+
+
+def test_make_blog():
+    posts_path = 'bench_posts/'
+    make_blog(posts_path, posts=5, pages=1, cells=2, images=1, image_kb=1, seed=1)
+    post_dirs = sorted(os.listdir(posts_path))
+    assert len(post_dirs) == 5
+
+    generate = Generate()
+    generate.config = {'posts': {'path': posts_path}}
+    generate._generate_posts_dict()
+    generate._generate_pages_dts()
+    assert len(generate.posts) == 5
+    assert len(generate.pages) == 1
+    for post_dir in post_dirs:
+        with open(os.path.join(posts_path, post_dir, 'meta.json'), 'r') as meta_file:
+            meta = json.load(meta_file)
+        assert post_dir.endswith(meta['slug'])
+        assert set(meta) == {'title', 'slug', 'category', 'dt', 'comments', 'set_link'}
+
+    make_blog('bench_again/', posts=5, pages=1, cells=2, images=1, image_kb=1, seed=1)
+    assert sorted(os.listdir('bench_again/')) == post_dirs
+
+    shutil.rmtree(posts_path)
+    shutil.rmtree('bench_again/')
+
+
+def test_compare():
+    baseline = {'generate_cold': {'wall': 1.0, 'peak_rss': 100}, 'serve': {'requests_per_second': 100}}
+    results = {'generate_cold': {'wall': 1.1, 'peak_rss': 200}, 'serve': {'requests_per_second': 70}}
+    regressions, lines = compare(results, baseline, 0.2)
+    assert sorted(regressions) == [('generate_cold', 'peak_rss'), ('serve', 'requests_per_second')]
+    assert len(lines) == 3
+
+    regressions, _ = compare(results, {}, 0.2)
+    assert regressions == []
@@ -0,0 +1,113 @@
+import os
+import time
+import shutil
+from unittest import mock
+
+from blgr.blgr import Cache, ConversionCache
+
+
+def test_store_fetch():
+    cache_path = 'cache/'
+    out_path = 'output/'
+    os.makedirs(out_path)
+    out_file = os.path.join(out_path, 'index.html')
+    with open(out_file, 'w') as converted:
+        converted.write('converted')
+
+    cache = ConversionCache(cache_path, 1024)
+    assert not cache.fetch('abcdef', out_file)
+    cache.store('abcdef', out_file)
+    assert os.path.exists(os.path.join(cache_path, 'conversions', 'ab', 'abcdef.html'))
+
+    fetched = os.path.join(out_path, 'fetched.html')
+    assert cache.fetch('abcdef', fetched)
+    with open(fetched, 'r') as fetched_file:
+        assert fetched_file.read() == 'converted'
+
+    shutil.rmtree(cache_path)
+    shutil.rmtree(out_path)
+
+
+def test_key():
+    post_path = 'post.ipynb'
+    with open(post_path, 'w') as post:
+        post.write('{}')
+
+    cache = ConversionCache('cache/', 1024)
+    key = cache.key(post_path, 'v1')
+    assert key == cache.key(post_path, 'v1')
+    assert key != cache.key(post_path, 'v2')
+
+    with open(post_path, 'w') as post:
+        post.write('{"changed": true}')
+    assert key != cache.key(post_path, 'v1')
+
+    os.remove(post_path)
+
+
+def test_prune():
+    cache_path = 'cache/'
+    cache = ConversionCache(cache_path, 10)
+    now = time.time()
+    for age, key in enumerate(('aa1', 'bb2', 'cc3')):
+        entry = cache._entry(key)
+        os.makedirs(os.path.dirname(entry))
+        with open(entry, 'w') as entry_file:
+            entry_file.write('12345')
+        os.utime(entry, (now - age * 10, now - age * 10))
+
+    removed, total = cache.prune()
+    # the least recently used entry goes first
+    assert removed == 1
+    assert total == 10
+    assert not os.path.exists(cache._entry('cc3'))
+    assert os.path.exists(cache._entry('aa1'))
+
+    assert cache.prune(0) == (2, 0)
+
+    shutil.rmtree(cache_path)
+
+
+def test_prune_concurrent():
+    cache_path = 'cache/'
+    out_file = 'fetched.html'
+    cache = ConversionCache(cache_path, 0)
+    for key in ('aa1', 'bb2'):
+        entry = cache._entry(key)
+        os.makedirs(os.path.dirname(entry))
+        with open(entry, 'w') as entry_file:
+            entry_file.write('12345')
+    # an entry another build is still storing is left alone
+    tmp_entry = cache._entry('aa3') + '.123.tmp'
+    with open(tmp_entry, 'w') as entry_file:
+        entry_file.write('12345')
+
+    # another build prunes an entry first
+    real_remove = os.remove
+
+    def remove(path):
+        if path == cache._entry('bb2'):
+            real_remove(path)
+        real_remove(path)
+
+    with mock.patch('blgr.blgr.os.remove', side_effect=remove):
+        assert cache.prune() == (1, 0)
+    assert os.path.exists(tmp_entry)
+
+    # ... or an entry goes between lookup and copy, which is a miss
+    assert not cache.fetch('aa1', out_file)
+    assert not os.path.exists(out_file)
+
+    shutil.rmtree(cache_path)
+
+
+def test_cache_command():
+    cache_cmd = Cache()
+    cache_cmd.config = {'cache': {'path': 'cache/', 'max_size': 100}}
+    cache_cmd.cli_args = {'action': 'prune', 'max_size': 5}
+    cache_cmd.prepare()
+
+    assert cache_cmd.cache.max_size == 100
+    with mock.patch.object(cache_cmd.cache, 'prune', return_value=(0, 0)) as mock_prune:
+        cache_cmd.execute()
+    mock_prune.assert_called_once_with(5)
@@ -1,8 +1,27 @@
+import os
+import sys
+import shutil
+import tempfile
+import subprocess
 from unittest.mock import patch
 
 from nose.tools import assert_raises
 
-from blgr.blgr import BlgrCli, Create, BlgrCommand
+from blgr.blgr import BlgrCli, Create, Generate, BlgrCommand
+
+# blgr runs from git hooks and scripts: importing it must stay cheap and must
+# not pull in what only some commands need
+IMPORT_BUDGET = 0.075
+HEAVY_MODULES = ('jinja2', 'nbconvert', 'http.server', 'socketserver', 'html.parser', 'sqlite3',
+                 'concurrent.futures', 'importlib.metadata', 'email.utils', 'subprocess')
+PRJ_PATH = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def _run_python(code, pycache):
+    env = dict(os.environ, PYTHONPYCACHEPREFIX=pycache)
+    env.pop('PYTHONDONTWRITEBYTECODE', None)  # a real install has its bytecode cached
+    return subprocess.run([sys.executable, '-X', 'importtime', '-c', code], cwd=PRJ_PATH, env=env,
+                          stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True, check=True)
 
 
 def test_blgr_command():
@@ -37,3 +56,31 @@ def test_executes_command():
     mock_prepare.assert_called_once_with()
     mock_execute.assert_called_once()
 
+
+def test_only_selected_command_is_created():
+    cli = BlgrCli()
+    with patch.object(Generate, '__init__', return_value=None) as mock_init:
+        cli.process_cli_args(['-c', 'blgr/config.json', 'create'])
+    assert not mock_init.called
+    assert isinstance(cli.cmd, Create)
+    assert BlgrCommand.commands['generate'] is Generate
+
+
+def test_import_time():
+    pycache = tempfile.mkdtemp()
+    _run_python('import blgr.blgr', pycache)  # writes the bytecode
+    timings = []
+    for _ in range(3):
+        result = _run_python('import blgr.blgr', pycache)
+        # -X importtime: "import time: self | cumulative | module" in microseconds
+        line = [l for l in result.stderr.splitlines() if l.endswith('| blgr.blgr')][-1]
+        timings.append(int(line.split('|')[1]) / 1e6)
+    assert min(timings) < IMPORT_BUDGET, timings
+
+    code = ("import sys\n"
+            "from blgr.blgr import BlgrCli\n"
+            "for command in (['create'], ['serve'], ['cache', 'prune']):\n"
+            "    BlgrCli().process_cli_args(['-c', 'blgr/config.json'] + command)\n"
+            "print(' '.join(m for m in {!r} if m in sys.modules))").format(HEAVY_MODULES)
+    assert _run_python(code, pycache).stdout.strip() == ''
+    shutil.rmtree(pycache)
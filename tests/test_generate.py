@@ -1,17 +1,26 @@
+import io
 import os
+import sys
+import gzip
+import base64
+import hashlib
 import json
 import shutil
+import subprocess
+import argparse
 import datetime
 from unittest import mock
 
 import jinja2
 from bs4 import BeautifulSoup
 
-from blgr.blgr import Generate
+import blgr.blgr
+from blgr.blgr import _link_replace, _search_terms, _assign_shards, _shard_spec, Archive, Generate, Merge, Rollback, MetaIndex, PageDecorator, AssetStore, OutputWriter, Spill, Profiler, InProcessConverter, SubprocessConverter, MANIFEST_NAME, MANIFEST_VERSION
 
 
 def test_prepare():
     generate = Generate()
+    generate.config = {}
 
     with mock.patch.object(generate, '_generate_out_path') as mock_out_path:
         with mock.patch.object(generate, '_generate_posts_dict') as mock_posts_dict:
@@ -28,6 +37,39 @@ def test_prepare():
     assert isinstance(generate.tmpl_env, jinja2.Environment)
 
 
+def test_prepare_templates():
+    template_path = 'templates/'
+    os.makedirs(template_path)
+    with open(os.path.join(template_path, 'menu.html'), 'w') as menu_template:
+        menu_template.write('user menu')
+
+    generate = Generate()
+    generate.prj_path = os.path.abspath('blgr')
+    generate.config = {'templates': {'paths': [template_path]}, 'cache': {'path': 'cache/'}}
+    generate._prepare_templates()
+
+    # user templates override the bundled ones, the rest still come from blgr
+    assert generate._get_template('menu.html').render() == 'user menu'
+    assert 'index.html' in generate.templates
+    assert os.listdir(os.path.join('cache', 'templates'))
+
+    # the environment is kept between builds, templates are looked up again
+    tmpl_env = generate.tmpl_env
+    generate._prepare_templates()
+    assert generate.tmpl_env is tmpl_env
+
+    # a fresh environment loads compiled templates from the bytecode cache
+    generate = Generate()
+    generate.prj_path = os.path.abspath('blgr')
+    generate.config = {'templates': {'paths': [template_path]}, 'cache': {'path': 'cache/'}}
+    with mock.patch.object(jinja2.Environment, 'compile') as mock_compile:
+        generate._prepare_templates()
+    assert not mock_compile.called
+
+    shutil.rmtree(template_path)
+    shutil.rmtree('cache/')
+
+
 def test_out_path():
     generate = Generate()
     conf = {'output': {'path': './output'}}
@@ -35,12 +77,77 @@ def test_out_path():
 
     generate._generate_out_path()
     assert os.path.exists(generate.out_path)
-    shutil.rmtree(generate.out_path)
-
-    os.makedirs(generate.out_path)
+    assert generate.out_path.startswith(os.path.join('output.generations', ''))
+    assert generate.out_path.endswith('.staging')
+    assert not os.path.exists('output')
+
+    # a staging dir left by a build that died is cleaned up, the ones of
+    # builds still running are not
+    dead = subprocess.Popen([sys.executable, '-c', ''])
+    dead.wait()
+    stale_staging = generate.out_path
+    dead_staging = os.path.join('output.generations', '1.{}.staging'.format(dead.pid))
+    running_staging = os.path.join('output.generations', '2.{}.staging'.format(os.getppid()))
+    for path in (dead_staging, running_staging, os.path.join('output.generations', '3.staging')):
+        os.makedirs(path)
     generate._generate_out_path()
-    assert os.path.exists(generate.out_path)
-    shutil.rmtree(generate.out_path)
+    assert sorted(os.listdir('output.generations')) == sorted([os.path.basename(generate.out_path),
+                                                              os.path.basename(running_staging)])
+    assert generate.out_path != stale_staging
+    assert generate.out_path.endswith('.{}.staging'.format(os.getpid()))
+    shutil.rmtree('output.generations')
+
+
+def test_publish():
+    generate = Generate()
+    generate.config = {'output': {'path': './output', 'generations': 2}}
+    generate.cli_args = {'incremental': True}
+
+    # an old style output dir is kept as the previous generation
+    os.makedirs('output')
+    with open(os.path.join('output', 'kept.html'), 'w') as kept:
+        kept.write('kept')
+    generations = []
+    for i in range(3):
+        generate._generate_out_path()
+        # incremental builds start from hardlinks of the published files
+        kept_path = os.path.join(generate.out_path, 'kept.html')
+        assert os.stat(kept_path).st_ino == os.stat(os.path.join('output', 'kept.html')).st_ino
+        with open(os.path.join(generate.out_path, 'index.html'), 'w') as indx:
+            indx.write(str(i))
+        generate._publish()
+        generations.append(generate.generation)
+
+        assert os.path.islink('output')
+        assert os.path.realpath('output') == os.path.realpath(os.path.join('output.generations', generations[-1]))
+        with open(os.path.join('output', 'index.html'), 'r') as indx:
+            assert indx.read() == str(i)
+    assert sorted(os.listdir('output.generations')) == generations[-2:]
+
+    os.remove('output')
+    shutil.rmtree('output.generations')
+
+
+def test_rollback():
+    os.makedirs(os.path.join('output.generations', '1'))
+    os.makedirs(os.path.join('output.generations', '2'))
+    os.symlink(os.path.join('output.generations', '2'), 'output')
+
+    rollback = Rollback()
+    rollback.config = {'output': {'path': 'output'}}
+    rollback.cli_args = {}
+    rollback.prepare()
+    assert rollback.current == '2'
+    rollback.execute()
+    assert os.path.realpath('output') == os.path.realpath(os.path.join('output.generations', '1'))
+
+    rollback.cli_args = {'generation': '2'}
+    rollback.prepare()
+    rollback.execute()
+    assert os.path.realpath('output') == os.path.realpath(os.path.join('output.generations', '2'))
+
+    os.remove('output')
+    shutil.rmtree('output.generations')
 
 
 def test_posts_dict():
@@ -71,6 +178,212 @@ def test_posts_dict():
     shutil.rmtree(conf['posts']['path'])
 
 
+def test_meta_index():
+    posts_path = 'posts/'
+    post_path = os.path.join(posts_path, 'post1')
+    os.makedirs(post_path)
+    with open(os.path.join(post_path, 'meta.json'), 'w') as meta_file:
+        json.dump({'slug': 'post1'}, meta_file)
+    with open(os.path.join(post_path, 'post1.ipynb'), 'w') as nb:
+        nb.write('{}')
+
+    meta_index = MetaIndex('cache/meta.sqlite')
+    posts, notebooks = meta_index.refresh(posts_path)
+    assert posts == {post_path: {'slug': 'post1'}}
+    assert notebooks == {post_path: 'post1.ipynb'}
+    meta_index.close()
+
+    # nothing changed - a fresh index over the same database reads no meta.json
+    meta_index = MetaIndex('cache/meta.sqlite')
+    with mock.patch('blgr.blgr.open', create=True) as mock_open:
+        assert meta_index.refresh(posts_path) == (posts, notebooks)
+    assert not mock_open.called
+
+    # changed meta is re-read, removed posts are dropped
+    with open(os.path.join(post_path, 'meta.json'), 'w') as meta_file:
+        json.dump({'slug': 'post1', 'title': 'changed'}, meta_file)
+    posts, _ = meta_index.refresh(posts_path)
+    assert posts[post_path]['title'] == 'changed'
+
+    shutil.rmtree(post_path)
+    assert meta_index.refresh(posts_path) == ({}, {})
+    assert meta_index.db.execute('SELECT COUNT(*) FROM posts').fetchone()[0] == 0
+    meta_index.close()
+
+    shutil.rmtree(posts_path)
+    shutil.rmtree('cache/')
+
+
+def test_meta_index_order():
+    paths = _write_posts('posts/', {'a': {'slug': 'a'}, 'b': {'slug': 'b'}})
+    meta_index = MetaIndex(':memory:')
+    assert list(meta_index.refresh('posts/')[0]) == [paths['a'], paths['b']]
+
+    # re-reading a post replaces its row, which does not move it
+    with open(os.path.join(paths['a'], 'meta.json'), 'w') as meta_file:
+        json.dump({'slug': 'a', 'title': 'changed'}, meta_file)
+    os.utime(os.path.join(paths['a'], 'meta.json'), (1, 1))
+    posts, notebooks = meta_index.refresh('posts/')
+    assert posts[paths['a']]['title'] == 'changed'
+    assert list(posts) == [paths['a'], paths['b']]
+    assert list(notebooks) == [paths['a'], paths['b']]
+    meta_index.close()
+
+    shutil.rmtree('posts/')
+
+
+def test_meta_index_search_terms():
+    meta_index = MetaIndex('cache/meta.sqlite')
+    other = MetaIndex('cache/meta.sqlite')
+    meta_index.store_search_terms('posts/1', 'h1', {'one': 1})
+    meta_index.store_search_terms('posts/2', 'h2', {'two': 2})
+    # buffered until the batch is flushed
+    assert other.search_terms('posts/1', 'h1') is None
+
+    meta_index.flush_search_terms()
+    assert other.search_terms('posts/1', 'h1') == {'one': 1}
+    assert other.search_terms('posts/2', 'h2') == {'two': 2}
+    assert other.search_terms('posts/2', 'h1') is None
+
+    # whatever is still buffered is written on close
+    meta_index.store_search_terms('posts/3', 'h3', {'three': 3})
+    meta_index.close()
+    assert other.search_terms('posts/3', 'h3') == {'three': 3}
+    other.close()
+
+    shutil.rmtree('cache/')
+
+
+def _write_posts(posts_path, metas):
+    for name, meta in metas.items():
+        post_path = os.path.join(posts_path, name)
+        os.makedirs(post_path)
+        with open(os.path.join(post_path, 'meta.json'), 'w') as meta_file:
+            json.dump(meta, meta_file)
+        with open(os.path.join(post_path, name + '.ipynb'), 'w') as nb:
+            nb.write('{}')
+    return {name: os.path.join(posts_path, name) for name in metas}
+
+
+ARCHIVE_METAS = {
+    'a': {'slug': 'a', 'dt': '2015-03-22T10:00:00', 'category': 'x'},
+    'b': {'slug': 'b', 'dt': '2015-03-22T09:00:00.500000'},
+    'c': {'slug': 'c', 'dt': '2014-12-31T23:00:00.000001', 'category': 'x'},
+    'p': {'slug': 'p', 'dt': 'whenever', 'set_link': True},
+}
+
+
+def test_meta_index_archive():
+    posts_path = 'posts/'
+    paths = _write_posts(posts_path, ARCHIVE_METAS)
+
+    meta_index = MetaIndex('')
+    meta_index.update(posts_path)
+    assert list(meta_index.archive_entries()) == [(datetime.datetime(2014, 12, 31, 23, 0, 0, 1), paths['c']),
+                                                  (datetime.datetime(2015, 3, 22, 9, 0, 0, 500000), paths['b']),
+                                                  (datetime.datetime(2015, 3, 22, 10), paths['a'])]
+    assert meta_index.archive_pages() == [paths['p']]
+    assert meta_index.archive_undated() == []
+    assert list(meta_index.archive_periods()) == [(2014,), (2014, 12), (2014, 12, 31),
+                                                  (2015,), (2015, 3), (2015, 3, 22)]
+    assert meta_index.archive_categories() == ['uncategorized', 'x']
+
+    posts = meta_index.archive_posts(datetime.datetime(2015, 1, 1), datetime.datetime(2016, 1, 1))
+    assert len(posts) == 2
+    assert [pd['url'] for pd in posts] == ['/2015/3/22/a/', '/2015/3/22/b/']
+    assert [pd['slug'] for pd in meta_index.archive_posts(category='x')] == ['a', 'c']
+
+    view = meta_index.view('meta')
+    assert view[paths['a']] == ARCHIVE_METAS['a']
+    assert paths['a'] in view
+    assert 'missing' not in view
+    assert view.get('missing') is None
+    assert sorted(view) == sorted(paths.values())
+    assert len(view) == 4
+    assert meta_index.view('notebook')[paths['a']] == 'a.ipynb'
+
+    shutil.rmtree(paths['c'])
+    meta_index.update(posts_path)
+    assert [pp for _, pp in meta_index.archive_entries()] == [paths['b'], paths['a']]
+    meta_index.close()
+
+    shutil.rmtree(posts_path)
+
+
+def test_spill():
+    spill = Spill(('term', 'doc'))
+    spill.append(('b', 1))
+    spill.extend([('a', 2), ('a', 1)])
+    assert list(spill.sorted()) == [('a', 1), ('a', 2), ('b', 1)]
+    spill.close()
+
+
+def test_stream_indexes():
+    posts_path = 'posts/'
+    _write_posts(posts_path, ARCHIVE_METAS)
+    generate = Generate()
+    generate.cli_args = {'stream': True}
+    generate.config = {'posts': {'path': posts_path}, 'output': {'page_size': 1}}
+    generate.out_path = 'output/'
+    os.makedirs(generate.out_path)
+    generate.menu_pages = []
+    generate._generate_posts_dict()
+    generate._generate_pages_dts()
+    assert generate.pages == [os.path.join(posts_path, 'p')]
+
+    with mock.patch.object(generate, '_render_index_page') as mock_page:
+        generate._generate_indexes()
+    rendered = {os.path.relpath(c[0][0], generate.out_path): [pd['slug'] for pd in c[0][1]['posts']]
+                for c in mock_page.call_args_list}
+    assert rendered[os.path.join('2015', 'index.html')] == ['a']
+    assert rendered[os.path.join('2015', 'page', '2', 'index.html')] == ['b']
+    assert rendered[os.path.join('2014', '12', '31', 'index.html')] == ['c']
+    assert rendered[os.path.join('x', 'page', '2', 'index.html')] == ['c']
+    assert [rendered['index.html']] + [rendered[os.path.join('page', str(n), 'index.html')] for n in (2, 3)] == [
+        ['a'], ['b'], ['c']]
+    assert len(rendered) == 9 + 3 + 2 + 1  # years/months/days, main, x, uncategorized
+
+    shutil.rmtree(posts_path)
+    shutil.rmtree(generate.out_path)
+
+
+def test_stream_indexes_match():
+    # posts with the same date are listed in the same order with and without --stream
+    posts_path = 'posts/'
+    metas = dict(ARCHIVE_METAS, d={'slug': 'd', 'dt': '2015-03-22T10:00:00'},
+                 e={'slug': 'e', 'dt': '2015-03-22T10:00:00', 'category': 'x'},
+                 f={'slug': 'f', 'dt': '2015-03-22T11:00:00Z'}, g={'slug': 'g', 'dt': '2015-03-22T11:00:00.5'})
+    metas = {name: dict({'set_link': False, 'comments': False}, **meta) for name, meta in metas.items()}
+    _write_posts(posts_path, metas)
+    rendered = {}
+    for stream in (False, True):
+        generate = Generate()
+        generate.cli_args = {'stream': stream}
+        generate.config = {'posts': {'path': posts_path}, 'output': {'page_size': 2}}
+        generate.out_path = 'output/'
+        os.makedirs(generate.out_path)
+        generate.menu_pages = []
+        generate.prj_path = os.path.abspath('blgr')
+        generate.manifest = {'global': None, 'sources': {}, 'indexes': {}}
+        generate._generate_posts_dict()
+        generate._generate_pages_dts()
+        with mock.patch.object(generate, '_convert_source'), mock.patch.object(generate, '_run_conversions'):
+            generate._generate_posts()
+        with mock.patch.object(generate, '_render_index_page') as mock_page:
+            generate._generate_indexes()
+        rendered[stream] = {os.path.relpath(c[0][0], generate.out_path): [pd['slug'] for pd in c[0][1]['posts']]
+                            for c in mock_page.call_args_list}
+        shutil.rmtree(generate.out_path)
+
+    assert rendered[True] == rendered[False]
+    # newest first by the parsed date, not by the dt string
+    assert rendered[True]['index.html'] == ['g', 'f']
+    assert rendered[True][os.path.join('page', '2', 'index.html')] == ['e', 'd']
+    assert rendered[True][os.path.join('page', '3', 'index.html')] == ['a', 'b']
+
+    shutil.rmtree(posts_path)
+
+
 def test_pages_dts():
     generate = Generate()
 
@@ -101,14 +414,42 @@ def test_pages_dts():
     assert 'fake_path3' in generate.pages
 
     # for we don't include page in dts dt3 is not in generate.dts
-    assert dt1.year in generate.dts
-    assert dt2.year in generate.dts
-    assert dt1.month in generate.dts[dt1.year]
-    assert dt2.month in generate.dts[dt2.year]
-    assert dt1.day in generate.dts[dt1.year][dt1.month]
-    assert dt2.day in generate.dts[dt2.year][dt2.month]
-    assert 'fake_path1' in generate.dts[dt1.year][dt1.month][dt1.day]
-    assert 'fake_path2' in generate.dts[dt2.year][dt2.month][dt2.day]
+    assert generate.dts.posts == ['fake_path2', 'fake_path1']
+    assert generate.dts.dts == [dt2, dt1]
+    assert generate.dts.period((dt1.year, dt1.month, dt1.day)) == (1, 2)
+    assert generate.dts.period((dt2.year,)) == (0, 1)
+
+
+def test_pages_dts_formats():
+    generate = Generate()
+    generate.posts = {
+        'fake_path1': {'dt': '2015-03-22T10:00:00', 'set_link': False},
+        'fake_path2': {'dt': '2015-03-22T09:00:00.500000', 'set_link': False},
+        'fake_path3': {'dt': '2015-03-21T23:30:00+03:00', 'set_link': False},
+    }
+
+    generate._generate_pages_dts()
+
+    assert generate.dts.posts == ['fake_path3', 'fake_path2', 'fake_path1']
+    assert generate.dts.dts[0] == datetime.datetime(2015, 3, 21, 23, 30)
+
+
+def test_archive():
+    dts = [datetime.datetime(2014, 12, 31, 23), datetime.datetime(2015, 1, 1),
+           datetime.datetime(2015, 1, 1, 5), datetime.datetime(2015, 2, 1), datetime.datetime(2016, 1, 1)]
+    archive = Archive(zip(reversed(dts), 'edcba'))
+
+    assert archive.dts == dts
+    assert archive.posts == list('abcde')
+    assert archive.period((2015,)) == (1, 4)
+    assert archive.period((2015, 1)) == (1, 3)
+    assert archive.period((2014, 12)) == (0, 1)
+    assert archive.period((2015, 1, 2)) == (3, 3)
+    assert list(archive.groups()) == [
+        ((2014,), 0, 1), ((2014, 12), 0, 1), ((2014, 12, 31), 0, 1),
+        ((2015,), 1, 4), ((2015, 1), 1, 3), ((2015, 1, 1), 1, 3), ((2015, 2), 3, 4), ((2015, 2, 1), 3, 4),
+        ((2016,), 4, 5), ((2016, 1), 4, 5), ((2016, 1, 1), 4, 5),
+    ]
 
 
 def test_main_index():
@@ -120,9 +461,10 @@ def test_main_index():
     with open(os.path.join(template_path, 'index.html'), 'w') as main_index_template:
         main_index_template.write('{{header}}-{{posts}}-{{pages}}')
 
-    fake_vars = {'header': 'fake_header', 'posts': 'fake_posts', 'pages': 'fake_pages'}
+    fake_vars = {'header': 'fake_header', 'posts': [{'slug': 'fake_post'}], 'pages': 'fake_pages'}
 
     generate = Generate()
+    generate.config = {}
     generate.out_path = out_path
     jloader = jinja2.FileSystemLoader(searchpath=template_path)
     generate.tmpl_env = jinja2.Environment(loader=jloader)
@@ -141,6 +483,58 @@ def test_main_index():
         shutil.rmtree(out_path)
 
 
+def test_paginated_index():
+    template_path = 'templates/'
+    os.makedirs(template_path)
+    with open(os.path.join(template_path, 'index.html'), 'w') as index_template:
+        index_template.write("{% for post in posts %}{{post['slug']}}{% endfor %}"
+                             "|{{pagination['prev']}}|{{pagination['next']}}")
+
+    output_path = 'output/'
+    cat_path = os.path.join(output_path, 'cat')
+    os.makedirs(cat_path)
+    fake_posts = [{'slug': str(day), 'dt': '2015-03-0{}T10:00:00'.format(day)} for day in range(1, 6)]
+
+    generate = Generate()
+    generate.config = {'output': {'page_size': 2}}
+    generate.out_path = output_path
+    jloader = jinja2.FileSystemLoader(searchpath=template_path)
+    generate.tmpl_env = jinja2.Environment(loader=jloader)
+
+    generate._render_index(cat_path, fake_posts, {'header': 'cat'})
+
+    def read(*path):
+        with open(os.path.join(cat_path, *path), 'r') as indx:
+            return indx.read()
+
+    # newest first, split into pages of two
+    assert read('index.html') == '54|None|/cat/page/2/'
+    assert read('page', '2', 'index.html') == '32|/cat/|/cat/page/3/'
+    assert read('page', '3', 'index.html') == '1|/cat/page/2/|None'
+    assert sorted(generate.manifest['indexes']) == [os.path.join('cat', 'index.html'),
+                                                    os.path.join('cat', 'page', '2', 'index.html'),
+                                                    os.path.join('cat', 'page', '3', 'index.html')]
+
+    # an older post does not touch the first page
+    generate.prev_manifest = generate.manifest
+    generate.manifest = {'global': None, 'indexes': {}}
+    fake_posts.append({'slug': '0', 'dt': '2015-02-28T10:00:00'})
+    with mock.patch.object(generate, '_get_template', wraps=generate._get_template) as mock_tmpl:
+        generate._render_index(cat_path, fake_posts, {'header': 'cat'})
+    assert mock_tmpl.call_count == 1
+    assert read('page', '3', 'index.html') == '10|/cat/page/2/|None'
+
+    # the main index lives at the root of the site
+    generate._render_index(output_path, fake_posts, {'header': 'main'})
+    with open(os.path.join(output_path, 'index.html'), 'r') as indx:
+        assert indx.read() == '54|None|/page/2/'
+    with open(os.path.join(output_path, 'page', '2', 'index.html'), 'r') as indx:
+        assert indx.read() == '32|/|/page/3/'
+
+    shutil.rmtree(template_path)
+    shutil.rmtree(output_path)
+
+
 def test_pages():
     generate = Generate()
 
@@ -174,10 +568,10 @@ def test_pages():
         with open(os.path.join(path, 'fake_post.ipynb'), 'w') as fake_post:
             fake_post.write('fake_data')
 
-    with mock.patch.object(generate, '_process_ipynb') as mock_ipynb:
+    with mock.patch.object(generate, '_convert_source') as mock_convert:
         generate._generate_pages()
 
-    mock_ipynb.assert_called()
+    mock_convert.assert_called()
 
     if os.path.exists(generate.out_path):
         shutil.rmtree(generate.out_path)
@@ -222,6 +616,7 @@ def test_menu():
     fake_pages = [k for k in fake_posts]
 
     generate = Generate()
+    generate.config = {}
     generate.posts = fake_posts
     generate.pages = fake_pages
 
@@ -239,6 +634,22 @@ def test_menu():
         shutil.rmtree(template_path)
 
 
+def test_menu_search_link():
+    generate = Generate()
+    generate.config = {}
+    generate.posts = {}
+    generate.pages = []
+    generate.prj_path = os.path.abspath('blgr')
+    generate._prepare_templates()
+
+    generate._generate_menu()
+    assert '/search/' in generate.menu
+
+    generate.config = {'search': {'enabled': False}}
+    generate._generate_menu()
+    assert '/search/' not in generate.menu
+
+
 def test_year_index():
     template_path = 'templates/'
     os.makedirs(template_path)
@@ -257,6 +668,8 @@ def test_year_index():
     ]
 
     generate = Generate()
+    generate.config = {}
+    generate.out_path = output_path
     jloader = jinja2.FileSystemLoader(searchpath=template_path)
     generate.tmpl_env = jinja2.Environment(loader=jloader)
 
@@ -297,6 +710,8 @@ def test_month_index():
     ]
 
     generate = Generate()
+    generate.config = {}
+    generate.out_path = output_path
     jloader = jinja2.FileSystemLoader(searchpath=template_path)
     generate.tmpl_env = jinja2.Environment(loader=jloader)
 
@@ -338,6 +753,8 @@ def test_day_index():
     ]
 
     generate = Generate()
+    generate.config = {}
+    generate.out_path = output_path
     jloader = jinja2.FileSystemLoader(searchpath=template_path)
     generate.tmpl_env = jinja2.Environment(loader=jloader)
 
@@ -377,6 +794,8 @@ def test_category_index():
     ]
 
     generate = Generate()
+    generate.config = {}
+    generate.out_path = output_path
     jloader = jinja2.FileSystemLoader(searchpath=template_path)
     generate.tmpl_env = jinja2.Environment(loader=jloader)
 
@@ -403,6 +822,7 @@ def test_generate_categories():
     config = {'output': {'path': 'output/'}}
     os.makedirs(config['output']['path'])
     generate.config = config
+    generate.out_path = config['output']['path']
     categories = {'fake_cat1': None, 'fake_cat2': None, 'fake_cat3': None}
     cats = (os.path.join(config['output']['path'], cat) for cat in categories)
 
@@ -420,10 +840,12 @@ def test_generate_categories():
 
 def test_process_ipynb():
     generate = Generate()
+    generate.config = {}
     generate.prj_path = os.path.dirname(os.path.abspath(__file__))
 
     out_path = os.path.join(generate.prj_path, 'output/')
     os.makedirs(out_path)
+    generate.out_path = out_path
     posts_path = os.path.join(generate.prj_path, 'post/')
     os.makedirs(posts_path)
     post_path = os.path.join(posts_path, 'post.ipynb')
@@ -444,11 +866,15 @@ def test_process_ipynb():
     with open(post_path, 'w') as post:
         json.dump(ipynb, post)
 
-    with mock.patch.object(generate, '_append_html') as mock_append_html:
+    generate.menu = '<div id="menu"></div>'
+    generate.comments = ''
+    with mock.patch.object(generate, '_append_html', wraps=generate._append_html) as mock_append_html:
         generate._process_ipynb(out_path, post_path, True)
-    mock_append_html.assert_called_once_with(os.path.join(out_path, 'index.html'), True)
+    mock_append_html.assert_called_once_with(os.path.join(out_path, 'index.html'), True,
+                                             os.path.join(out_path, 'index.html.raw.tmp'))
 
-    assert os.path.exists(os.path.join(out_path, 'index.html'))
+    # the nbconvert css and js go to shared assets
+    assert sorted(os.listdir(out_path)) == ['assets', 'index.html']
 
     if os.path.exists(out_path):
         shutil.rmtree(out_path)
@@ -456,8 +882,67 @@ def test_process_ipynb():
         shutil.rmtree(posts_path)
 
 
+def test_process_ipynb_cached():
+    generate = Generate()
+    generate.config = {'cache': {'path': 'cache/'}}
+    out_path = 'output/'
+    os.makedirs(out_path)
+    post_path = 'post.ipynb'
+    with open(post_path, 'w') as post:
+        post.write('{}')
+
+    converter = mock.Mock()
+    converter.version.return_value = 'v1'
+    converter.convert.side_effect = lambda src, dst: open(dst, 'w').write('converted')
+    generate.converter = converter
+    generate.menu = ''
+
+    generate._process_ipynb(out_path, post_path)
+    os.remove(os.path.join(out_path, 'index.html'))
+    generate._process_ipynb(out_path, post_path)
+
+    # second run is served from the cache
+    converter.convert.assert_called_once_with(post_path, os.path.join(out_path, 'index.html.raw.tmp'))
+    with open(os.path.join(out_path, 'index.html'), 'r') as indx:
+        assert indx.read() == 'converted'
+
+    shutil.rmtree('cache/')
+    shutil.rmtree(out_path)
+    os.remove(post_path)
+
+
+def test_get_converter():
+    generate = Generate()
+    generate.config = {'converter': {'backend': 'subprocess'}}
+    converter = generate._get_converter()
+    assert isinstance(converter, SubprocessConverter)
+    assert generate._get_converter() is converter  # created once, then reused
+
+    generate = Generate()
+    generate.config = {}
+    assert isinstance(generate._get_converter(), InProcessConverter)
+
+
+def test_subprocess_converter():
+    out_path = 'output/'
+    os.makedirs(out_path)
+    with open(os.path.join(out_path, 'post.html'), 'w') as produced:
+        produced.write('converted')
+
+    converter = SubprocessConverter()
+    with mock.patch('subprocess.check_call') as mock_call:
+        converter.convert('posts/post.ipynb', os.path.join(out_path, 'index.html'))
+
+    mock_call.assert_called_once_with(['ipython', 'nbconvert', '--to', 'html', os.path.abspath('posts/post.ipynb')],
+                                      cwd='output')
+    assert os.listdir(out_path) == ['index.html']
+
+    shutil.rmtree(out_path)
+
+
 def test_append_html():
     generate = Generate()
+    generate.config = {}
     fake_comments = 'fake_comments'
     comments = '<div id="fake_comments">%s</div>' % fake_comments
     fake_menu = 'fake_menu'
@@ -496,6 +981,95 @@ def test_append_html():
         shutil.rmtree(out_path)
 
 
+def test_page_decorator():
+    out = io.StringIO()
+    page = ('<!DOCTYPE html><html><head><script>var s = "<div>";</script></head>'
+            '<body class="nb"><div id="notebook-container"><div>&amp;&#62;<br/></div><!-- c --></div>'
+            '<div>after</div></body></html>')
+    decorator = PageDecorator(out, '<nav>menu</nav>', '<div id="c">comments</div>')
+    # feed in small chunks to make sure tags split across reads survive
+    for i in range(0, len(page), 7):
+        decorator.feed(page[i:i + 7])
+    decorator.close()
+
+    assert out.getvalue() == page.replace('<body class="nb">', '<body class="nb"><nav>menu</nav>').replace(
+        '<!-- c --></div>', '<!-- c --><div id="c">comments</div></div>')
+
+    # preview builds get the live reload script at the end of body
+    out = io.StringIO()
+    decorator = PageDecorator(out, 'menu', None, '<script></script>')
+    decorator.feed('<html><body><main></main></body></html>')
+    decorator.close()
+    assert out.getvalue() == '<html><body>menu<main></main><script></script></body></html>'
+
+    # no container in the page - comments go to the end of body
+    out = io.StringIO()
+    decorator = PageDecorator(out, 'menu', 'comments')
+    decorator.feed('<html><body><main></main></body></html>')
+    decorator.close()
+    assert out.getvalue() == '<html><body>menu<main></main>comments</body></html>'
+
+
+def test_page_decorator_images():
+    out_path = 'output/'
+    assets = AssetStore(out_path)
+    png = base64.b64encode(b'png bytes').decode('ascii')
+    page = ('<html><body><img src="data:image/png;base64,{0}" alt="a &amp; b">'
+            '<img src="data:image/png;base64,{0}"/><img src="/logo.gif"></body></html>').format(png)
+    out = io.StringIO()
+    decorator = PageDecorator(out, '', assets=assets)
+    decorator.feed(page)
+    decorator.close()
+
+    name = hashlib.sha1(b'png bytes').hexdigest() + '.png'
+    # the same image is stored once and every page references the file
+    assert os.listdir(os.path.join(out_path, 'assets')) == [name]
+    assert decorator.extracted == ['assets/' + name] * 2
+    assert out.getvalue() == ('<html><body><img src="/assets/{0}" alt="a &amp; b" loading="lazy">'
+                              '<img src="/assets/{0}" loading="lazy"><img src="/logo.gif"></body></html>').format(name)
+    with open(os.path.join(out_path, 'assets', name), 'rb') as asset:
+        assert asset.read() == b'png bytes'
+
+    shutil.rmtree(out_path)
+
+
+def test_page_decorator_boilerplate():
+    out_path = 'output/'
+    assets = AssetStore(out_path)
+    page = ('<html><head><title>t</title><style type="text/css">a {}</style><script>var a = "</div>";</script>'
+            '<script type="text/x-mathjax-config">config()</script><style>b {}</style></head>'
+            '<body><style>c {}</style></body></html>')
+    out = io.StringIO()
+    decorator = PageDecorator(out, 'menu', assets=assets)
+    for i in range(0, len(page), 5):
+        decorator.feed(page[i:i + 5])
+    decorator.close()
+
+    css = 'assets/' + hashlib.sha1(b'a {}\nb {}').hexdigest() + '.css'
+    js = 'assets/' + hashlib.sha1(b'var a = "</div>";').hexdigest() + '.js'
+    # every style of <head> goes to one stylesheet where the first one was,
+    # inline styles of the body stay where they are
+    assert out.getvalue() == ('<html><head><title>t</title><link rel="stylesheet" href="/{}">'
+                              '<script src="/{}"></script><script type="text/x-mathjax-config">config()</script>'
+                              '</head><body>menu<style>c {{}}</style></body></html>').format(css, js)
+    assert sorted(decorator.extracted) == sorted([css, js])
+    with open(os.path.join(out_path, css), 'r') as css_file:
+        assert css_file.read() == 'a {}\nb {}'
+
+    shutil.rmtree(out_path)
+
+
+def test_run_conversions_assets():
+    generate = Generate()
+    generate.cli_args = {'jobs': 1}
+    generate.out_path = 'output/'
+    generate.manifest['sources'] = {'post': {'hash': 'h', 'outputs': ['slug/index.html']}}
+    generate.conversions = [(os.path.join(generate.out_path, 'slug'), 'post.ipynb', False, 'post')]
+    with mock.patch.object(generate, '_process_ipynb', return_value=['assets/b.png', 'assets/a.png', 'assets/b.png']):
+        generate._run_conversions()
+    assert generate.manifest['sources']['post']['outputs'] == ['slug/index.html', 'assets/a.png', 'assets/b.png']
+
+
 def test_generate_post():
     generate = Generate()
 
@@ -537,22 +1111,22 @@ def test_generate_post():
     generate.posts = fake_posts
     generate.prj_path = fake_prj_path
 
-    with mock.patch.object(generate, '_process_ipynb') as mock_process_ipynb:
+    with mock.patch.object(generate, '_convert_source') as mock_convert:
         pd = generate._generate_post(fake_post1, fake_day_path, fake_categories, **fake_date)
 
-    mock_process_ipynb.assert_called_once_with(os.path.join(fake_day_path, fake_slug),
-                                               os.path.join(fake_prj_path, fake_post1, 'test.ipynb'),
-                                               False)
+    mock_convert.assert_called_once_with(fake_post1, os.path.join(fake_day_path, fake_slug),
+                                         os.path.join(fake_prj_path, fake_post1, 'test.ipynb'),
+                                         False)
     assert pd['url'] == '/{}/{}/{}/{}/'.format(fake_date['year'], fake_date['month'],
                                                fake_date['day'], fake_slug)
     assert fake_category in fake_categories.keys()
 
-    with mock.patch.object(generate, '_process_ipynb') as mock_process_ipynb:
+    with mock.patch.object(generate, '_convert_source') as mock_convert:
         pd = generate._generate_post(fake_post2, fake_day_path, fake_categories, **fake_date)
 
-    mock_process_ipynb.assert_called_once_with(os.path.join(fake_day_path, fake_slug),
-                                               os.path.join(fake_prj_path, fake_post2, 'test.ipynb'),
-                                               True)
+    mock_convert.assert_called_once_with(fake_post2, os.path.join(fake_day_path, fake_slug),
+                                         os.path.join(fake_prj_path, fake_post2, 'test.ipynb'),
+                                         True)
     assert pd['url'] == '/{}/{}/{}/{}/'.format(fake_date['year'], fake_date['month'],
                                                fake_date['day'], fake_slug)
     assert 'uncategorized' in fake_categories.keys()
@@ -567,75 +1141,551 @@ def test_generate_post():
 
 def test_generate_posts():
     fake_out_path = 'output/'
-    fake_dts = {
-        2014: {
-            1: {
-                1: {
-                    'fake_post': {}
-                }
-            },
-            2: {
-                1: {
-                    'fake_post': {}
-                },
-                2: {
-                    'fake_post': {}
-                }
-            },
-        },
-        2015: {
-            1: {
-                1: {
-                    'fake_post': {}
-                }
-            }
-        }
-    }
+    days = [(2014, 1, 1), (2014, 2, 1), (2014, 2, 1), (2014, 2, 2), (2015, 1, 1)]
+    fake_dts = Archive((datetime.datetime(*day, hour), 'fake_post%d' % hour) for hour, day in enumerate(days))
 
     generate = Generate()
     generate.out_path = fake_out_path
     generate.dts = fake_dts
 
-    with mock.patch.object(generate, '_generate_post') as mock_gen_post:
-        with mock.patch.object(generate, '_generate_day_index') as mock_gen_day_index:
-            with mock.patch.object(generate, '_generate_month_index') as mock_gen_month_index:
-                with mock.patch.object(generate, '_generate_year_index') as mock_gen_year_index:
-                    with mock.patch.object(generate, '_generate_categories') as mock_gen_categories:
-                        with mock.patch.object(generate, '_generate_main_index') as mock_gen_main_index:
-                            generate._generate_posts()
+    with mock.patch.object(generate, '_generate_post', side_effect=lambda post, *args: post) as mock_gen_post:
+        generate._generate_posts()
 
     mock_gen_post.assert_called()
-    mock_gen_day_index.assert_called()
-    mock_gen_month_index.assert_called()
-    mock_gen_year_index.assert_called()
-    mock_gen_categories.assert_called()
-    mock_gen_main_index.assert_called()
-
-    years = os.listdir(fake_out_path)
-    for year in fake_dts:
-        assert str(year) in years
-        year_path = os.path.join(fake_out_path, str(year))
-        months = os.listdir(year_path)
-        for month in fake_dts[year]:
-            assert str(month) in months
-            month_path = os.path.join(year_path, str(month))
-            days = os.listdir(month_path)
-            for day in fake_dts[year][month]:
-                assert str(day) in days
+    assert generate.all_posts == ['fake_post0', 'fake_post1', 'fake_post2', 'fake_post3', 'fake_post4']
+    groups = {key: generate.all_posts[lo:hi] for key, lo, hi in fake_dts.groups()}
+    assert len(groups[(2014,)]) == 4
+    assert len(groups[(2014, 2)]) == 3
+    assert len(groups[(2014, 2, 1)]) == 2
+
+    for year, month, day in days:
+        assert os.path.isdir(os.path.join(fake_out_path, str(year), str(month), str(day)))
 
     if os.path.exists(fake_out_path):
         shutil.rmtree(fake_out_path)
 
 
+def test_generate_indexes():
+    generate = Generate()
+    generate.out_path = 'output/'
+    fake_post = {'slug': 'fake_slug'}
+    generate.all_posts = [fake_post]
+    generate.categories = {'fake_cat': [fake_post]}
+    generate.dts = Archive([(datetime.datetime(2015, 3, 22), 'fake_post')])
+
+    with mock.patch.object(generate, '_generate_day_index') as mock_day:
+        with mock.patch.object(generate, '_generate_month_index') as mock_month:
+            with mock.patch.object(generate, '_generate_year_index') as mock_year:
+                with mock.patch.object(generate, '_generate_categories') as mock_categories:
+                    with mock.patch.object(generate, '_generate_main_index') as mock_main:
+                        generate._generate_indexes()
+
+    mock_year.assert_called_once_with(os.path.join('output/', '2015'), [fake_post], 2015)
+    mock_month.assert_called_once_with(os.path.join('output/', '2015', '3'), [fake_post], (2015, 3))
+    mock_day.assert_called_once_with(os.path.join('output/', '2015', '3', '22'), [fake_post], (2015, 3, 22))
+    mock_categories.assert_called_once_with(generate.categories)
+    mock_main.assert_called_once_with([fake_post])
+
+
+def test_run_conversions():
+    generate = Generate()
+    jobs = [('out1', 'post1.ipynb', False, 'post1'), ('out2', 'post2.ipynb', True, 'post2')]
+
+    generate.conversions = list(jobs)
+    generate.cli_args = {'jobs': 1}
+    generate.profiler = Profiler()
+    with mock.patch.object(generate, '_process_ipynb') as mock_ipynb:
+        generate._run_conversions()
+    assert mock_ipynb.call_args_list == [mock.call(*job[:3]) for job in jobs]
+    assert generate.conversions == []
+    assert [c['source'] for c in generate.profiler.conversions] == ['post1.ipynb', 'post2.ipynb']
+
+    generate.conversions = list(jobs)
+    generate.cli_args = {'jobs': 4}
+    generate.config = {}
+    generate.prj_path = 'prj'
+    generate.menu = 'menu'
+    generate.comments = 'comments'
+    with mock.patch('concurrent.futures.ProcessPoolExecutor') as mock_pool:
+        generate._run_conversions()
+    mock_pool.assert_called_once_with(max_workers=2, initializer=blgr.blgr._init_worker,
+                                      initargs=(generate._worker_state(),))
+    mock_pool.return_value.__enter__.return_value.map.assert_called_once_with(blgr.blgr._run_worker, jobs)
+
+
+def test_compress_outputs():
+    generate = Generate()
+    generate.out_path = 'output/'
+    generate.config = {'output': {'path': generate.out_path, 'compress': ['gzip']}}
+    os.makedirs(os.path.join(generate.out_path, 'post'))
+    page = os.path.join(generate.out_path, 'post', 'index.html')
+    with open(page, 'w') as page_file:
+        page_file.write('page ' * 100)
+    with open(os.path.join(generate.out_path, 'image.png'), 'w') as image:
+        image.write('png')
+
+    assert generate._compress_outputs() == 1
+    with open(page + '.gz', 'rb') as gz:
+        assert gzip.decompress(gz.read()) == b'page ' * 100
+    assert not os.path.exists(os.path.join(generate.out_path, 'image.png.gz'))
+
+    # unchanged pages are not compressed again
+    assert generate._compress_outputs() == 0
+    os.utime(page, (1, 1))
+    assert generate._compress_outputs() == 1
+
+    shutil.rmtree(generate.out_path)
+
+
+def test_stale_compressed():
+    # generate -z, then generate -i without -z after the page changed
+    generate = Generate()
+    generate.config = {'output': {'path': './output', 'compress': ['gzip']}}
+    generate.cli_args = {'incremental': True}
+    generate._generate_out_path()
+    for name, content in (('index.html', 'old title'), ('about.html', 'about')):
+        generate._get_writer().write(os.path.join(generate.out_path, name), content)
+    assert generate._compress_outputs() == 2
+    generate._remove_stale_compressed()
+    assert sorted(os.listdir(generate.out_path)) == ['about.html', 'about.html.gz', 'index.html', 'index.html.gz']
+    generate._publish()
+
+    generate._generate_out_path()
+    generate._get_writer().write(os.path.join(generate.out_path, 'index.html'), 'new title')
+    generate._remove_stale_compressed()
+    # only the sibling of the rewritten page is dropped
+    assert sorted(os.listdir(generate.out_path)) == ['about.html', 'about.html.gz', 'index.html']
+    assert generate.writer.counts['deleted'] == 1
+    generate._publish()
+    with gzip.open(os.path.join('output', 'about.html.gz'), 'rb') as gz:
+        assert gz.read() == b'about'
+
+    os.remove('output')
+    shutil.rmtree('output.generations')
+
+
+def test_file_hashes():
+    generate = Generate()
+    generate.out_path = 'output/'
+    os.makedirs(generate.out_path)
+    page = os.path.join(generate.out_path, 'index.html')
+    with open(page, 'w') as page_file:
+        page_file.write('page')
+
+    generate._generate_file_hashes()
+    st = os.stat(page)
+    assert generate.manifest['files'] == {'index.html': [st.st_mtime_ns, st.st_size, hashlib.sha1(b'page').hexdigest()]}
+
+    # unchanged stat - the recorded hash is reused without reading the file
+    generate.prev_manifest = {'files': {'index.html': [st.st_mtime_ns, st.st_size, 'recorded']}}
+    generate._generate_file_hashes()
+    assert generate.manifest['files']['index.html'][2] == 'recorded'
+
+    shutil.rmtree(generate.out_path)
+
+
+def test_profiler_phase_peak():
+    profiler = Profiler()
+    with profiler.phase('big'):
+        data = b'x' * (64 * 1024 * 1024)
+        del data
+    with profiler.phase('small'):
+        pass
+    big, small = profiler.phases
+    if big['peak_rss'] is not None:
+        # the peak of an earlier phase is not reported again
+        assert small['peak_rss'] < big['peak_rss'] - 32 * 1024 * 1024
+
+
+def test_profiler():
+    profiler = Profiler()
+    with profiler.phase('scan'):
+        pass
+    profiler.record({'source': 'posts/slow', 'output': 'output/slow/index.html', 'pid': 1, 'start': 1.0,
+                     'wall': 2.0, 'cpu': 1.5, 'size': 4096})
+    profiler.record({'source': 'posts/fast', 'output': 'output/fast/index.html', 'pid': 2, 'start': 1.0,
+                     'wall': 0.5, 'cpu': 0.5, 'size': 1024})
+
+    assert profiler.phases[0]['name'] == 'scan'
+    assert profiler.phases[0]['peak_rss'] is None or profiler.phases[0]['peak_rss'] > 0
+    summary = profiler.summary(1)
+    assert 'posts/slow' in summary
+    assert 'posts/fast' not in summary
+
+    profiler.write('profile.json', 'profile.trace.json')
+    with open('profile.json', 'r') as report_file:
+        report = json.load(report_file)
+    assert [c['source'] for c in report['conversions']] == ['posts/slow', 'posts/fast']
+    with open('profile.trace.json', 'r') as trace_file:
+        trace = json.load(trace_file)
+    events = [e for e in trace['traceEvents'] if e['ph'] == 'X']
+    assert [e['cat'] for e in events] == ['phase', 'conversion', 'conversion']
+    assert events[1]['dur'] == 2000000
+
+    os.remove('profile.json')
+    os.remove('profile.trace.json')
+
+
+def test_execute_profiled():
+    generate = Generate()
+    generate.config = {}
+    generate.cli_args = {'profile': 'profile.json', 'profile_top': 3}
+    generate.profiler = Profiler()
+    steps = ('_generate_menu', '_generate_comments', '_generate_global_hash', '_generate_pages', '_generate_posts',
+             '_run_conversions', '_generate_indexes', '_generate_search', '_remove_stale', '_remove_stale_compressed',
+             '_generate_file_hashes', '_save_manifest', '_publish')
+    mocks = [mock.patch.object(generate, step) for step in steps]
+    for step_mock in mocks:
+        step_mock.start()
+    with mock.patch.object(generate.profiler, 'write') as mock_write:
+        generate.execute()
+    for step_mock in mocks:
+        step_mock.stop()
+
+    assert [p['name'] for p in generate.profiler.phases] == ['menu', 'comments', 'global hash', 'pages', 'posts',
+                                                             'conversions', 'indexes', 'search', 'stale',
+                                                             'stale compressed', 'file hashes', 'manifest', 'publish']
+    mock_write.assert_called_once_with('profile.json', 'profile.trace.json')
+
+
 def test_execute():
     generate = Generate()
+    generate.config = {}
     with mock.patch.object(generate, '_generate_menu') as mock_menu:
         with mock.patch.object(generate, '_generate_comments') as mock_comments:
-            with mock.patch.object(generate, '_generate_pages') as mock_pages:
-                with mock.patch.object(generate, '_generate_posts') as mock_posts:
-                    generate.execute()
+            with mock.patch.object(generate, '_generate_global_hash') as mock_global_hash:
+                with mock.patch.object(generate, '_generate_pages') as mock_pages:
+                    with mock.patch.object(generate, '_generate_posts') as mock_posts:
+                        with mock.patch.object(generate, '_run_conversions') as mock_conversions:
+                            with mock.patch.object(generate, '_generate_indexes') as mock_indexes, \
+                                    mock.patch.object(generate, '_generate_search') as mock_search:
+                                with mock.patch.object(generate, '_remove_stale') as mock_stale:
+                                    with mock.patch.object(generate, '_generate_file_hashes') as mock_hashes:
+                                        with mock.patch.object(generate, '_save_manifest') as mock_manifest:
+                                            with mock.patch.object(generate, '_publish') as mock_publish:
+                                                generate.execute()
 
     mock_menu.assert_called_once_with()
     mock_comments.assert_called_once_with()
+    mock_global_hash.assert_called_once_with()
     mock_pages.assert_called_once_with()
     mock_posts.assert_called_once_with()
+    mock_conversions.assert_called_once_with()
+    mock_indexes.assert_called_once_with()
+    mock_search.assert_called_once_with()
+    mock_stale.assert_called_once_with()
+    mock_hashes.assert_called_once_with()
+    mock_manifest.assert_called_once_with()
+    mock_publish.assert_called_once_with()
+
+
+def test_out_path_incremental():
+    generate = Generate()
+    generate.config = {'output': {'path': './output'}}
+    generate.cli_args = {'incremental': True}
+
+    os.makedirs(generate.config['output']['path'])
+    kept = os.path.join(generate.config['output']['path'], 'kept.html')
+    with open(kept, 'w') as kept_file:
+        kept_file.write('kept')
+    manifest = {'version': MANIFEST_VERSION, 'global': 'fake', 'sources': {}, 'indexes': {'kept.html': 'key'}}
+    with open(os.path.join(generate.config['output']['path'], MANIFEST_NAME), 'w') as mf:
+        json.dump(manifest, mf)
+
+    generate._generate_out_path()
+    assert os.path.exists(os.path.join(generate.out_path, 'kept.html'))
+    assert generate.prev_manifest == manifest
+    assert generate.manifest['indexes'] == {}
+
+    shutil.rmtree(generate.config['output']['path'])
+    shutil.rmtree('output.generations')
+
+
+def test_convert_source():
+    generate = Generate()
+    generate.out_path = 'output/'
+    post_path = 'post/'
+    slug_path = os.path.join(generate.out_path, 'slug')
+    os.makedirs(slug_path)
+    os.makedirs(post_path)
+    ipynb_path = os.path.join(post_path, 'post.ipynb')
+    for path in (ipynb_path, os.path.join(post_path, 'meta.json')):
+        with open(path, 'w') as fake_file:
+            fake_file.write('{}')
+
+    generate.manifest['global'] = 'global'
+    generate._convert_source(post_path, slug_path, ipynb_path)
+    assert generate.conversions == [(slug_path, ipynb_path, False, post_path)]
+    assert generate.manifest['sources'][post_path]['outputs'] == [os.path.join('slug', 'index.html')]
+
+    # nothing changed and output exists - conversion is skipped
+    with open(os.path.join(slug_path, 'index.html'), 'w') as out:
+        out.write('converted')
+    generate.prev_manifest = generate.manifest
+    generate.manifest = {'global': 'global', 'sources': {}, 'indexes': {}}
+    generate.conversions = []
+    generate._convert_source(post_path, slug_path, ipynb_path)
+    assert generate.conversions == []
+    assert generate.writer.counts['skipped'] == 1
+
+    # notebook changed
+    with open(ipynb_path, 'w') as fake_file:
+        fake_file.write('{"changed": true}')
+    generate._convert_source(post_path, slug_path, ipynb_path)
+    assert generate.conversions == [(slug_path, ipynb_path, False, post_path)]
+
+    shutil.rmtree(generate.out_path)
+    shutil.rmtree(post_path)
+
+
+def test_remove_stale():
+    generate = Generate()
+    generate.out_path = 'output/'
+    stale_dir = os.path.join(generate.out_path, '2015', '3', '22', 'gone')
+    os.makedirs(stale_dir)
+    with open(os.path.join(stale_dir, 'index.html'), 'w') as stale:
+        stale.write('stale')
+    with open(os.path.join(generate.out_path, 'index.html'), 'w') as main:
+        main.write('main')
+
+    generate.prev_manifest = {'sources': {'gone': {'hash': 'h', 'outputs': ['2015/3/22/gone/index.html']}},
+                              'indexes': {'index.html': 'key'}}
+    generate.manifest = {'sources': {}, 'indexes': {'index.html': 'key'}}
+    generate._remove_stale()
+
+    assert not os.path.exists(os.path.join(generate.out_path, '2015'))
+    assert os.path.exists(os.path.join(generate.out_path, 'index.html'))
+    assert generate.writer.counts['deleted'] == 1
+
+    shutil.rmtree(generate.out_path)
+
+
+def test_link_replace():
+    os.makedirs('output/')
+    src = os.path.join('output', 'src.js')
+    dst = os.path.join('output', 'dst.js')
+    with open(src, 'w') as src_file:
+        src_file.write('js')
+    os.link(src, dst)
+
+    _link_replace(src, dst)
+    assert sorted(os.listdir('output')) == ['dst.js', 'src.js']
+
+    # another worker linked dst between the check and the rename
+    with mock.patch('blgr.blgr.os.path.exists', return_value=False):
+        _link_replace(src, dst)
+    assert sorted(os.listdir('output')) == ['dst.js', 'src.js']
+    assert os.path.samefile(src, dst)
+
+    shutil.rmtree('output')
+
+
+def test_output_writer():
+    out_path = 'output/'
+    base_path = 'published/'
+    os.makedirs(base_path)
+    with open(os.path.join(base_path, 'index.html'), 'w') as published:
+        published.write('published')
+    os.utime(os.path.join(base_path, 'index.html'), (1, 1))
+
+    writer = OutputWriter(out_path, base_path)
+    page = os.path.join(out_path, 'post', 'index.html')
+    assert writer.write(page, 'page')
+    os.utime(page, (1, 1))
+    # the same bytes again leave the file and its mtime alone
+    assert not writer.write(page, 'page')
+    assert os.stat(page).st_mtime == 1
+    assert writer.write(page, b'changed')
+    with open(page, 'rb') as page_file:
+        assert page_file.read() == b'changed'
+
+    # a file the published build already has is linked from there
+    main = os.path.join(out_path, 'index.html')
+    assert not writer.write(main, 'published')
+    assert os.stat(main).st_mtime == 1
+    assert os.path.samefile(main, os.path.join(base_path, 'index.html'))
+
+    with open(page + '.tmp', 'w') as tmp:
+        tmp.write('changed')
+    assert not writer.commit(page + '.tmp', page)
+    assert not os.path.exists(page + '.tmp')
+
+    writer.remove(page)
+    writer.remove(page)
+    assert not os.path.exists(page)
+    assert writer.counts == {'written': 2, 'skipped': 3, 'deleted': 1}
+
+    shutil.rmtree(out_path)
+    shutil.rmtree(base_path)
+
+
+def test_search_terms():
+    post_path = 'post.ipynb'
+    ipynb = {'nbformat': 3, 'worksheets': [{'cells': [
+        {'cell_type': 'markdown', 'source': ['Plotting with numpy\n', 'and numpy again']},
+        {'cell_type': 'code', 'input': 'import numpy as np', 'outputs': [{'text': 'ignored'}]},
+        {'cell_type': 'raw', 'source': 'skipped'}]}]}
+    with open(post_path, 'w') as post:
+        json.dump(ipynb, post)
+
+    terms = _search_terms(post_path, {'title': 'Numpy Tricks', 'category': 'python'})
+    assert terms == {'plotting': 1, 'with': 1, 'numpy': 3 + 5, 'and': 1, 'again': 1, 'import': 1, 'as': 1,
+                     'np': 1, 'tricks': 5, 'python': 5}
+
+    os.remove(post_path)
+
+
+def test_generate_search():
+    generate = Generate()
+    generate.config = {'search': {'prefix_length': 2}}
+    generate.out_path = 'output/'
+    generate.menu_pages = []
+    generate.manifest['global'] = 'global'
+    generate.prj_path = os.path.abspath('blgr')
+    generate._prepare_templates()
+    generate.posts = {'posts/1': {'title': 'One', 'dt': '2015-03-22T00:00:00'},
+                      'posts/2': {'title': 'Two', 'dt': '2015-03-23T00:00:00'}}
+    generate.search_sources = [('posts/2', 'h2', 'two.ipynb', '/2015/3/23/two/'),
+                               ('posts/1', 'h1', 'one.ipynb', '/2015/3/22/one/')]
+    terms = {'posts/1': {'apple': 1, 'one': 5}, 'posts/2': {'apricot': 2, 'two': 5}}
+
+    notebooks = {'one.ipynb': 'posts/1', 'two.ipynb': 'posts/2'}
+    with mock.patch('blgr.blgr._search_terms', side_effect=lambda path, meta: terms[notebooks[path]]) as mock_terms:
+        generate._generate_search()
+    assert mock_terms.call_count == 2
+
+    with open(os.path.join(generate.out_path, 'search', 'index.json'), 'r') as indx:
+        assert json.load(indx) == {'prefix': 2, 'docs': [['/2015/3/22/one/', 'One', '2015-03-22T00:00:00'],
+                                                         ['/2015/3/23/two/', 'Two', '2015-03-23T00:00:00']]}
+    with open(os.path.join(generate.out_path, 'search', 'terms', 'ap.json'), 'r') as shard:
+        assert json.load(shard) == {'apple': [[0, 1]], 'apricot': [[1, 2]]}
+    assert os.path.exists(os.path.join(generate.out_path, 'search', 'index.html'))
+
+    # only the changed post is extracted again and only its shards are rewritten
+    generate.prev_manifest = generate.manifest
+    generate.manifest = {'global': 'global', 'indexes': {}}
+    generate.search_sources[0] = ('posts/2', 'h2-changed', 'two.ipynb', '/2015/3/23/two/')
+    terms['posts/2'] = {'apricot': 2, 'three': 1}
+    generate.writer = None
+    with mock.patch('blgr.blgr._search_terms', return_value=terms['posts/2']) as mock_terms, \
+            mock.patch('blgr.blgr.os.replace', wraps=os.replace) as mock_replace:
+        generate._generate_search()
+    mock_terms.assert_called_once_with('two.ipynb', generate.posts['posts/2'])
+    assert sorted(os.path.relpath(c[0][1], generate.out_path) for c in mock_replace.call_args_list) == [
+        os.path.join('search', 'terms', 'th.json')]
+    assert os.path.join('search', 'terms', 'tw.json') not in generate.manifest['indexes']
+    # the files left alone on their manifest key count as unchanged
+    assert generate.writer.counts == {'written': 1, 'skipped': 4, 'deleted': 0}
+
+    shutil.rmtree(generate.out_path)
+
+
+def test_stream_search():
+    terms = {'posts/1': {'apple': 1, 'one': 5}, 'posts/2': {'apricot': 2, 'two': 5}}
+    notebooks = {'one.ipynb': 'posts/1', 'two.ipynb': 'posts/2'}
+    sources = [('posts/2', 'h2', 'two.ipynb', '/2015/3/23/two/'), ('posts/1', 'h1', 'one.ipynb', '/2015/3/22/one/')]
+    built = {}
+    for stream in (False, True):
+        generate = Generate()
+        generate.cli_args = {'stream': stream}
+        generate.config = {'search': {'prefix_length': 2}}
+        generate.out_path = 'output-{}/'.format(stream)
+        generate.menu_pages = []
+        generate.posts = {'posts/1': {'title': 'One', 'dt': '2015-03-22T00:00:00'},
+                          'posts/2': {'title': 'Two', 'dt': '2015-03-23T00:00:00'}}
+        generate.search_sources = Spill(('source', 'hash', 'ipynb', 'url')) if stream else []
+        for source in sources:
+            generate.search_sources.append(source)
+        with mock.patch('blgr.blgr._search_terms', side_effect=lambda path, meta: terms[notebooks[path]]), \
+                mock.patch.object(generate, '_render_index_page'):
+            generate._generate_search()
+
+        built[stream] = {}
+        for dirpath, _, filenames in os.walk(generate.out_path):
+            for filename in filenames:
+                with open(os.path.join(dirpath, filename), 'r') as search_file:
+                    built[stream][os.path.relpath(os.path.join(dirpath, filename), generate.out_path)] = search_file.read()
+        assert sorted(generate.manifest['indexes']) == sorted(built[stream])
+        shutil.rmtree(generate.out_path)
+
+    # the streamed index is spilled to disk, but written byte for byte the same
+    assert built[True] == built[False]
+    assert sorted(built[True]) == [os.path.join('search', 'index.json')] + [
+        os.path.join('search', 'terms', p + '.json') for p in ('ap', 'on', 'tw')]
+
+
+def test_shard_spec():
+    assert _shard_spec('2/4') == (2, 4)
+    for spec in ('0/4', '5/4', '2', 'a/b'):
+        try:
+            _shard_spec(spec)
+        except argparse.ArgumentTypeError:
+            pass
+        else:
+            assert False, spec
+
+
+def test_assign_shards():
+    sources = ['posts/{}'.format(i) for i in range(10)]
+    shards = _assign_shards(sources, {}, 3)
+    # stable: the same posts always land on the same shards, whatever their order
+    assert shards == _assign_shards(list(reversed(sources)), {}, 3)
+    assert sorted(s for shard in shards for s in shard) == sorted(sources)
+
+    # with timings of the last build the slowest posts are spread first
+    costs = {'posts/0': 10, 'posts/1': 6, 'posts/2': 5, 'posts/3': 1}
+    shards = _assign_shards(['posts/0', 'posts/1', 'posts/2', 'posts/3'], costs, 2)
+    assert shards == [['posts/0', 'posts/3'], ['posts/1', 'posts/2']]
+
+
+def test_convert_source_shard():
+    generate = Generate()
+    generate.out_path = 'output/'
+    generate.shard_sources = {'post1'}
+    generate._convert_source('post2', 'output/slug2', 'post2/post.ipynb')
+    assert generate.conversions == []
+    assert generate.manifest['sources'] == {}
+
+
+def test_merge_shards():
+    merge = Merge()
+    merge.out_path = 'output/'
+    merge.manifest['global'] = 'global'
+    merge.cli_args = {'shards': ['shard1/', 'shard2/']}
+    for i in (1, 2):
+        post_dir = os.path.join('shard{}'.format(i), '2015', '3', '22', 'post{}'.format(i))
+        os.makedirs(post_dir)
+        with open(os.path.join(post_dir, 'index.html'), 'w') as page:
+            page.write('post{}'.format(i))
+        fragment = {'version': MANIFEST_VERSION, 'shard': [i, 2], 'global': 'global',
+                    'sources': {'post{}'.format(i): {'hash': 'h', 'outputs': ['2015/3/22/post{}/index.html'.format(i)],
+                                                     'cost': i}}}
+        with open(os.path.join('shard{}'.format(i), '.blgr-fragment.json'), 'w') as ff:
+            json.dump(fragment, ff)
+
+    merge._merge_shards()
+    assert sorted(merge.manifest['sources']) == ['post1', 'post2']
+    for i in (1, 2):
+        with open(os.path.join(merge.out_path, '2015', '3', '22', 'post{}'.format(i), 'index.html'), 'r') as page:
+            assert page.read() == 'post{}'.format(i)
+    assert not os.path.exists(os.path.join(merge.out_path, '.blgr-fragment.json'))
+
+    # every post must come from a shard, and all shards must be there
+    merge._convert_source('post1', 'output/2015/3/22/post1', 'post1/post.ipynb')
+    assert merge.search_sources == [('post1', 'h', 'post1/post.ipynb', '/2015/3/22/post1/')]
+    try:
+        merge._convert_source('post3', 'output/2015/3/22/post3', 'post3/post.ipynb')
+    except ValueError:
+        pass
+    else:
+        assert False
+    merge.cli_args = {'shards': ['shard1/']}
+    try:
+        merge._merge_shards()
+    except ValueError:
+        pass
+    else:
+        assert False
+
+    for path in ('shard1/', 'shard2/', merge.out_path):
+        shutil.rmtree(path)
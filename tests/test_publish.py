@@ -0,0 +1,110 @@
+import os
+import json
+import shutil
+
+from blgr.blgr import Publish, PUBLISH_MANIFEST_NAME
+
+
+def _write(path, data):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'w') as out:
+        out.write(data)
+
+
+def _publish(cli_args):
+    publish = Publish()
+    publish.config = {'output': {'path': 'output'}, 'publish': {'target': 'public'}}
+    publish.cli_args = cli_args
+    publish.prepare()
+    publish.execute()
+    return publish
+
+
+def test_publish():
+    _write(os.path.join('output', 'index.html'), 'main')
+    _write(os.path.join('output', 'assets', 'a.png'), 'png')
+    _write(os.path.join('output', 'old', 'index.html'), 'old')
+
+    publish = _publish({})
+    assert publish.source == os.path.realpath('output')
+    for rel_path in ('index.html', os.path.join('assets', 'a.png'), os.path.join('old', 'index.html')):
+        assert os.path.exists(os.path.join('public', rel_path))
+    with open(os.path.join('public', PUBLISH_MANIFEST_NAME), 'r') as mf:
+        manifest = json.load(mf)
+    assert manifest['files']['index.html'][1] == 4
+
+    shutil.rmtree(os.path.join('output', 'old'))
+    os.remove(os.path.join('output', 'index.html'))
+    _write(os.path.join('output', 'index.html'), 'changed main')
+    _write(os.path.join('public', 'unmanaged.txt'), 'not ours')
+
+    files, copies, stale = publish.plan()
+    assert copies == ['index.html']
+    assert stale == [os.path.join('old', 'index.html')]
+
+    # a dry run leaves the target as it is
+    _publish({'dry_run': True})
+    assert os.path.exists(os.path.join('public', 'old', 'index.html'))
+
+    mtime = os.stat(os.path.join('public', 'assets', 'a.png')).st_mtime_ns
+    _publish({'jobs': 2})
+    with open(os.path.join('public', 'index.html'), 'r') as main:
+        assert main.read() == 'changed main'
+    assert not os.path.exists(os.path.join('public', 'old'))
+    assert os.stat(os.path.join('public', 'assets', 'a.png')).st_mtime_ns == mtime
+    assert os.path.exists(os.path.join('public', 'unmanaged.txt'))
+
+    # files removed from the target behind its back are copied again
+    os.remove(os.path.join('public', 'assets', 'a.png'))
+    assert publish.plan()[1] == [os.path.join('assets', 'a.png')]
+
+    shutil.rmtree('output')
+    shutil.rmtree('public')
+
+
+def test_publish_pages_last():
+    _write(os.path.join('output', 'index.html'), 'main')
+    _write(os.path.join('output', 'index.html.gz'), 'gz')
+    _write(os.path.join('output', 'z', 'style.css'), 'css')
+    _write(os.path.join('output', 'search', 'index.json'), '{}')
+
+    publish = Publish()
+    publish.config = {'output': {'path': 'output'}}
+    publish.cli_args = {'target': 'public'}
+    publish.prepare()
+    assert publish.plan()[1] == [os.path.join('search', 'index.json'), os.path.join('z', 'style.css'),
+                                 'index.html', 'index.html.gz']
+
+    shutil.rmtree('output')
+
+
+def test_publish_relinked():
+    _write(os.path.join('output', 'index.html'), 'main')
+    _write(os.path.join('output', 'assets', 'a.png'), 'png')
+
+    _publish({})
+    # without its manifest every file is copied again, onto links of itself
+    os.remove(os.path.join('public', PUBLISH_MANIFEST_NAME))
+    _publish({})
+    published = sorted(os.path.relpath(os.path.join(dirpath, f), 'public')
+                       for dirpath, _, filenames in os.walk('public') for f in filenames)
+    assert published == [PUBLISH_MANIFEST_NAME, os.path.join('assets', 'a.png'), 'index.html']
+
+    shutil.rmtree('output')
+    shutil.rmtree('public')
+
+
+def test_publish_stale_dir_gone():
+    _write(os.path.join('output', 'index.html'), 'main')
+    _write(os.path.join('output', 'old', 'post', 'index.html'), 'old')
+    _publish({})
+
+    # the stale page's folder was removed from the target by hand
+    shutil.rmtree(os.path.join('output', 'old'))
+    shutil.rmtree(os.path.join('public', 'old', 'post'))
+    _publish({})
+    with open(os.path.join('public', PUBLISH_MANIFEST_NAME), 'r') as mf:
+        assert sorted(json.load(mf)['files']) == ['index.html']
+
+    shutil.rmtree('output')
+    shutil.rmtree('public')
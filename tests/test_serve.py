@@ -0,0 +1,300 @@
+import os
+import time
+import gzip
+import socket
+import shutil
+import threading
+import http.client
+
+from blgr.blgr import Generate, Serve, ReloadHub, _accepted_encodings, _url_path, MANIFEST_NAME, FRAGMENT_NAME
+
+
+def start_server(serve):
+    httpd = serve.make_server(('127.0.0.1', 0))
+    thread = threading.Thread(target=httpd.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return httpd
+
+
+def stop_server(httpd):
+    httpd.shutdown()
+    httpd.server_close()
+
+
+def prepare_serve(cli_args=None):
+    out_path = 'output/'
+    os.makedirs(out_path)
+    with open(os.path.join(out_path, 'index.html'), 'w') as indx:
+        indx.write('index')
+
+    serve = Serve()
+    serve.config = {'output': {'path': out_path}}
+    serve.cli_args = cli_args or {}
+    serve.prepare()
+    return serve
+
+
+def test_prepare():
+    serve = Serve()
+    serve.config = {'output': {'path': 'output/'}}
+    serve.cli_args = {'port': 8000}
+    serve.prepare()
+
+    assert serve.port == 8000
+    assert serve.out_path == 'output/'
+
+
+def test_keep_alive():
+    serve = prepare_serve()
+    httpd = start_server(serve)
+
+    conn = http.client.HTTPConnection('127.0.0.1', httpd.server_address[1])
+    for _ in range(2):
+        conn.request('GET', '/index.html')
+        resp = conn.getresponse()
+        assert resp.status == 200
+        assert resp.version == 11
+        assert resp.read() == b'index'
+    # both requests went over the same socket
+    assert conn.sock is not None
+
+    # responses are not held back by Nagle waiting on delayed ACKs (~40 ms each)
+    started = time.monotonic()
+    for _ in range(20):
+        conn.request('GET', '/index.html')
+        conn.getresponse().read()
+    assert time.monotonic() - started < 0.5
+    conn.close()
+
+    stop_server(httpd)
+    shutil.rmtree(serve.out_path)
+
+
+def test_connection_limit():
+    serve = prepare_serve({'max_connections': 1, 'timeout': 5})
+    httpd = start_server(serve)
+
+    # first connection stays open and holds the only slot
+    conn = http.client.HTTPConnection('127.0.0.1', httpd.server_address[1])
+    conn.request('GET', '/index.html')
+    assert conn.getresponse().read() == b'index'
+
+    refused = socket.create_connection(('127.0.0.1', httpd.server_address[1]))
+    assert refused.recv(1024).startswith(b'HTTP/1.1 503')
+    refused.close()
+    conn.close()
+
+    stop_server(httpd)
+    shutil.rmtree(serve.out_path)
+
+
+def test_idle_timeout():
+    serve = prepare_serve({'timeout': 0.2})
+    httpd = start_server(serve)
+
+    idle = socket.create_connection(('127.0.0.1', httpd.server_address[1]))
+    idle.settimeout(5)
+    # the server drops the connection once the timeout passes without a request
+    assert idle.recv(1024) == b''
+    idle.close()
+
+    stop_server(httpd)
+    shutil.rmtree(serve.out_path)
+
+
+def test_idle_keep_alive():
+    serve = prepare_serve({'workers': 1, 'timeout': 5})
+    httpd = start_server(serve)
+
+    # an idle keep-alive connection does not hold the only worker
+    kept = http.client.HTTPConnection('127.0.0.1', httpd.server_address[1])
+    kept.request('GET', '/index.html')
+    assert kept.getresponse().read() == b'index'
+    started = time.monotonic()
+    conn = http.client.HTTPConnection('127.0.0.1', httpd.server_address[1], timeout=5)
+    conn.request('GET', '/index.html')
+    assert conn.getresponse().read() == b'index'
+    assert time.monotonic() - started < 1
+    conn.close()
+
+    # and is picked up again once its next request arrives
+    kept.request('GET', '/index.html')
+    assert kept.getresponse().read() == b'index'
+    kept.close()
+
+    # pipelined requests sent at once are all answered
+    pipelined = socket.create_connection(('127.0.0.1', httpd.server_address[1]))
+    pipelined.settimeout(5)
+    pipelined.sendall(b'GET /index.html HTTP/1.1\r\nHost: x\r\n\r\n' * 2 +
+                      b'GET /index.html HTTP/1.1\r\nHost: x\r\nConnection: close\r\n\r\n')
+    received = b''
+    while True:
+        data = pipelined.recv(65536)
+        if not data:
+            break
+        received += data
+    assert received.count(b'HTTP/1.1 200') == 3
+    pipelined.close()
+
+    stop_server(httpd)
+    shutil.rmtree(serve.out_path)
+
+
+def test_hidden_files():
+    serve = prepare_serve()
+    for name in (MANIFEST_NAME, FRAGMENT_NAME, 'index.html.123.tmp'):
+        with open(os.path.join(serve.out_path, name), 'w') as hidden:
+            hidden.write('{}')
+    httpd = start_server(serve)
+
+    conn = http.client.HTTPConnection('127.0.0.1', httpd.server_address[1])
+    for name in (MANIFEST_NAME, FRAGMENT_NAME, 'index.html.123.tmp'):
+        conn.request('GET', '/' + name)
+        resp = conn.getresponse()
+        resp.read()
+        assert resp.status == 404
+    conn.request('GET', '/index.html')
+    assert conn.getresponse().status == 200
+    conn.close()
+
+    stop_server(httpd)
+    shutil.rmtree(serve.out_path)
+
+
+def test_accepted_encodings():
+    assert _accepted_encodings('gzip, deflate, br') == {'gzip', 'deflate', 'br'}
+    assert _accepted_encodings('gzip;q=0.5, br;q=0') == {'gzip'}
+    assert _accepted_encodings('') == set()
+
+
+def test_precompressed():
+    serve = prepare_serve()
+    indx_path = os.path.join(serve.out_path, 'index.html')
+    with open(indx_path + '.gz', 'wb') as gz:
+        gz.write(gzip.compress(b'index'))
+    # generate --compress gives siblings the mtime of their source
+    st = os.stat(indx_path)
+    os.utime(indx_path + '.gz', ns=(st.st_atime_ns, st.st_mtime_ns))
+    httpd = start_server(serve)
+
+    conn = http.client.HTTPConnection('127.0.0.1', httpd.server_address[1])
+    conn.request('GET', '/', headers={'Accept-Encoding': 'gzip, br'})
+    resp = conn.getresponse()
+    assert resp.status == 200
+    assert resp.getheader('Content-Encoding') == 'gzip'
+    assert resp.getheader('Content-Type') == 'text/html'
+    assert resp.getheader('Vary') == 'Accept-Encoding'
+    assert gzip.decompress(resp.read()) == b'index'
+
+    conn.request('GET', '/index.html')
+    resp = conn.getresponse()
+    assert resp.getheader('Content-Encoding') is None
+    assert resp.read() == b'index'
+
+    # a page rewritten since it was compressed is sent as it is now
+    with open(indx_path, 'w') as indx:
+        indx.write('changed')
+    os.utime(indx_path, ns=(st.st_atime_ns, st.st_mtime_ns + 1000))
+    conn.request('GET', '/', headers={'Accept-Encoding': 'gzip'})
+    resp = conn.getresponse()
+    assert resp.getheader('Content-Encoding') is None
+    assert resp.read() == b'changed'
+    conn.close()
+
+    stop_server(httpd)
+    shutil.rmtree(serve.out_path)
+
+
+def test_conditional_get():
+    serve = prepare_serve()
+    serve.config['serve'] = {'cache_control': [['*.html', 'no-cache'], ['*', 'max-age=60']]}
+    generate = Generate()
+    generate.out_path = serve.out_path
+    generate._generate_file_hashes()
+    generate._save_manifest()
+    etag = '"{}"'.format(generate.manifest['files']['index.html'][2])
+    httpd = start_server(serve)
+
+    conn = http.client.HTTPConnection('127.0.0.1', httpd.server_address[1])
+    conn.request('GET', '/')
+    resp = conn.getresponse()
+    resp.read()
+    assert resp.getheader('ETag') == etag
+    assert resp.getheader('Cache-Control') == 'no-cache'
+    last_modified = resp.getheader('Last-Modified')
+
+    conn.request('GET', '/', headers={'If-None-Match': 'W/' + etag})
+    resp = conn.getresponse()
+    assert resp.status == 304
+    assert resp.read() == b''
+    assert resp.getheader('ETag') == etag
+
+    conn.request('GET', '/', headers={'If-None-Match': '"other"'})
+    resp = conn.getresponse()
+    assert resp.status == 200
+    assert resp.read() == b'index'
+
+    conn.request('GET', '/', headers={'If-Modified-Since': last_modified})
+    resp = conn.getresponse()
+    assert resp.status == 304
+    resp.read()
+
+    # a file changed after the build gets no stale ETag
+    with open(os.path.join(serve.out_path, 'index.html'), 'w') as indx:
+        indx.write('changed')
+    conn.request('GET', '/index.html', headers={'If-None-Match': etag})
+    resp = conn.getresponse()
+    assert resp.status == 200
+    assert resp.getheader('ETag') is None
+    assert resp.read() == b'changed'
+    conn.close()
+
+    stop_server(httpd)
+    shutil.rmtree(serve.out_path)
+
+
+def test_url_path():
+    assert _url_path('index.html') == '/'
+    assert _url_path(os.path.join('2015', '3', 'post', 'index.html')) == '/2015/3/post/'
+    assert _url_path('/2015/3/post/') == '/2015/3/post/'
+    assert _url_path('style.css') == '/style.css'
+
+
+def test_live_reload():
+    serve = prepare_serve({'workers': 1})
+    httpd = start_server(serve)
+    httpd.reload_hub = ReloadHub()
+
+    port = httpd.server_address[1]
+    streams = []
+    for path in ('/post/', '/other/'):
+        stream = socket.create_connection(('127.0.0.1', port))
+        stream.settimeout(5)
+        stream.sendall('GET /__blgr/reload?path={} HTTP/1.1\r\nHost: localhost\r\n\r\n'.format(path).encode())
+        assert b'text/event-stream' in stream.recv(1024)
+        streams.append(stream)
+
+    deadline = time.monotonic() + 5
+    while len(httpd.reload_hub.clients) < 2 and time.monotonic() < deadline:
+        time.sleep(0.01)
+
+    # open streams do not hold worker threads - a pool of one still serves files
+    conn = http.client.HTTPConnection('127.0.0.1', port)
+    conn.request('GET', '/index.html')
+    assert conn.getresponse().read() == b'index'
+    conn.close()
+
+    assert httpd.reload_hub.notify([os.path.join('post', 'index.html')]) == 1
+    assert streams[0].recv(1024) == b'data: reload\n\n'
+
+    # a closed tab is dropped
+    streams[1].close()
+    deadline = time.monotonic() + 5
+    while len(httpd.reload_hub.clients) > 1 and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert len(httpd.reload_hub.clients) == 1
+
+    streams[0].close()
+    stop_server(httpd)
+    shutil.rmtree(serve.out_path)
@@ -0,0 +1,167 @@
+import os
+import time
+import json
+import shutil
+from unittest import mock
+
+from blgr.blgr import Serve, InotifyWatcher, PollingWatcher, _make_watcher
+
+
+def prepare_watched():
+    posts_path = 'posts/'
+    os.makedirs(os.path.join(posts_path, 'post1'))
+    with open(os.path.join(posts_path, 'post1', 'meta.json'), 'w') as meta:
+        meta.write('{}')
+    with open('watched.json', 'w') as cfg:
+        cfg.write('{}')
+    return posts_path
+
+
+def clean_watched():
+    shutil.rmtree('posts/')
+    os.remove('watched.json')
+
+
+def check_watcher(watcher, posts_path):
+    assert watcher.wait(0.05) == set()
+
+    meta_path = os.path.join(posts_path, 'post1', 'meta.json')
+    with open(meta_path, 'w') as meta:
+        meta.write('{"changed": true}')
+    assert meta_path in watcher.wait(2)
+
+    # new post directories are picked up as well
+    os.makedirs(os.path.join(posts_path, 'post2'))
+    watcher.wait(2)
+    new_meta = os.path.join(posts_path, 'post2', 'meta.json')
+    with open(new_meta, 'w') as meta:
+        meta.write('{}')
+    changed = set()
+    deadline = time.monotonic() + 2
+    while new_meta not in changed and time.monotonic() < deadline:
+        changed |= watcher.wait(0.2)
+    assert new_meta in changed
+
+    with open('watched.json', 'w') as cfg:
+        cfg.write('{"changed": true}')
+    changed = watcher.wait(2)
+    assert any(os.path.abspath(c) == os.path.abspath('watched.json') for c in changed)
+    watcher.close()
+
+
+def test_polling_watcher():
+    posts_path = prepare_watched()
+    check_watcher(PollingWatcher([posts_path], ['watched.json'], interval=0.01), posts_path)
+    clean_watched()
+
+
+def test_inotify_watcher():
+    posts_path = prepare_watched()
+    watcher = _make_watcher([posts_path], ['watched.json'])
+    if isinstance(watcher, InotifyWatcher):
+        check_watcher(watcher, posts_path)
+    else:
+        watcher.close()
+    clean_watched()
+
+
+def test_watch_debounces():
+    serve = Serve()
+    serve.cli_args = {'debounce': 0.01}
+    serve.config = {'output': {'path': 'output/'}}
+    serve.prepare()
+
+    bursts = [{'a'}, {'b'}, set(), set(), {'c'}, set()]
+
+    def wait(timeout):
+        if not bursts:
+            serve.stop_event.set()
+            return set()
+        return bursts.pop(0)
+
+    watcher = mock.Mock()
+    watcher.wait.side_effect = wait
+    with mock.patch.object(serve, '_rebuild') as mock_rebuild:
+        serve._watch(watcher, 'generate')
+
+    assert mock_rebuild.call_args_list == [mock.call('generate', {'a', 'b'}), mock.call('generate', {'c'})]
+
+
+def test_rebuild_reloads_config():
+    with open('watched.json', 'w') as cfg:
+        json.dump({'output': {'path': 'other/'}}, cfg)
+
+    serve = Serve()
+    serve.config = {'output': {'path': 'output/'}}
+    serve.cli_args = {'config_path': 'watched.json'}
+    serve.prepare()
+    generate = serve._make_generate()
+    assert generate.cli_args['incremental']
+
+    with mock.patch.object(generate, 'prepare') as mock_prepare:
+        with mock.patch.object(generate, 'execute') as mock_execute:
+            assert serve._rebuild(generate, {os.path.abspath('watched.json')})
+    mock_prepare.assert_called_once_with()
+    mock_execute.assert_called_once_with()
+    assert generate.config == {'output': {'path': 'other/'}}
+
+    with mock.patch.object(generate, 'prepare', side_effect=ValueError):
+        assert not serve._rebuild(generate)
+
+    os.remove('watched.json')
+
+
+def test_rebuild_notifies_changed_pages():
+    serve = Serve()
+    serve.config = {'output': {'path': 'output/'}}
+    serve.prepare()
+    serve.reload_hub = mock.Mock()
+    generate = serve._make_generate()
+    generate.prev_manifest = {'files': {'index.html': [1, 1, 'a'], 'post/index.html': [1, 1, 'b']}}
+    generate.manifest = {'files': {'index.html': [2, 1, 'a'], 'post/index.html': [2, 1, 'c'],
+                                   'new/index.html': [2, 1, 'd']}}
+
+    with mock.patch.object(generate, 'prepare'):
+        with mock.patch.object(generate, 'execute'):
+            serve._rebuild(generate)
+
+    # index.html was rewritten with the same content, so its tabs are left alone
+    assert sorted(serve.reload_hub.notify.call_args[0][0]) == ['new/index.html', 'post/index.html']
+
+
+def test_preview_path():
+    serve = Serve()
+    serve.config = {'output': {'path': 'output/'}}
+    serve.cli_args = {'watch': True}
+    serve.prepare()
+    assert serve.out_path == 'output.preview'
+
+    generate = serve._make_generate()
+    generate._generate_out_path()
+    assert generate.publish_path == 'output.preview'
+    assert generate.out_path.startswith('output.preview.generations')
+    assert not os.path.exists('output.generations')
+
+    shutil.rmtree('output.preview.generations')
+
+
+def test_watch_template_dirs():
+    serve = Serve()
+    serve.config = {'output': {'path': 'output/'}, 'posts': {'path': 'posts/'},
+                    'templates': {'paths': ['my-templates/']}}
+    serve.cli_args = {'watch': True}
+    serve.prepare()
+
+    def rebuild(generate, changed=()):
+        generate.prj_path = os.path.abspath('blgr')
+
+    with mock.patch.object(serve, '_rebuild', side_effect=rebuild), \
+            mock.patch.object(serve, 'make_server'), \
+            mock.patch.object(serve, '_watch'), \
+            mock.patch('blgr.blgr._make_watcher') as mock_watcher:
+        serve.execute()
+
+    # templates from the config are watched, not only the bundled ones
+    assert mock_watcher.call_args[0][0] == ['posts/', 'my-templates/',
+                                            os.path.join(os.path.abspath('blgr'), 'data/templates/')]
+    mock_watcher.return_value.close.assert_called_once_with()